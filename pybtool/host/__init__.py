@@ -1,3 +1,10 @@
 from .hci import HCI
+from .connection import Connection, ConnectionManager, ConnectionEvent
 from .l2cap import L2CAP
-from .att import ATT
\ No newline at end of file
+from .l2cap_coc import L2capCoc, L2capCocChannel
+from .att import ATT
+from .att_notify import Notifier
+from .att_db import Attribute, AttributeDatabase, default_database
+from .gatt import GATT
+from .sm import SecurityManager
+from .aio import AsyncHCI, AsyncL2CAP, AsyncATT
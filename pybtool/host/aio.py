@@ -0,0 +1,178 @@
+import asyncio
+import logging
+from .hci import HCI, hci_init_cmds
+from .hci_cmd import HciCmd
+from .hci_evt import HciEvent
+from .l2cap import L2CAP
+from .att import ATT
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncHCI:
+    """
+    asyncio front end of HCI
+
+    The transport receive thread stays the only reader, its callbacks hand
+    results over to the event loop with call_soon_threadsafe, so no thread or
+    sleep loop is needed per operation. Create it from inside the event loop.
+    """
+
+    def __init__(self, hci: HCI, loop: asyncio.AbstractEventLoop = None):
+        self.hci = hci
+        self.loop = loop or asyncio.get_running_loop()
+
+    async def send_command(self, cmd: HciCmd, expect_evt: HciEvent = None, timeout: float = 2):
+        """
+        send command and await its Command Complete/Command Status event, None on timeout
+        """
+        future = self.hci.submit_command(cmd, expect_evt)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future, loop=self.loop), timeout)
+        except asyncio.TimeoutError:
+            self.hci.cmd_scheduler.cancel(cmd.opcode, future)
+            logger.warning(f"cmd opcode:0x{cmd.opcode:04X} timeout")
+            return None
+
+    async def send_commands(self, cmds: list, timeout: float = 2) -> list:
+        """
+        pipeline commands, cmds: list of (HciCmd, expect_evt)
+        """
+        return await asyncio.gather(*[self.send_command(cmd, evt, timeout) for cmd, evt in cmds])
+
+    async def init(self):
+        """
+        hci module init
+        """
+        cmds = [(h[0](), h[1]()) for h in hci_init_cmds]
+        evts = await self.send_commands(cmds)
+        for hcievt in evts:
+            logger.info(hcievt)
+        self.hci._setup_acl_buffers(evts)
+
+    async def send_acl_data(self, connection_handle: int, data: bytes):
+        """
+        queue a L2CAP PDU, HCI flow control sends it when the controller has buffers
+        """
+        self.hci.send_acl_data(connection_handle, data)
+
+    def event_queue(self, event_code: int, maxsize: int = 0) -> asyncio.Queue:
+        """
+        subscribe to an event, every received event is put in the returned queue
+        """
+        queue = asyncio.Queue(maxsize)
+        self.hci.register_event(event_code, self._queue_put(queue))
+        return queue
+
+    def le_event_queue(self, subevent_code: int, maxsize: int = 0) -> asyncio.Queue:
+        """
+        subscribe to a LE Meta subevent, every received event is put in the returned queue
+        """
+        queue = asyncio.Queue(maxsize)
+        self.hci.register_le_event(subevent_code, self._queue_put(queue))
+        return queue
+
+    async def wait_event(self, event_code: int, timeout: float = None) -> HciEvent:
+        """
+        await the next event with event_code
+        """
+        future = self.loop.create_future()
+
+        def cb(evt):
+            self.loop.call_soon_threadsafe(self._set_result, future, evt)
+
+        self.hci.register_event(event_code, cb)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.hci.unregister_event(event_code, cb)
+
+    def _queue_put(self, queue: asyncio.Queue) -> callable:
+        def cb(item):
+            self.loop.call_soon_threadsafe(self._put_nowait, queue, item)
+
+        return cb
+
+    @staticmethod
+    def _put_nowait(queue: asyncio.Queue, item):
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logger.warning("async queue full, drop item")
+
+    @staticmethod
+    def _set_result(future: asyncio.Future, result):
+        if not future.done():
+            future.set_result(result)
+
+
+class AsyncL2CAP:
+    """
+    asyncio front end of L2CAP
+    """
+
+    def __init__(self, l2cap: L2CAP, loop: asyncio.AbstractEventLoop = None):
+        self.l2cap = l2cap
+        self.loop = loop or asyncio.get_running_loop()
+        # cid -> asyncio.Queue of (connection_handle, payload)
+        self.queues = {}
+
+    async def send(self, connection_handle: int, cid: int, data: bytes):
+        self.l2cap.send(connection_handle, cid, data)
+
+    async def receive(self, cid: int):
+        """
+        await the next payload received on cid, return (connection_handle, payload)
+        """
+        return await self.channel(cid).get()
+
+    def channel(self, cid: int) -> asyncio.Queue:
+        """
+        route cid to a queue in the event loop
+        """
+        queue = self.queues.get(cid)
+        if queue is None:
+            queue = self.queues[cid] = asyncio.Queue()
+
+            def cb(connection_handle, cid, payload):
+                self.loop.call_soon_threadsafe(queue.put_nowait, (connection_handle, payload))
+
+            self.l2cap.register_channel(cid, cb)
+        return queue
+
+
+class AsyncATT:
+    """
+    asyncio front end of the ATT client requests
+
+    A request given up by timeout or cancellation while still queued is never
+    sent, the outstanding one is failed by the ATT transaction timeout.
+    """
+
+    # ATT transaction timeout
+    TIMEOUT = 30
+
+    def __init__(self, att: ATT, loop: asyncio.AbstractEventLoop = None):
+        self.att = att
+        self.loop = loop or asyncio.get_running_loop()
+
+    async def request(self, connection_handle: int, pdu: bytes, timeout: float = TIMEOUT) -> bytes:
+        """
+        send a request and await the response pdu, raise AttError on error response
+        """
+        return await self._wait(self.att.request(connection_handle, pdu), timeout)
+
+    async def read(self, connection_handle: int, handle: int, timeout: float = TIMEOUT) -> bytes:
+        return await self._wait(self.att.read(connection_handle, handle), timeout)
+
+    async def find_information(self, connection_handle: int, start_handle: int, end_handle: int, timeout: float = TIMEOUT) -> bytes:
+        return await self._wait(self.att.find_information(connection_handle, start_handle, end_handle), timeout)
+
+    async def read_by_type(self, connection_handle: int, start_handle: int, end_handle: int, attribute_type: bytes, timeout: float = TIMEOUT) -> bytes:
+        return await self._wait(self.att.read_by_type(connection_handle, start_handle, end_handle, attribute_type), timeout)
+
+    async def read_by_group_type(self, connection_handle: int, start_handle: int, end_handle: int, group_type: bytes, timeout: float = TIMEOUT) -> bytes:
+        return await self._wait(self.att.read_by_group_type(connection_handle, start_handle, end_handle, group_type), timeout)
+
+    async def _wait(self, future, timeout: float):
+        return await asyncio.wait_for(asyncio.wrap_future(future, loop=self.loop), timeout)
@@ -1,7 +1,26 @@
 import logging
 import struct
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError
 from enum import IntEnum
+from .hci_evt import HciEventDisconnectionComplete
+from .connection import ATT_DEFAULT_MTU
+from .att_db import AttributeDatabase, default_database, uuid16, uuid_to_short, PERM_READ, PERM_READ_ENCRYPTED, PERM_WRITE, PERM_WRITE_ENCRYPTED, GATT_PRIMARY_SERVICE, GATT_SECONDARY_SERVICE
+from .trace import get_tracer
 logger = logging.getLogger(__name__)
+tracer = get_tracer("att")
+
+ATT_CID = 0x0004
+# largest ATT_MTU on LE, attribute values are at most 512 bytes
+ATT_MAX_MTU = 517
+ATT_MAX_VALUE_LEN = 512
+# prepared writes queued per connection before Prepare Queue Full
+ATT_PREPARE_QUEUE_MAX = 64
+# sign counter (4 bytes) and MAC (8 bytes) at the end of a Signed Write Command
+ATT_SIGNATURE_LEN = 12
+# ATT transaction timeout, a request not answered in time closes the bearer
+ATT_TRANSACTION_TIMEOUT = 30
 
 class ATT_OPCODE(IntEnum):
     ATT_ERROR_RSP = 0x01
@@ -21,30 +40,662 @@ class ATT_OPCODE(IntEnum):
     ATT_READ_MULTIPLE_RSP = 0x0F
     ATT_READ_BY_GROUP_TYPE_REQ = 0x10
     ATT_READ_BY_GROUP_TYPE_RSP = 0x11
+    ATT_WRITE_REQ = 0x12
+    ATT_WRITE_RSP = 0x13
+    ATT_PREPARE_WRITE_REQ = 0x16
+    ATT_PREPARE_WRITE_RSP = 0x17
+    ATT_EXECUTE_WRITE_REQ = 0x18
+    ATT_EXECUTE_WRITE_RSP = 0x19
+    ATT_HANDLE_VALUE_NTF = 0x1B
+    ATT_HANDLE_VALUE_IND = 0x1D
+    ATT_HANDLE_VALUE_CFM = 0x1E
     ATT_READ_MULTIPLE_VARIABLE_REQ = 0x20
     ATT_READ_MULTIPLE_VARIABLE_RSP = 0x21
+    ATT_WRITE_CMD = 0x52
+    ATT_SIGNED_WRITE_CMD = 0xD2
+
+# opcode bit 6, commands get no response, not even an error
+ATT_COMMAND_FLAG = 0x40
+
+
+class ATT_ERROR(IntEnum):
+    ATT_INVALID_HANDLE = 0x01
+    ATT_READ_NOT_PERMITTED = 0x02
+    ATT_WRITE_NOT_PERMITTED = 0x03
+    ATT_INVALID_PDU = 0x04
+    ATT_INSUFFICIENT_AUTHENTICATION = 0x05
+    ATT_REQUEST_NOT_SUPPORTED = 0x06
+    ATT_INVALID_OFFSET = 0x07
+    ATT_INSUFFICIENT_AUTHORIZATION = 0x08
+    ATT_PREPARE_QUEUE_FULL = 0x09
+    ATT_ATTRIBUTE_NOT_FOUND = 0x0A
+    ATT_ATTRIBUTE_NOT_LONG = 0x0B
+    ATT_ENCRYPTION_KEY_SIZE_TOO_SHORT = 0x0C
+    ATT_INVALID_ATTRIBUTE_VALUE_LENGTH = 0x0D
+    ATT_UNLIKELY_ERROR = 0x0E
+    ATT_INSUFFICIENT_ENCRYPTION = 0x0F
+    ATT_UNSUPPORTED_GROUP_TYPE = 0x10
+    ATT_INSUFFICIENT_RESOURCES = 0x11
+
+# server to client responses, each one completes the outstanding request of the bearer
+ATT_RESPONSES = {
+    ATT_OPCODE.ATT_ERROR_RSP,
+    ATT_OPCODE.ATT_EXCHANGE_MTU_RSP,
+    ATT_OPCODE.ATT_FIND_INFORMATION_RSP,
+    ATT_OPCODE.ATT_FIND_BY_TYPE_VALUE_RSP,
+    ATT_OPCODE.ATT_READ_BY_TYPE_RSP,
+    ATT_OPCODE.ATT_READ_RSP,
+    ATT_OPCODE.ATT_READ_BLOB_RSP,
+    ATT_OPCODE.ATT_READ_MULTIPLE_RSP,
+    ATT_OPCODE.ATT_READ_BY_GROUP_TYPE_RSP,
+    ATT_OPCODE.ATT_READ_MULTIPLE_VARIABLE_RSP,
+    ATT_OPCODE.ATT_WRITE_RSP,
+    ATT_OPCODE.ATT_PREPARE_WRITE_RSP,
+    ATT_OPCODE.ATT_EXECUTE_WRITE_RSP,
+}
+
+# Execute Write Request flags
+ATT_EXECUTE_WRITE_CANCEL = 0x00
+ATT_EXECUTE_WRITE_COMMIT = 0x01
+
+
+def att_opcode_name(opcode: int) -> str:
+    try:
+        return ATT_OPCODE(opcode).name
+    except ValueError:
+        return "UNKNOWN"
+
+
+class AttError(Exception):
+    """
+    ATT error response
+    """
+
+    def __init__(self, request_opcode: int, handle: int, error_code: int):
+        super().__init__(f"att error rsp request:{att_opcode_name(request_opcode)} handle:0x{handle:04X} error_code:0x{error_code:02X}")
+        self.request_opcode = request_opcode
+        self.handle = handle
+        self.error_code = error_code
+
 
 class ATT:
-    def __init__(self, l2cap):
+    """
+    ATT bearer on the LE fixed channel
+
+    Client side: request() keeps one outstanding request per connection and
+    resolves futures with the response PDUs. A request not answered within
+    timeout fails with TimeoutError together with the requests queued behind
+    it, and later requests on that connection fail with ConnectionError until
+    it is closed, as ATT requires after a transaction timeout. Cancelled
+    requests still waiting in the queue are never sent. Server side: requests are
+    answered from an AttributeDatabase, range queries are bisections on the
+    database indexes and every response packs as many entries as fit in the
+    connection ATT_MTU.
+    """
+
+    def __init__(self, l2cap, db: AttributeDatabase = None, mtu: int = ATT_MAX_MTU, signer: callable = None, verifier: callable = None, timeout: float = ATT_TRANSACTION_TIMEOUT):
+        """
+        db: attribute database of the server, default GAP/Battery/GATT services
+        mtu: ATT_MTU offered in MTU exchanges, bounded by the L2CAP mtu
+        signer: signer(connection_handle, data) -> 12 bytes signature (sign counter and MAC) for Signed Write Commands
+        verifier: verifier(connection_handle, data, signature) -> bool, received Signed Write Commands are dropped without it
+        timeout: ATT transaction timeout in seconds
+        """
         self.l2cap = l2cap
-        self.l2cap.register_att(self.att_handler)
+        self.signer = signer
+        self.verifier = verifier
+        self.timeout = timeout
+        self.local_mtu = max(ATT_DEFAULT_MTU, min(mtu, ATT_MAX_MTU, l2cap.mtu))
+        self.l2cap.register_channel(ATT_CID, self.att_handler)
+        self.db = db if db is not None else default_database()
+        self.connections = getattr(self.l2cap.hci, "connections", None)
+        # request opcode -> handler(connection_handle, att_data) -> response pdu
+        self.server_handlers = {
+            ATT_OPCODE.ATT_EXCHANGE_MTU_REQ: self.exchange_mtu_req,
+            ATT_OPCODE.ATT_FIND_INFORMATION_REQ: self.find_information_req,
+            ATT_OPCODE.ATT_FIND_BY_TYPE_VALUE_REQ: self.find_by_type_value_req,
+            ATT_OPCODE.ATT_READ_BY_TYPE_REQ: self.read_by_type_req,
+            ATT_OPCODE.ATT_READ_REQ: self.read_req,
+            ATT_OPCODE.ATT_READ_BLOB_REQ: self.read_blob_req,
+            ATT_OPCODE.ATT_READ_MULTIPLE_REQ: self.read_multiple_req,
+            ATT_OPCODE.ATT_READ_BY_GROUP_TYPE_REQ: self.read_by_group_type_req,
+            ATT_OPCODE.ATT_READ_MULTIPLE_VARIABLE_REQ: self.read_multiple_variable_req,
+            ATT_OPCODE.ATT_WRITE_REQ: self.write_req,
+            ATT_OPCODE.ATT_WRITE_CMD: self.write_cmd_handler,
+            ATT_OPCODE.ATT_SIGNED_WRITE_CMD: self.signed_write_cmd_handler,
+            ATT_OPCODE.ATT_PREPARE_WRITE_REQ: self.prepare_write_req,
+            ATT_OPCODE.ATT_EXECUTE_WRITE_REQ: self.execute_write_req,
+            ATT_OPCODE.ATT_HANDLE_VALUE_NTF: self.handle_value_ntf,
+            ATT_OPCODE.ATT_HANDLE_VALUE_IND: self.handle_value_ind,
+            ATT_OPCODE.ATT_HANDLE_VALUE_CFM: self.handle_value_cfm,
+        }
+        # callbacks for the notifications and indications received from the peer server
+        self.notification_callbacks = []
+        # callbacks for the confirmations of the indications sent by the server
+        self.confirmation_callbacks = []
+        # connection handle -> list of (handle, offset, value) of the server prepare queue
+        self.prepare_queues = {}
+        # connection handle -> deque of (pdu, future), the head one is outstanding
+        self.requests = {}
+        # connection handle -> transaction timer of the outstanding request
+        self.request_timers = {}
+        # connection handles whose ATT transaction timed out
+        self.timed_out = set()
+        self.requests_lock = threading.Lock()
+        self.l2cap.hci.register_event(HciEventDisconnectionComplete.EVENT_CODE, self._on_disconnection_complete)
 
     def att_handler(self, connection_handle, cid, att_data: bytes):
-        logger.info("att recv:" + " ".join([hex(i) for i in att_data]))
+        tracer.packet("att recv", att_data)
         opcode  = att_data[0]
-        logger.info(f"att opcode:0x{opcode:02X} {ATT_OPCODE(opcode).name}")
-        parameters = att_data[1:]
-        if opcode == ATT_OPCODE.ATT_READ_BY_GROUP_TYPE_REQ:
-            self.read_by_group_type_req(connection_handle, cid, parameters)
+        if tracer.enabled():
+            tracer.log("att opcode:0x%02X %s", opcode, att_opcode_name(opcode))
+        if opcode in ATT_RESPONSES:
+            self.response_handler(connection_handle, opcode, att_data)
+        else:
+            self.server_handler(connection_handle, opcode, att_data)
+
+    def register_notification(self, cb: callable):
+        """
+        注册 notification/indication 回调函数, cb(connection_handle, handle, value)
+        """
+        if cb not in self.notification_callbacks:
+            self.notification_callbacks.append(cb)
+
+    def unregister_notification(self, cb: callable):
+        """
+        取消注册 notification/indication 回调函数
+        """
+        if cb in self.notification_callbacks:
+            self.notification_callbacks.remove(cb)
+
+    def register_confirmation(self, cb: callable):
+        """
+        注册 indication confirmation 回调函数, cb(connection_handle)
+        """
+        if cb not in self.confirmation_callbacks:
+            self.confirmation_callbacks.append(cb)
+
+    def unregister_confirmation(self, cb: callable):
+        """
+        取消注册 indication confirmation 回调函数
+        """
+        if cb in self.confirmation_callbacks:
+            self.confirmation_callbacks.remove(cb)
+
+    def mtu(self, connection_handle) -> int:
+        """
+        ATT_MTU of a connection
+        """
+        connection = self.connections.get(connection_handle) if self.connections is not None else None
+        return connection.mtu if connection is not None else ATT_DEFAULT_MTU
+
+    def _set_mtu(self, connection_handle, client_mtu: int, server_mtu: int) -> int:
+        """
+        ATT_MTU of the connection after an exchange, the smaller of both Rx MTUs
+        """
+        mtu = max(ATT_DEFAULT_MTU, min(client_mtu, server_mtu))
+        connection = self.connections.get(connection_handle) if self.connections is not None else None
+        if connection is not None:
+            connection.mtu = mtu
+        logger.info(f"att connection_handle:0x{connection_handle:04X} mtu:{mtu}")
+        return mtu
+
+    def request(self, connection_handle, pdu: bytes) -> Future:
+        """
+        send a request, the returned future resolves to the response pdu
+
+        ATT allows one outstanding request per bearer, later requests are
+        queued and sent when the previous response arrives
+        """
+        future = Future()
+        with self.requests_lock:
+            if connection_handle in self.timed_out:
+                future.set_exception(ConnectionError(f"connection 0x{connection_handle:04X} att bearer closed after a transaction timeout"))
+                return future
+            requests = self.requests.setdefault(connection_handle, deque())
+            requests.append((pdu, future))
+            send = len(requests) == 1
+            if send:
+                self._start_timer(connection_handle, future)
+        if send:
+            self.l2cap.send(connection_handle, ATT_CID, pdu)
+        return future
+
+    def response_handler(self, connection_handle, opcode, att_data: bytes):
+        with self.requests_lock:
+            requests = self.requests.get(connection_handle)
+            if not requests:
+                logger.warning(f"att unexpected response:0x{opcode:02X} {att_opcode_name(opcode)}")
+                return
+            pdu, future = requests.popleft()
+            self.request_timers.pop(connection_handle).cancel()
+            # requests cancelled while queued are dropped unsent
+            while requests and requests[0][1].cancelled():
+                requests.popleft()
+            next_pdu = requests[0][0] if requests else None
+            if requests:
+                self._start_timer(connection_handle, requests[0][1])
+            else:
+                del self.requests[connection_handle]
+        if next_pdu is not None:
+            self.l2cap.send(connection_handle, ATT_CID, next_pdu)
+        if opcode == ATT_OPCODE.ATT_EXCHANGE_MTU_RSP:
+            # the MTU applies before the next request is built by the waiter
+            self._set_mtu(connection_handle, struct.unpack_from('<H', pdu, 1)[0], struct.unpack_from('<H', att_data, 1)[0])
+        if not future.set_running_or_notify_cancel():
+            return
+        if opcode == ATT_OPCODE.ATT_ERROR_RSP:
+            request_opcode, handle, error_code = struct.unpack('<BHB', att_data[1:5])
+            future.set_exception(AttError(request_opcode, handle, error_code))
         else:
-            logger.error(f"att opcode:0x{opcode:02X} {ATT_OPCODE(opcode).name} not supported")
+            future.set_result(att_data)
+
+    def _start_timer(self, connection_handle, future: Future):
+        # called with requests_lock held, when the request becomes outstanding
+        timer = threading.Timer(self.timeout, self._on_request_timeout, [connection_handle, future])
+        timer.daemon = True
+        self.request_timers[connection_handle] = timer
+        timer.start()
+
+    def _on_request_timeout(self, connection_handle, future: Future):
+        with self.requests_lock:
+            requests = self.requests.get(connection_handle)
+            if not requests or requests[0][1] is not future:
+                # answered meanwhile
+                return
+            del self.requests[connection_handle]
+            del self.request_timers[connection_handle]
+            self.timed_out.add(connection_handle)
+        logger.warning(f"att connection_handle:0x{connection_handle:04X} request:0x{requests[0][0][0]:02X} not answered, bearer closed")
+        self._fail(requests, TimeoutError(f"connection 0x{connection_handle:04X} att request not answered"))
+
+    @staticmethod
+    def _fail(requests, exception: Exception):
+        for _, future in requests:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exception)
+
+    def _on_disconnection_complete(self, evt):
+        if evt.status == 0:
+            self.disconnected(evt.connection_handle)
+
+    def disconnected(self, connection_handle):
+        """
+        fail the requests of a closed connection
+        """
+        self.prepare_queues.pop(connection_handle, None)
+        with self.requests_lock:
+            requests = self.requests.pop(connection_handle, ())
+            timer = self.request_timers.pop(connection_handle, None)
+            if timer is not None:
+                timer.cancel()
+            self.timed_out.discard(connection_handle)
+        self._fail(requests, ConnectionError(f"connection 0x{connection_handle:04X} disconnected"))
+
+    def exchange_mtu(self, connection_handle, mtu: int = None) -> Future:
+        """
+        offer mtu (local_mtu by default) as client Rx MTU, the connection
+        ATT_MTU is updated when the response arrives
+        """
+        mtu = self.local_mtu if mtu is None else mtu
+        return self.request(connection_handle, struct.pack('<BH', ATT_OPCODE.ATT_EXCHANGE_MTU_REQ, mtu))
+
+    def read(self, connection_handle, handle) -> Future:
+        return self.request(connection_handle, struct.pack('<BH', ATT_OPCODE.ATT_READ_REQ, handle))
+
+    def read_blob(self, connection_handle, handle, offset: int) -> Future:
+        return self.request(connection_handle, struct.pack('<BHH', ATT_OPCODE.ATT_READ_BLOB_REQ, handle, offset))
+
+    def read_multiple(self, connection_handle, handles: list) -> Future:
+        """
+        values concatenated in the response, only usable for known fixed length values
+        """
+        return self.request(connection_handle, struct.pack(f'<B{len(handles)}H', ATT_OPCODE.ATT_READ_MULTIPLE_REQ, *handles))
+
+    def read_multiple_variable(self, connection_handle, handles: list) -> Future:
+        """
+        the response has a (length, value) tuple per handle, the last one may be truncated to the ATT_MTU
+        """
+        return self.request(connection_handle, struct.pack(f'<B{len(handles)}H', ATT_OPCODE.ATT_READ_MULTIPLE_VARIABLE_REQ, *handles))
+
+    def write(self, connection_handle, handle, value: bytes) -> Future:
+        return self.request(connection_handle, struct.pack('<BH', ATT_OPCODE.ATT_WRITE_REQ, handle) + value)
+
+    def write_cmd(self, connection_handle, handle, value: bytes):
+        """
+        Write Command, sent at once without waiting for the outstanding request
+        """
+        self.l2cap.send(connection_handle, ATT_CID, struct.pack('<BH', ATT_OPCODE.ATT_WRITE_CMD, handle) + value)
+
+    def signed_write_cmd(self, connection_handle, handle, value: bytes):
+        if self.signer is None:
+            raise ValueError("no signer for signed write")
+        data = struct.pack('<BH', ATT_OPCODE.ATT_SIGNED_WRITE_CMD, handle) + value
+        signature = self.signer(connection_handle, data)
+        if len(signature) != ATT_SIGNATURE_LEN:
+            raise ValueError(f"signature must be {ATT_SIGNATURE_LEN} bytes")
+        self.l2cap.send(connection_handle, ATT_CID, data + signature)
+
+    def prepare_write(self, connection_handle, handle, offset: int, value: bytes) -> Future:
+        return self.request(connection_handle, struct.pack('<BHH', ATT_OPCODE.ATT_PREPARE_WRITE_REQ, handle, offset) + value)
+
+    def execute_write(self, connection_handle, flags: int = ATT_EXECUTE_WRITE_COMMIT) -> Future:
+        return self.request(connection_handle, struct.pack('<BB', ATT_OPCODE.ATT_EXECUTE_WRITE_REQ, flags))
+
+    def find_information(self, connection_handle, start_handle, end_handle) -> Future:
+        return self.request(connection_handle, struct.pack('<BHH', ATT_OPCODE.ATT_FIND_INFORMATION_REQ, start_handle, end_handle))
+
+    def read_by_type(self, connection_handle, start_handle, end_handle, attribute_type: bytes) -> Future:
+        """
+        attribute_type: 2 or 16 bytes little endian UUID
+        """
+        return self.request(connection_handle, struct.pack('<BHH', ATT_OPCODE.ATT_READ_BY_TYPE_REQ, start_handle, end_handle) + attribute_type)
+
+    def read_by_group_type(self, connection_handle, start_handle, end_handle, group_type: bytes) -> Future:
+        """
+        group_type: 2 or 16 bytes little endian UUID
+        """
+        return self.request(connection_handle, struct.pack('<BHH', ATT_OPCODE.ATT_READ_BY_GROUP_TYPE_REQ, start_handle, end_handle) + group_type)
+
+    def server_handler(self, connection_handle, opcode, att_data: bytes):
+        handler = self.server_handlers.get(opcode)
+        if handler is None:
+            if not opcode & ATT_COMMAND_FLAG:
+                self.error_rsp(connection_handle, opcode, 0x0000, ATT_ERROR.ATT_REQUEST_NOT_SUPPORTED)
+            return
+        try:
+            rsp = handler(connection_handle, att_data)
+        except AttError as e:
+            if opcode & ATT_COMMAND_FLAG:
+                logger.info(f"att connection_handle:0x{connection_handle:04X} command dropped: {e}")
+            else:
+                self.error_rsp(connection_handle, e.request_opcode, e.handle, e.error_code)
+            return
+        except (struct.error, IndexError):
+            if not opcode & ATT_COMMAND_FLAG:
+                self.error_rsp(connection_handle, opcode, 0x0000, ATT_ERROR.ATT_INVALID_PDU)
+            return
+        if rsp is not None:
+            self.l2cap.send(connection_handle, ATT_CID, rsp)
+
+    def error_rsp(self, connection_handle, request_opcode: int, handle: int, error_code: int):
+        self.l2cap.send(connection_handle, ATT_CID, struct.pack('<BBHB', ATT_OPCODE.ATT_ERROR_RSP, request_opcode, handle, error_code))
+
+    def _read_value(self, connection_handle, opcode: int, attribute) -> bytes:
+        """
+        attribute value after the permission checks, raise AttError
+        """
+        if not attribute.permissions & (PERM_READ | PERM_READ_ENCRYPTED):
+            raise AttError(opcode, attribute.handle, ATT_ERROR.ATT_READ_NOT_PERMITTED)
+        if attribute.permissions & PERM_READ_ENCRYPTED:
+            connection = self.connections.get(connection_handle) if self.connections is not None else None
+            if connection is None or not connection.encrypted:
+                raise AttError(opcode, attribute.handle, ATT_ERROR.ATT_INSUFFICIENT_ENCRYPTION)
+        return attribute.read(connection_handle)
+
+    def _writable(self, connection_handle, opcode: int, handle: int):
+        """
+        attribute of a write after the permission checks, raise AttError
+        """
+        attribute = self.db.get(handle)
+        if attribute is None:
+            raise AttError(opcode, handle, ATT_ERROR.ATT_INVALID_HANDLE)
+        if not attribute.permissions & (PERM_WRITE | PERM_WRITE_ENCRYPTED):
+            raise AttError(opcode, handle, ATT_ERROR.ATT_WRITE_NOT_PERMITTED)
+        if attribute.permissions & PERM_WRITE_ENCRYPTED:
+            connection = self.connections.get(connection_handle) if self.connections is not None else None
+            if connection is None or not connection.encrypted:
+                raise AttError(opcode, handle, ATT_ERROR.ATT_INSUFFICIENT_ENCRYPTION)
+        return attribute
+
+    def _write_value(self, connection_handle, opcode: int, handle: int, value: bytes):
+        attribute = self._writable(connection_handle, opcode, handle)
+        if len(value) > ATT_MAX_VALUE_LEN:
+            raise AttError(opcode, handle, ATT_ERROR.ATT_INVALID_ATTRIBUTE_VALUE_LENGTH)
+        self._store_value(connection_handle, opcode, attribute, value)
+
+    @staticmethod
+    def _store_value(connection_handle, opcode: int, attribute, value: bytes):
+        if attribute.write_cb is None:
+            attribute.value = bytes(value)
+            return
+        try:
+            attribute.write_cb(connection_handle, bytes(value))
+        except ValueError:
+            raise AttError(opcode, attribute.handle, ATT_ERROR.ATT_INVALID_ATTRIBUTE_VALUE_LENGTH)
+
+    @staticmethod
+    def _handle_range(opcode: int, att_data: bytes):
+        start_handle, end_handle = struct.unpack_from('<HH', att_data, 1)
+        if start_handle == 0 or start_handle > end_handle:
+            raise AttError(opcode, start_handle, ATT_ERROR.ATT_INVALID_HANDLE)
+        return start_handle, end_handle
+
+    def exchange_mtu_req(self, connection_handle, att_data: bytes) -> bytes:
+        client_mtu = struct.unpack_from('<H', att_data, 1)[0]
+        # the response still goes out with the previous ATT_MTU, it is 3 bytes
+        self._set_mtu(connection_handle, client_mtu, self.local_mtu)
+        return struct.pack('<BH', ATT_OPCODE.ATT_EXCHANGE_MTU_RSP, self.local_mtu)
+
+    def find_information_req(self, connection_handle, att_data: bytes) -> bytes:
+        opcode = ATT_OPCODE.ATT_FIND_INFORMATION_REQ
+        start_handle, end_handle = self._handle_range(opcode, att_data)
+        attributes = self.db.range(start_handle, end_handle)
+        if not attributes:
+            raise AttError(opcode, start_handle, ATT_ERROR.ATT_ATTRIBUTE_NOT_FOUND)
+        uuid_len = len(attributes[0].type)
+        # format 0x01 16-bit UUIDs, 0x02 128-bit UUIDs
+        rsp = bytearray(struct.pack('<BB', ATT_OPCODE.ATT_FIND_INFORMATION_RSP, 0x01 if uuid_len == 2 else 0x02))
+        count = (self.mtu(connection_handle) - 2) // (2 + uuid_len)
+        for attribute in attributes[:count]:
+            if len(attribute.type) != uuid_len:
+                break
+            rsp += struct.pack('<H', attribute.handle) + attribute.type
+        return bytes(rsp)
+
+    def find_by_type_value_req(self, connection_handle, att_data: bytes) -> bytes:
+        opcode = ATT_OPCODE.ATT_FIND_BY_TYPE_VALUE_REQ
+        start_handle, end_handle = self._handle_range(opcode, att_data)
+        attribute_type = att_data[5:7]
+        value = att_data[7:]
+        if len(attribute_type) != 2:
+            raise AttError(opcode, 0x0000, ATT_ERROR.ATT_INVALID_PDU)
+        grouping = attribute_type in (uuid16(GATT_PRIMARY_SERVICE), uuid16(GATT_SECONDARY_SERVICE))
+        rsp = bytearray([ATT_OPCODE.ATT_FIND_BY_TYPE_VALUE_RSP])
+        count = (self.mtu(connection_handle) - 1) // 4
+        for attribute in self.db.range_by_type(attribute_type, start_handle, end_handle):
+            if attribute.read(connection_handle) != value:
+                continue
+            end_group = self.db.group_end(attribute) if grouping else attribute.handle
+            rsp += struct.pack('<HH', attribute.handle, end_group)
+            count -= 1
+            if count == 0:
+                break
+        if len(rsp) == 1:
+            raise AttError(opcode, start_handle, ATT_ERROR.ATT_ATTRIBUTE_NOT_FOUND)
+        return bytes(rsp)
+
+    def read_by_type_req(self, connection_handle, att_data: bytes) -> bytes:
+        opcode = ATT_OPCODE.ATT_READ_BY_TYPE_REQ
+        start_handle, end_handle = self._handle_range(opcode, att_data)
+        attribute_type = att_data[5:]
+        if len(attribute_type) not in (2, 16):
+            raise AttError(opcode, 0x0000, ATT_ERROR.ATT_INVALID_PDU)
+        attributes = self.db.range_by_type(attribute_type, start_handle, end_handle)
+        return self._pack_read_by_type(connection_handle, opcode, start_handle, attributes, False)
+
+    def read_by_group_type_req(self, connection_handle, att_data: bytes) -> bytes:
+        opcode = ATT_OPCODE.ATT_READ_BY_GROUP_TYPE_REQ
+        start_handle, end_handle = self._handle_range(opcode, att_data)
+        group_type = att_data[5:]
+        if len(group_type) not in (2, 16):
+            raise AttError(opcode, 0x0000, ATT_ERROR.ATT_INVALID_PDU)
+        tracer.log("att read by group type req start_handle:0x%04X end_handle:0x%04X group_type:%s", start_handle, end_handle, group_type[::-1].hex())
+        if uuid_to_short(group_type) not in (uuid16(GATT_PRIMARY_SERVICE), uuid16(GATT_SECONDARY_SERVICE)):
+            raise AttError(opcode, start_handle, ATT_ERROR.ATT_UNSUPPORTED_GROUP_TYPE)
+        attributes = self.db.range_by_type(group_type, start_handle, end_handle)
+        return self._pack_read_by_type(connection_handle, opcode, start_handle, attributes, True)
+
+    def _pack_read_by_type(self, connection_handle, opcode: int, start_handle: int, attributes: list, group: bool) -> bytes:
+        """
+        Read By Type / Read By Group Type response, entries of the same length
+        up to the ATT_MTU
+        """
+        if not attributes:
+            raise AttError(opcode, start_handle, ATT_ERROR.ATT_ATTRIBUTE_NOT_FOUND)
+        mtu = self.mtu(connection_handle)
+        header_len = 4 if group else 2
+        max_value_len = min(mtu - 2 - header_len, 255 - header_len)
+        rsp = bytearray(2)
+        length = 0
+        for attribute in attributes:
+            try:
+                value = self._read_value(connection_handle, opcode, attribute)
+            except AttError:
+                if length == 0:
+                    raise
+                break
+            value = value[:max_value_len]
+            if length == 0:
+                length = header_len + len(value)
+            elif header_len + len(value) != length or len(rsp) + length > mtu:
+                break
+            if group:
+                rsp += struct.pack('<HH', attribute.handle, self.db.group_end(attribute))
+            else:
+                rsp += struct.pack('<H', attribute.handle)
+            rsp += value
+        rsp[0] = ATT_OPCODE.ATT_READ_BY_GROUP_TYPE_RSP if group else ATT_OPCODE.ATT_READ_BY_TYPE_RSP
+        rsp[1] = length
+        return bytes(rsp)
+
+    def read_req(self, connection_handle, att_data: bytes) -> bytes:
+        opcode = ATT_OPCODE.ATT_READ_REQ
+        handle = struct.unpack_from('<H', att_data, 1)[0]
+        attribute = self.db.get(handle)
+        if attribute is None:
+            raise AttError(opcode, handle, ATT_ERROR.ATT_INVALID_HANDLE)
+        value = self._read_value(connection_handle, opcode, attribute)
+        return bytes([ATT_OPCODE.ATT_READ_RSP]) + value[: self.mtu(connection_handle) - 1]
+
+    def _read_handle(self, connection_handle, opcode: int, handle: int) -> bytes:
+        attribute = self.db.get(handle)
+        if attribute is None:
+            raise AttError(opcode, handle, ATT_ERROR.ATT_INVALID_HANDLE)
+        return self._read_value(connection_handle, opcode, attribute)
+
+    def read_blob_req(self, connection_handle, att_data: bytes) -> bytes:
+        opcode = ATT_OPCODE.ATT_READ_BLOB_REQ
+        handle, offset = struct.unpack_from('<HH', att_data, 1)
+        value = self._read_handle(connection_handle, opcode, handle)
+        if offset > len(value):
+            raise AttError(opcode, handle, ATT_ERROR.ATT_INVALID_OFFSET)
+        return bytes([ATT_OPCODE.ATT_READ_BLOB_RSP]) + value[offset : offset + self.mtu(connection_handle) - 1]
+
+    def _read_handles(self, connection_handle, opcode: int, att_data: bytes) -> list:
+        """
+        values of the handles of a Read Multiple (Variable) request, the first failing handle raises
+        """
+        count = (len(att_data) - 1) // 2
+        if count < 2 or len(att_data) != 1 + 2 * count:
+            raise AttError(opcode, 0x0000, ATT_ERROR.ATT_INVALID_PDU)
+        return [self._read_handle(connection_handle, opcode, handle) for handle in struct.unpack_from(f'<{count}H', att_data, 1)]
+
+    def read_multiple_req(self, connection_handle, att_data: bytes) -> bytes:
+        values = self._read_handles(connection_handle, ATT_OPCODE.ATT_READ_MULTIPLE_REQ, att_data)
+        rsp = bytes([ATT_OPCODE.ATT_READ_MULTIPLE_RSP]) + b"".join(values)
+        return rsp[: self.mtu(connection_handle)]
+
+    def read_multiple_variable_req(self, connection_handle, att_data: bytes) -> bytes:
+        values = self._read_handles(connection_handle, ATT_OPCODE.ATT_READ_MULTIPLE_VARIABLE_REQ, att_data)
+        rsp = bytearray([ATT_OPCODE.ATT_READ_MULTIPLE_VARIABLE_RSP])
+        for value in values:
+            rsp += struct.pack('<H', len(value)) + value
+        return bytes(rsp[: self.mtu(connection_handle)])
+
+    def handle_value_ntf(self, connection_handle, att_data: bytes):
+        handle = struct.unpack_from('<H', att_data, 1)[0]
+        value = att_data[3:]
+        for cb in self.notification_callbacks:
+            try:
+                cb(connection_handle, handle, value)
+            except Exception as e:
+                logger.exception(f"att notification callback error: {e}")
+
+    def handle_value_ind(self, connection_handle, att_data: bytes) -> bytes:
+        self.handle_value_ntf(connection_handle, att_data)
+        return bytes([ATT_OPCODE.ATT_HANDLE_VALUE_CFM])
+
+    def handle_value_cfm(self, connection_handle, att_data: bytes):
+        # a confirmation is never answered, not even with an error
+        if not self.confirmation_callbacks:
+            logger.warning(f"att connection_handle:0x{connection_handle:04X} unexpected handle value confirmation, dropped")
+            return
+        for cb in self.confirmation_callbacks:
+            try:
+                cb(connection_handle)
+            except Exception as e:
+                logger.exception(f"att confirmation callback error: {e}")
+
+    def write_req(self, connection_handle, att_data: bytes) -> bytes:
+        handle = struct.unpack_from('<H', att_data, 1)[0]
+        self._write_value(connection_handle, ATT_OPCODE.ATT_WRITE_REQ, handle, att_data[3:])
+        return bytes([ATT_OPCODE.ATT_WRITE_RSP])
+
+    def write_cmd_handler(self, connection_handle, att_data: bytes):
+        handle = struct.unpack_from('<H', att_data, 1)[0]
+        self._write_value(connection_handle, ATT_OPCODE.ATT_WRITE_CMD, handle, att_data[3:])
+
+    def signed_write_cmd_handler(self, connection_handle, att_data: bytes):
+        handle = struct.unpack_from('<H', att_data, 1)[0]
+        if len(att_data) < 3 + ATT_SIGNATURE_LEN:
+            return
+        data, signature = att_data[:-ATT_SIGNATURE_LEN], att_data[-ATT_SIGNATURE_LEN:]
+        if self.verifier is None or not self.verifier(connection_handle, data, signature):
+            logger.warning(f"att connection_handle:0x{connection_handle:04X} signed write handle:0x{handle:04X} not verified, dropped")
+            return
+        self._write_value(connection_handle, ATT_OPCODE.ATT_SIGNED_WRITE_CMD, handle, data[3:])
 
-    def read_by_group_type_req(self, connection_handle, cid, param):
-        start_handle, end_handle, group_type = struct.unpack('<HHH', param)
-        logger.info(f"att read by group type req start_handle:0x{start_handle:04X} end_handle:0x{end_handle:04X} group_type:0x{group_type:04X}")
-        self.read_by_group_type_rsp(connection_handle, cid, start_handle, end_handle, group_type)
+    def prepare_write_req(self, connection_handle, att_data: bytes) -> bytes:
+        opcode = ATT_OPCODE.ATT_PREPARE_WRITE_REQ
+        handle, offset = struct.unpack_from('<HH', att_data, 1)
+        self._writable(connection_handle, opcode, handle)
+        queue = self.prepare_queues.setdefault(connection_handle, [])
+        if len(queue) >= ATT_PREPARE_QUEUE_MAX:
+            raise AttError(opcode, handle, ATT_ERROR.ATT_PREPARE_QUEUE_FULL)
+        queue.append((handle, offset, bytes(att_data[5:])))
+        # the response echoes the request so the client can check the queued part
+        return bytes([ATT_OPCODE.ATT_PREPARE_WRITE_RSP]) + att_data[1:]
 
-    def read_by_group_type_rsp(self, connection_handle, cid, start_handle, end_handle, group_type):
-        att = bytes([0x01, 0x00, 0x03, 0x00, 0x00, 0x18, 0x04, 0x00, 0x07, 0x00, 0x0F, 0x18, 0x08, 0x00, 0x0A, 0x00, 0x01, 0x18])
-        header = struct.pack('<BB', ATT_OPCODE.ATT_READ_BY_GROUP_TYPE_RSP, len(att)//3)
-        self.l2cap.send(connection_handle, cid, header + att)
\ No newline at end of file
+    def execute_write_req(self, connection_handle, att_data: bytes) -> bytes:
+        """
+        Every queued value is checked (offsets, lengths, permissions) before
+        any is written, then values with a write_cb are written first, so a
+        rejection leaves the values stored in the database untouched. Values
+        accepted by an earlier write_cb can not be taken back: a commit is
+        only atomic when at most one of its attributes has a write_cb.
+        """
+        opcode = ATT_OPCODE.ATT_EXECUTE_WRITE_REQ
+        flags = att_data[1]
+        queue = self.prepare_queues.pop(connection_handle, [])
+        if flags == ATT_EXECUTE_WRITE_COMMIT:
+            # handle -> value assembled from its parts, in the order they were prepared
+            values = {}
+            for handle, offset, part in queue:
+                value = values.get(handle, b"")
+                if offset > len(value):
+                    raise AttError(opcode, handle, ATT_ERROR.ATT_INVALID_OFFSET)
+                values[handle] = value[:offset] + part + value[offset + len(part) :]
+            writes = []
+            for handle, value in values.items():
+                attribute = self._writable(connection_handle, opcode, handle)
+                if len(value) > ATT_MAX_VALUE_LEN:
+                    raise AttError(opcode, handle, ATT_ERROR.ATT_INVALID_ATTRIBUTE_VALUE_LENGTH)
+                writes.append((attribute, value))
+            # callbacks may still reject their value, stored values can not fail
+            writes.sort(key=lambda write: write[0].write_cb is None)
+            for attribute, value in writes:
+                self._store_value(connection_handle, opcode, attribute, value)
+        elif flags != ATT_EXECUTE_WRITE_CANCEL:
+            raise AttError(opcode, 0x0000, ATT_ERROR.ATT_INVALID_PDU)
+        return bytes([ATT_OPCODE.ATT_EXECUTE_WRITE_RSP])
@@ -0,0 +1,255 @@
+import bisect
+import struct
+import threading
+
+# Bluetooth Base UUID 00000000-0000-1000-8000-00805F9B34FB, little endian without the first 4 bytes
+BASE_UUID = bytes.fromhex("FB349B5F8000008000100000")
+
+GATT_PRIMARY_SERVICE = 0x2800
+GATT_SECONDARY_SERVICE = 0x2801
+GATT_INCLUDE = 0x2802
+GATT_CHARACTERISTIC = 0x2803
+GATT_CLIENT_CHARACTERISTIC_CONFIGURATION = 0x2902
+
+GATT_GAP_SERVICE = 0x1800
+GATT_GATT_SERVICE = 0x1801
+GATT_BATTERY_SERVICE = 0x180F
+GATT_DEVICE_NAME = 0x2A00
+GATT_APPEARANCE = 0x2A01
+GATT_SERVICE_CHANGED = 0x2A05
+GATT_BATTERY_LEVEL = 0x2A19
+GATT_DATABASE_HASH = 0x2B2A
+
+# characteristic properties
+PROP_BROADCAST = 0x01
+PROP_READ = 0x02
+PROP_WRITE_WITHOUT_RESPONSE = 0x04
+PROP_WRITE = 0x08
+PROP_NOTIFY = 0x10
+PROP_INDICATE = 0x20
+PROP_AUTHENTICATED_SIGNED_WRITES = 0x40
+PROP_EXTENDED_PROPERTIES = 0x80
+
+# client characteristic configuration bits
+CCCD_NOTIFICATION = 0x0001
+CCCD_INDICATION = 0x0002
+
+# attribute permissions
+PERM_READ = 0x01
+PERM_WRITE = 0x02
+PERM_READ_ENCRYPTED = 0x04
+PERM_WRITE_ENCRYPTED = 0x08
+
+
+def uuid16(uuid: int) -> bytes:
+    return struct.pack("<H", uuid)
+
+
+def uuid_to_128(uuid: bytes) -> bytes:
+    """
+    2, 4 or 16 bytes little endian UUID to the 16 bytes form
+    """
+    if len(uuid) == 16:
+        return bytes(uuid)
+    return BASE_UUID + bytes(uuid).ljust(4, b"\0")
+
+
+def uuid_to_short(uuid: bytes) -> bytes:
+    """
+    16 bytes UUID to the 2 bytes form if it is a 16-bit Bluetooth UUID
+    """
+    if len(uuid) == 16 and uuid[:12] == BASE_UUID and uuid[14:] == b"\0\0":
+        return bytes(uuid[12:14])
+    return bytes(uuid)
+
+
+class Attribute:
+    """
+    ATT attribute
+
+    value is the stored value, read_cb(connection_handle) -> bytes overrides
+    it for dynamic values, write_cb(connection_handle, value) receives the
+    written values instead of value, and raises ValueError to reject them.
+    """
+
+    __slots__ = ("handle", "type", "value", "permissions", "read_cb", "write_cb")
+
+    def __init__(self, handle: int, attribute_type: bytes, value: bytes = b"", permissions: int = PERM_READ, read_cb: callable = None, write_cb: callable = None):
+        self.handle = handle
+        # little endian UUID, 2 or 16 bytes
+        self.type = bytes(attribute_type)
+        self.value = bytes(value)
+        self.permissions = permissions
+        self.read_cb = read_cb
+        self.write_cb = write_cb
+
+    def read(self, connection_handle: int) -> bytes:
+        if self.read_cb is not None:
+            return self.read_cb(connection_handle)
+        return self.value
+
+    def __str__(self):
+        return f"attribute handle:0x{self.handle:04X} type:{self.type[::-1].hex()} value:{self.value.hex()}"
+
+
+class AttributeDatabase:
+    """
+    ATT attribute database
+
+    Attributes are kept sorted by handle, with a secondary index from the
+    16 bytes type UUID to the sorted handles of that type. Handle range and
+    type range queries are bisections on these lists, not scans of the
+    whole database.
+
+    Client Characteristic Configuration descriptors added by
+    add_characteristic keep one value per connection.
+    """
+
+    GROUP_TYPES = (uuid_to_128(uuid16(GATT_PRIMARY_SERVICE)), uuid_to_128(uuid16(GATT_SECONDARY_SERVICE)))
+
+    def __init__(self):
+        self.handles = []
+        self.attributes = []
+        # 16 bytes type UUID -> (sorted handles, attributes)
+        self.types = {}
+        # connection handle -> {characteristic value handle: CCCD bits}
+        self.client_configurations = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.attributes)
+
+    def __iter__(self):
+        return iter(list(self.attributes))
+
+    @property
+    def next_handle(self) -> int:
+        return self.handles[-1] + 1 if self.handles else 1
+
+    def add(self, attribute_type: bytes, value: bytes = b"", permissions: int = PERM_READ, handle: int = None, read_cb: callable = None, write_cb: callable = None) -> Attribute:
+        """
+        add an attribute, at the next free handle by default
+        """
+        with self.lock:
+            if handle is None:
+                handle = self.next_handle
+            if not 0x0001 <= handle <= 0xFFFF:
+                raise ValueError(f"invalid handle 0x{handle:04X}")
+            index = bisect.bisect_left(self.handles, handle)
+            if index < len(self.handles) and self.handles[index] == handle:
+                raise ValueError(f"handle 0x{handle:04X} already used")
+            attribute = Attribute(handle, attribute_type, value, permissions, read_cb, write_cb)
+            self.handles.insert(index, handle)
+            self.attributes.insert(index, attribute)
+            handles, attributes = self.types.setdefault(uuid_to_128(attribute.type), ([], []))
+            index = bisect.bisect_left(handles, handle)
+            handles.insert(index, handle)
+            attributes.insert(index, attribute)
+            return attribute
+
+    def get(self, handle: int) -> Attribute:
+        index = bisect.bisect_left(self.handles, handle)
+        if index < len(self.handles) and self.handles[index] == handle:
+            return self.attributes[index]
+        return None
+
+    def range(self, start_handle: int, end_handle: int) -> list:
+        """
+        attributes with start_handle <= handle <= end_handle
+        """
+        lo = bisect.bisect_left(self.handles, start_handle)
+        hi = bisect.bisect_right(self.handles, end_handle)
+        return self.attributes[lo:hi]
+
+    def range_by_type(self, attribute_type: bytes, start_handle: int, end_handle: int) -> list:
+        """
+        attributes of a type with start_handle <= handle <= end_handle
+        """
+        entry = self.types.get(uuid_to_128(attribute_type))
+        if entry is None:
+            return []
+        handles, attributes = entry
+        lo = bisect.bisect_left(handles, start_handle)
+        hi = bisect.bisect_right(handles, end_handle)
+        return attributes[lo:hi]
+
+    def group_end(self, attribute: Attribute) -> int:
+        """
+        end group handle of a service declaration: the handle before the next
+        service declaration, the last handle of the database for the last one
+        """
+        end = self.handles[-1]
+        for group_type in self.GROUP_TYPES:
+            entry = self.types.get(group_type)
+            if entry is None:
+                continue
+            handles = entry[0]
+            index = bisect.bisect_right(handles, attribute.handle)
+            if index < len(handles):
+                end = min(end, handles[index] - 1)
+        return end
+
+    def add_service(self, uuid: bytes, primary: bool = True) -> Attribute:
+        service_type = GATT_PRIMARY_SERVICE if primary else GATT_SECONDARY_SERVICE
+        return self.add(uuid16(service_type), uuid_to_short(uuid))
+
+    def add_characteristic(self, uuid: bytes, properties: int, value: bytes = b"", permissions: int = PERM_READ, read_cb: callable = None, write_cb: callable = None) -> Attribute:
+        """
+        add a characteristic declaration and its value, return the value attribute
+
+        a Client Characteristic Configuration descriptor is added for notify/indicate
+        """
+        with self.lock:
+            declaration = self.add(uuid16(GATT_CHARACTERISTIC))
+            attribute = self.add(uuid_to_short(uuid), value, permissions, read_cb=read_cb, write_cb=write_cb)
+            declaration.value = struct.pack("<BH", properties, attribute.handle) + uuid_to_short(uuid)
+            if properties & (PROP_NOTIFY | PROP_INDICATE):
+                value_handle = attribute.handle
+                self.add_descriptor(
+                    uuid16(GATT_CLIENT_CHARACTERISTIC_CONFIGURATION),
+                    b"\0\0",
+                    PERM_READ | PERM_WRITE,
+                    read_cb=lambda connection_handle: struct.pack("<H", self.client_configuration(connection_handle, value_handle)),
+                    write_cb=lambda connection_handle, value: self._write_client_configuration(connection_handle, value_handle, value),
+                )
+            return attribute
+
+    def client_configuration(self, connection_handle: int, value_handle: int) -> int:
+        """
+        CCCD bits of a characteristic for a connection, 0 if never written
+        """
+        return self.client_configurations.get(connection_handle, {}).get(value_handle, 0)
+
+    def set_client_configuration(self, connection_handle: int, value_handle: int, flags: int):
+        with self.lock:
+            self.client_configurations.setdefault(connection_handle, {})[value_handle] = flags
+
+    def _write_client_configuration(self, connection_handle: int, value_handle: int, value: bytes):
+        if len(value) != 2:
+            raise ValueError("client characteristic configuration is 2 bytes")
+        self.set_client_configuration(connection_handle, value_handle, struct.unpack("<H", value)[0])
+
+    def clear_client_configurations(self, connection_handle: int):
+        """
+        forget the CCCD values of a connection, they do not persist for unbonded peers
+        """
+        with self.lock:
+            self.client_configurations.pop(connection_handle, None)
+
+    def add_descriptor(self, uuid: bytes, value: bytes = b"", permissions: int = PERM_READ, read_cb: callable = None, write_cb: callable = None) -> Attribute:
+        return self.add(uuid_to_short(uuid), value, permissions, read_cb=read_cb, write_cb=write_cb)
+
+
+def default_database(device_name: str = "btool", appearance: int = 0x0000, battery_level: int = 100) -> AttributeDatabase:
+    """
+    GAP, Battery and GATT services
+    """
+    db = AttributeDatabase()
+    db.add_service(uuid16(GATT_GAP_SERVICE))
+    db.add_characteristic(uuid16(GATT_DEVICE_NAME), PROP_READ, device_name.encode("utf-8"))
+    db.add_characteristic(uuid16(GATT_APPEARANCE), PROP_READ, struct.pack("<H", appearance))
+    db.add_service(uuid16(GATT_BATTERY_SERVICE))
+    db.add_characteristic(uuid16(GATT_BATTERY_LEVEL), PROP_READ | PROP_NOTIFY, bytes([battery_level]))
+    db.add_service(uuid16(GATT_GATT_SERVICE))
+    db.add_characteristic(uuid16(GATT_SERVICE_CHANGED), PROP_INDICATE, b"", 0)
+    return db
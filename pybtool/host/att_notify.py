@@ -0,0 +1,193 @@
+import logging
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+from .att import ATT_CID, ATT_OPCODE
+from .att_db import CCCD_INDICATION, CCCD_NOTIFICATION
+from .connection import ConnectionEvent
+from .hci_evt import HciEventNumberOfCompletedPackets
+logger = logging.getLogger(__name__)
+
+# ACL packets a connection may have queued in the host before its notifications wait
+NOTIFY_MAX_PENDING = 4
+# ATT transaction timeout, an indication not confirmed in time closes the bearer
+INDICATION_TIMEOUT = 30
+
+
+class Notifier:
+    """
+    server notifications and indications
+
+    Every connection has a queue of notifications and a queue of indications,
+    both keyed by characteristic value handle: a value queued for a
+    characteristic whose previous value is still waiting replaces it, so a
+    link slower than the update rate gets the latest value instead of a
+    growing backlog.
+
+    Notifications leave the queue while the connection has fewer than
+    max_pending ACL packets waiting for controller credits in the
+    HciAclScheduler, the queues are drained again when Number Of Completed
+    Packets returns credits. Indications are sent one at a time per
+    connection, the next one after the Handle Value Confirmation.
+
+    An indication not confirmed within indication_timeout fails with
+    TimeoutError together with the indications queued behind it, and
+    nothing more is sent on that connection until it is closed, as ATT
+    requires after a transaction timeout.
+
+    Values are only sent to connections whose Client Characteristic
+    Configuration enables them.
+    """
+
+    def __init__(self, att, max_pending: int = NOTIFY_MAX_PENDING, indication_timeout: float = INDICATION_TIMEOUT):
+        self.att = att
+        self.db = att.db
+        self.hci = att.l2cap.hci
+        self.max_pending = max_pending
+        self.indication_timeout = indication_timeout
+        # connection handle -> OrderedDict value handle -> value
+        self.notifications = {}
+        # connection handle -> OrderedDict value handle -> (value, futures)
+        self.indications = {}
+        # connection handle -> (futures, timer) of the indication waiting for its confirmation
+        self.outstanding = {}
+        # connection handles whose ATT transaction timed out
+        self.timed_out = set()
+        # values replaced by a newer one before being sent
+        self.coalesced = 0
+        self.lock = threading.RLock()
+        self.att.register_confirmation(self.handle_value_cfm)
+        self.hci.register_event(HciEventNumberOfCompletedPackets.EVENT_CODE, self._on_completed_packets)
+        if self.att.connections is not None:
+            self.att.connections.register_event(ConnectionEvent.DISCONNECTED, self._on_disconnected)
+
+    def notify(self, connection_handle, value_handle, value: bytes) -> bool:
+        """
+        queue a notification, False if the client did not enable notifications
+        """
+        if not self.db.client_configuration(connection_handle, value_handle) & CCCD_NOTIFICATION:
+            return False
+        if connection_handle in self.timed_out:
+            return False
+        with self.lock:
+            queue = self.notifications.setdefault(connection_handle, OrderedDict())
+            if value_handle in queue:
+                self.coalesced += 1
+            queue[value_handle] = bytes(value)
+            self._drain(connection_handle)
+        return True
+
+    def indicate(self, connection_handle, value_handle, value: bytes) -> Future:
+        """
+        queue an indication, the future resolves when the client confirms it
+        or a newer value of the same characteristic, None if the client did
+        not enable indications or the connection timed out
+        """
+        if not self.db.client_configuration(connection_handle, value_handle) & CCCD_INDICATION:
+            return None
+        if connection_handle in self.timed_out:
+            return None
+        future = Future()
+        with self.lock:
+            queue = self.indications.setdefault(connection_handle, OrderedDict())
+            _, futures = queue.get(value_handle, (None, []))
+            if futures:
+                self.coalesced += 1
+            futures.append(future)
+            queue[value_handle] = (bytes(value), futures)
+            self._send_indication(connection_handle)
+        return future
+
+    def notify_all(self, value_handle, value: bytes) -> int:
+        """
+        notify every connection that enabled notifications, return the number of connections
+        """
+        connections = self.att.connections if self.att.connections is not None else ()
+        return sum(self.notify(connection.handle, value_handle, value) for connection in connections)
+
+    def backlog(self, connection_handle) -> int:
+        """
+        number of values queued for a connection
+        """
+        return len(self.notifications.get(connection_handle, ())) + len(self.indications.get(connection_handle, ()))
+
+    def _pdu(self, connection_handle, opcode: int, value_handle, value: bytes) -> bytes:
+        # the value is truncated to ATT_MTU - 3
+        return struct.pack('<BH', opcode, value_handle) + value[: self.att.mtu(connection_handle) - 3]
+
+    def _drain(self, connection_handle):
+        queue = self.notifications.get(connection_handle)
+        scheduler = self.hci.acl_scheduler
+        while queue and scheduler.pending(connection_handle) < self.max_pending:
+            value_handle, value = queue.popitem(last=False)
+            self.att.l2cap.send(connection_handle, ATT_CID, self._pdu(connection_handle, ATT_OPCODE.ATT_HANDLE_VALUE_NTF, value_handle, value))
+        if not queue:
+            self.notifications.pop(connection_handle, None)
+
+    def _send_indication(self, connection_handle):
+        if connection_handle in self.outstanding:
+            return
+        queue = self.indications.get(connection_handle)
+        if not queue:
+            self.indications.pop(connection_handle, None)
+            return
+        value_handle, (value, futures) = queue.popitem(last=False)
+        timer = threading.Timer(self.indication_timeout, self._on_indication_timeout, [connection_handle, futures])
+        timer.daemon = True
+        self.outstanding[connection_handle] = (futures, timer)
+        timer.start()
+        self.att.l2cap.send(connection_handle, ATT_CID, self._pdu(connection_handle, ATT_OPCODE.ATT_HANDLE_VALUE_IND, value_handle, value))
+
+    def handle_value_cfm(self, connection_handle):
+        with self.lock:
+            outstanding = self.outstanding.pop(connection_handle, None)
+            if outstanding is None:
+                logger.warning(f"att connection_handle:0x{connection_handle:04X} unexpected handle value confirmation")
+                return
+            futures, timer = outstanding
+            timer.cancel()
+            self._send_indication(connection_handle)
+        for future in futures:
+            if future.set_running_or_notify_cancel():
+                future.set_result(None)
+
+    def _on_indication_timeout(self, connection_handle, futures: list):
+        with self.lock:
+            outstanding = self.outstanding.get(connection_handle)
+            if outstanding is None or outstanding[0] is not futures:
+                # confirmed meanwhile
+                return
+            del self.outstanding[connection_handle]
+            self.timed_out.add(connection_handle)
+            self.notifications.pop(connection_handle, None)
+            failed = list(futures)
+            for _, queued in self.indications.pop(connection_handle, {}).values():
+                failed += queued
+        logger.warning(f"att connection_handle:0x{connection_handle:04X} indication not confirmed, bearer closed")
+        self._fail(failed, TimeoutError(f"connection 0x{connection_handle:04X} indication not confirmed"))
+
+    @staticmethod
+    def _fail(futures: list, exception: Exception):
+        for future in futures:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exception)
+
+    def _on_completed_packets(self, evt):
+        with self.lock:
+            for connection_handle in list(self.notifications):
+                self._drain(connection_handle)
+
+    def _on_disconnected(self, connection):
+        with self.lock:
+            self.notifications.pop(connection.handle, None)
+            self.timed_out.discard(connection.handle)
+            futures = []
+            outstanding = self.outstanding.pop(connection.handle, None)
+            if outstanding is not None:
+                futures += outstanding[0]
+                outstanding[1].cancel()
+            for _, queued in self.indications.pop(connection.handle, {}).values():
+                futures += queued
+        self.db.clear_client_configurations(connection.handle)
+        self._fail(futures, ConnectionError(f"connection 0x{connection.handle:04X} disconnected"))
@@ -0,0 +1,196 @@
+import logging
+import threading
+from enum import IntEnum
+from .hci_def import RoleType, address_to_str
+from .hci_evt import (
+    HciEventDisconnectionComplete,
+    HciEventLeConnectionComplete,
+    HciEventLeConnectionUpdateComplete,
+)
+from .hci_evt_decoder import (
+    ENCRYPTION_CHANGE,
+    ENCRYPTION_KEY_REFRESH_COMPLETE,
+    LE_ENHANCED_CONNECTION_COMPLETE,
+)
+
+logger = logging.getLogger(__name__)
+
+ATT_DEFAULT_MTU = 23
+
+
+class ConnectionEvent(IntEnum):
+    CONNECTED = 0
+    UPDATED = 1
+    ENCRYPTION_CHANGED = 2
+    DISCONNECTED = 3
+
+
+class Connection:
+    """
+    state of one LE connection
+    """
+
+    __slots__ = (
+        "handle",
+        "role",
+        "peer_address_type",
+        "peer_address",
+        "interval",
+        "latency",
+        "supervision_timeout",
+        "mtu",
+        "encrypted",
+        "security_level",
+    )
+
+    def __init__(self, handle: int, role: int, peer_address_type: int, peer_address: bytes, interval: int, latency: int, supervision_timeout: int):
+        self.handle = handle
+        self.role = role
+        self.peer_address_type = peer_address_type
+        # little endian as received in the event
+        self.peer_address = peer_address
+        # interval in 1.25 ms units, supervision timeout in 10 ms units
+        self.interval = interval
+        self.latency = latency
+        self.supervision_timeout = supervision_timeout
+        self.mtu = ATT_DEFAULT_MTU
+        self.encrypted = False
+        # LE security mode 1 level, 1 is no security, 2 encrypted. The
+        # Encryption Change event does not tell if the key is authenticated,
+        # levels 3 and 4 are set by the pairing that produced the key
+        self.security_level = 1
+
+    @property
+    def is_central(self) -> bool:
+        return self.role == RoleType.Central
+
+    def __str__(self):
+        return f"connection 0x{self.handle:04X} {RoleType(self.role).name} peer: {address_to_str(self.peer_address)}, interval: {self.interval*1.25} ms, latency: {self.latency}, supervision_timeout: {self.supervision_timeout*10} ms, mtu: {self.mtu}, encrypted: {self.encrypted}"
+
+
+class ConnectionManager:
+    """
+    LE connection table
+
+    Connections are indexed by handle and by (peer address type, peer
+    address), both dicts, so a
+    lookup per ACL packet is constant time whatever the number of links. The
+    table follows the LE (Enhanced) Connection Complete, LE Connection Update
+    Complete, Encryption Change and Disconnection Complete events, and
+    subscribers registered with register_event are called with the
+    Connection after the table is updated.
+    """
+
+    def __init__(self, hci):
+        self.hci = hci
+        # connection handle -> Connection
+        self.connections = {}
+        # (peer address type, peer address) -> Connection
+        self.peers = {}
+        self.lock = threading.Lock()
+        # ConnectionEvent -> list of callbacks
+        self.callbacks = {}
+        hci.register_le_event(HciEventLeConnectionComplete.SUBEVENT_CODE, self._on_connection_complete)
+        hci.register_le_event(LE_ENHANCED_CONNECTION_COMPLETE, self._on_connection_complete)
+        hci.register_le_event(HciEventLeConnectionUpdateComplete.SUBEVENT_CODE, self._on_connection_update_complete)
+        hci.register_event(ENCRYPTION_CHANGE, self._on_encryption_change)
+        hci.register_event(ENCRYPTION_KEY_REFRESH_COMPLETE, self._on_encryption_change)
+        hci.register_event(HciEventDisconnectionComplete.EVENT_CODE, self._on_disconnection_complete)
+
+    def get(self, connection_handle: int) -> Connection:
+        """
+        connection by handle, None if not connected
+        """
+        return self.connections.get(connection_handle)
+
+    def find(self, peer_address: bytes, peer_address_type: int = 0) -> Connection:
+        """
+        connection by peer address (little endian) and address type, 0 public,
+        1 random, None if not connected
+        """
+        return self.peers.get((peer_address_type, peer_address))
+
+    def __contains__(self, connection_handle: int):
+        return connection_handle in self.connections
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(list(self.connections.values()))
+
+    def register_event(self, event: ConnectionEvent, cb: callable):
+        """
+        注册连接事件回调函数, cb(connection)
+        """
+        callbacks = self.callbacks.setdefault(event, [])
+        if cb not in callbacks:
+            callbacks.append(cb)
+
+    def unregister_event(self, event: ConnectionEvent, cb: callable):
+        """
+        取消注册连接事件回调函数
+        """
+        callbacks = self.callbacks.get(event, [])
+        if cb in callbacks:
+            callbacks.remove(cb)
+
+    def _notify(self, event: ConnectionEvent, connection: Connection):
+        for cb in self.callbacks.get(event, ()):
+            try:
+                cb(connection)
+            except Exception as e:
+                logger.exception(f"connection callback error: {e}")
+
+    def _on_connection_complete(self, evt):
+        if evt.status != 0:
+            logger.warning(f"connection failed, status: 0x{evt.status:02X}")
+            return
+        connection = Connection(
+            evt.connection_handle,
+            evt.role,
+            evt.adv_address_type,
+            evt.peer_bd_addr,
+            evt.connection_interval,
+            evt.max_latency,
+            evt.supervision_timeout,
+        )
+        with self.lock:
+            self.connections[connection.handle] = connection
+            self.peers[(connection.peer_address_type, connection.peer_address)] = connection
+        logger.info(connection)
+        self._notify(ConnectionEvent.CONNECTED, connection)
+
+    def _on_connection_update_complete(self, evt):
+        connection = self.connections.get(evt.connection_handle)
+        if connection is None or evt.status != 0:
+            return
+        connection.interval = evt.connection_interval
+        connection.latency = evt.max_latency
+        connection.supervision_timeout = evt.supervision_timeout
+        self._notify(ConnectionEvent.UPDATED, connection)
+
+    def _on_encryption_change(self, evt):
+        connection = self.connections.get(evt.connection_handle)
+        if connection is None or evt.status != 0:
+            return
+        # key refresh keeps the link encrypted
+        connection.encrypted = bool(getattr(evt, "encryption_enabled", True))
+        if not connection.encrypted:
+            connection.security_level = 1
+        elif connection.security_level < 2:
+            connection.security_level = 2
+        self._notify(ConnectionEvent.ENCRYPTION_CHANGED, connection)
+
+    def _on_disconnection_complete(self, evt):
+        if evt.status != 0:
+            return
+        with self.lock:
+            connection = self.connections.pop(evt.connection_handle, None)
+            if connection is not None:
+                key = (connection.peer_address_type, connection.peer_address)
+                if self.peers.get(key) is connection:
+                    del self.peers[key]
+        if connection is not None:
+            logger.info(f"connection 0x{connection.handle:04X} disconnected, reason: 0x{evt.reason:02X}")
+            self._notify(ConnectionEvent.DISCONNECTED, connection)
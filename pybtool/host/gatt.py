@@ -1,15 +1,575 @@
+import json
+import logging
+import os
+import struct
+import threading
+from collections import deque
+import concurrent.futures
+from itertools import islice
+from .att import ATT_ERROR, ATT_EXECUTE_WRITE_CANCEL, ATT_EXECUTE_WRITE_COMMIT, AttError
+from .att_db import (
+    GATT_CHARACTERISTIC,
+    GATT_DATABASE_HASH,
+    GATT_PRIMARY_SERVICE,
+    uuid16,
+)
+from .connection import ConnectionEvent
+from .hci_evt import HciEventNumberOfCompletedPackets
+logger = logging.getLogger(__name__)
+
+# GATT procedures time out after 30 s
+GATT_TIMEOUT = 30
+# attribute values are at most 512 bytes
+GATT_MAX_VALUE_LEN = 512
+# Read Blob requests queued ahead while the length of a long value is unknown
+GATT_BLOB_WINDOW = 4
+# ACL packets a bulk write keeps queued in the host on top of those in the controller
+GATT_WRITE_MAX_PENDING = 8
+
+
+class Descriptor:
+    __slots__ = ("handle", "uuid")
+
+    def __init__(self, handle: int, uuid: bytes):
+        self.handle = handle
+        # little endian UUID, 2 or 16 bytes
+        self.uuid = uuid
+
+    def __str__(self):
+        return f"descriptor handle:0x{self.handle:04X} uuid:{self.uuid[::-1].hex()}"
+
+
+class Characteristic:
+    __slots__ = ("handle", "properties", "value_handle", "uuid", "end_handle", "descriptors")
+
+    def __init__(self, handle: int, properties: int, value_handle: int, uuid: bytes, end_handle: int = 0):
+        # handle of the characteristic declaration
+        self.handle = handle
+        self.properties = properties
+        self.value_handle = value_handle
+        self.uuid = uuid
+        # last handle of the characteristic, its descriptors are in value_handle+1..end_handle
+        self.end_handle = end_handle
+        self.descriptors = []
+
+    def __str__(self):
+        return f"characteristic handle:0x{self.handle:04X} value_handle:0x{self.value_handle:04X} properties:0x{self.properties:02X} uuid:{self.uuid[::-1].hex()}"
+
+
+class Service:
+    __slots__ = ("handle", "end_group_handle", "uuid", "characteristics")
+
+    def __init__(self, handle: int, end_group_handle: int, uuid: bytes):
+        self.handle = handle
+        self.end_group_handle = end_group_handle
+        self.uuid = uuid
+        self.characteristics = []
+
+    def __str__(self):
+        return f"service handle:0x{self.handle:04X}-0x{self.end_group_handle:04X} uuid:{self.uuid[::-1].hex()}"
+
+
+def services_to_json(services: list) -> list:
+    return [
+        {
+            "handle": s.handle,
+            "end_group_handle": s.end_group_handle,
+            "uuid": s.uuid.hex(),
+            "characteristics": [
+                {
+                    "handle": c.handle,
+                    "properties": c.properties,
+                    "value_handle": c.value_handle,
+                    "uuid": c.uuid.hex(),
+                    "end_handle": c.end_handle,
+                    "descriptors": [[d.handle, d.uuid.hex()] for d in c.descriptors],
+                }
+                for c in s.characteristics
+            ],
+        }
+        for s in services
+    ]
+
+
+def services_from_json(data: list) -> list:
+    services = []
+    for s in data:
+        service = Service(s["handle"], s["end_group_handle"], bytes.fromhex(s["uuid"]))
+        for c in s["characteristics"]:
+            characteristic = Characteristic(c["handle"], c["properties"], c["value_handle"], bytes.fromhex(c["uuid"]), c["end_handle"])
+            characteristic.descriptors = [Descriptor(handle, bytes.fromhex(uuid)) for handle, uuid in c["descriptors"]]
+            service.characteristics.append(characteristic)
+        services.append(service)
+    return services
+
+
+class GattCache:
+    """
+    discovered databases on disk, one json file per peer identity, valid as
+    long as the peer Database Hash is unchanged
+
+    The identity is the address type and the address of the connection.
+    Identity addresses resolved by the controller (address types 2 and 3)
+    share the entry of the public or static address. There is no IRK
+    resolution in the host, so a peer seen with a resolvable private address
+    is not cached: its next connection would use another address.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(peer_address_type: int, peer_address: bytes) -> str:
+        """
+        cache key of a peer, None if its address does not identify it
+        """
+        # 0 public, 1 random, 2 public identity, 3 random identity
+        random = peer_address_type & 0x01
+        # random address top bits 0b01: resolvable private, 0b00: non-resolvable private
+        if random and peer_address_type < 2 and peer_address[5] >> 6 != 0b11:
+            return None
+        return f"{'random' if random else 'public'}-{peer_address[::-1].hex()}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key: str, database_hash: bytes) -> list:
+        """
+        cached services, None if there is no entry for this hash
+        """
+        try:
+            with open(self._path(key), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("database_hash") != database_hash.hex():
+            return None
+        return services_from_json(data["services"])
+
+    def store(self, key: str, database_hash: bytes, services: list):
+        path = self._path(key)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"database_hash": database_hash.hex(), "services": services_to_json(services)}, f)
+        os.replace(path + ".tmp", path)
+
+
 class GATT:
-    def __init__(self, att):
+    """
+    GATT client
+
+    Discovery uses Read By Group Type / Read By Type / Find Information over
+    whole handle ranges, each response packed to the ATT_MTU by the server,
+    so the number of round-trips depends on the database size, not on the
+    number of services. The independent range queries of a step are all
+    queued at once on the ATT bearer, so the next request goes out as soon
+    as the previous response arrives.
+
+    The ATT_MTU is exchanged before the first discovery of a connection, so
+    the responses are packed to the negotiated MTU, not to the default 23.
+
+    With a cache directory, discovered databases are stored per peer identity
+    (see GattCache) with the Database Hash, and reused while the hash is unchanged.
+
+    Long writes queue all their Prepare Write requests at once, bulk writes
+    stream Write Commands as fast as the controller ACL credits come back.
+    """
+
+    def __init__(self, att, cache_dir: str = None):
         self.att = att
+        self.cache = GattCache(cache_dir) if cache_dir else None
+        # connection handle -> list of Service
+        self.databases = {}
+        # connection handles whose MTU exchange is done, a client exchanges once per connection
+        self.mtu_exchanged = set()
+        # connection handle -> future of the MTU exchange not answered yet
+        self.mtu_requests = {}
+        hci = self.att.l2cap.hci
+        connections = getattr(hci, "connections", None)
+        self.connections = connections
+        if connections is not None:
+            connections.register_event(ConnectionEvent.DISCONNECTED, self._on_disconnected)
+        # notified when Number Of Completed Packets returns ACL credits
+        self.acl_completed = threading.Condition()
+        hci.register_event(HciEventNumberOfCompletedPackets.EVENT_CODE, self._on_completed_packets)
+
+    def _on_disconnected(self, connection):
+        self.databases.pop(connection.handle, None)
+        self.mtu_exchanged.discard(connection.handle)
+        self.mtu_requests.pop(connection.handle, None)
+        with self.acl_completed:
+            self.acl_completed.notify_all()
+
+    def _on_completed_packets(self, evt):
+        with self.acl_completed:
+            self.acl_completed.notify_all()
+
+    def exchange_mtu(self, connection_handle, timeout: float = GATT_TIMEOUT) -> int:
+        """
+        exchange the ATT_MTU once per connection, return the connection ATT_MTU
+
+        A timeout propagates and leaves the exchange unmarked: a later call
+        waits again for the same request while ATT still expects its
+        response, and raises once ATT timed it out, until the connection is
+        closed and the next one exchanges again.
+        """
+        if connection_handle not in self.mtu_exchanged:
+            future = self.mtu_requests.get(connection_handle)
+            if future is None:
+                future = self.mtu_requests[connection_handle] = self.att.exchange_mtu(connection_handle)
+            try:
+                future.result(timeout)
+            except AttError as e:
+                # a server without MTU exchange keeps the default ATT_MTU
+                logger.info(f"gatt connection_handle:0x{connection_handle:04X} mtu exchange failed: {e}")
+            self.mtu_requests.pop(connection_handle, None)
+            self.mtu_exchanged.add(connection_handle)
+        return self.att.mtu(connection_handle)
+
+    def _query_ranges(self, connection_handle, ranges: list, request: callable, parse: callable, timeout: float) -> list:
+        """
+        run range queries until Attribute Not Found, every range is queued
+        on the bearer before waiting for the first response
+
+        request(connection_handle, start, end) -> Future
+        parse(pdu) -> (entries, last handle covered by the response)
+        """
+        pending = deque((start, end, request(connection_handle, start, end)) for start, end in ranges if start <= end)
+        entries = []
+        while pending:
+            start, end, future = pending.popleft()
+            try:
+                found, last = parse(future.result(timeout))
+            except AttError as e:
+                if e.error_code == ATT_ERROR.ATT_ATTRIBUTE_NOT_FOUND:
+                    continue
+                raise
+            entries.extend(found)
+            if found and last < end:
+                pending.append((last + 1, end, request(connection_handle, last + 1, end)))
+        # continuations are queued behind the other ranges
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    @staticmethod
+    def _parse_read_by_group_type(pdu: bytes):
+        length = pdu[1]
+        entries = [struct.unpack_from("<HH", pdu, i) + (pdu[i + 4 : i + length],) for i in range(2, len(pdu) - length + 1, length)]
+        return entries, entries[-1][1] if entries else 0xFFFF
+
+    @staticmethod
+    def _parse_read_by_type(pdu: bytes):
+        length = pdu[1]
+        entries = [(struct.unpack_from("<H", pdu, i)[0], pdu[i + 2 : i + length]) for i in range(2, len(pdu) - length + 1, length)]
+        return entries, entries[-1][0] if entries else 0xFFFF
+
+    @staticmethod
+    def _parse_find_information(pdu: bytes):
+        size = 4 if pdu[1] == 0x01 else 18
+        entries = [(struct.unpack_from("<H", pdu, i)[0], pdu[i + 2 : i + size]) for i in range(2, len(pdu) - size + 1, size)]
+        return entries, entries[-1][0] if entries else 0xFFFF
+
+    def discover_services(self, connection_handle, timeout: float = GATT_TIMEOUT) -> list:
+        """
+        primary services of the peer
+        """
+        group_type = uuid16(GATT_PRIMARY_SERVICE)
+        entries = self._query_ranges(
+            connection_handle,
+            [(0x0001, 0xFFFF)],
+            lambda h, start, end: self.att.read_by_group_type(h, start, end, group_type),
+            self._parse_read_by_group_type,
+            timeout,
+        )
+        return [Service(handle, end, uuid) for handle, end, uuid in entries]
+
+    def discover_characteristics(self, connection_handle, services: list, timeout: float = GATT_TIMEOUT):
+        """
+        fill the characteristics of services with one Read By Type over the handle range they cover
+        """
+        if not services:
+            return
+        declaration_type = uuid16(GATT_CHARACTERISTIC)
+        entries = self._query_ranges(
+            connection_handle,
+            self._merge_ranges([(s.handle, s.end_group_handle) for s in services]),
+            lambda h, start, end: self.att.read_by_type(h, start, end, declaration_type),
+            self._parse_read_by_type,
+            timeout,
+        )
+        characteristics = [Characteristic(handle, value[0], struct.unpack_from("<H", value, 1)[0], bytes(value[3:])) for handle, value in entries]
+        i = 0
+        for service in services:
+            service.characteristics = []
+            while i < len(characteristics) and characteristics[i].handle <= service.end_group_handle:
+                if characteristics[i].handle > service.handle:
+                    service.characteristics.append(characteristics[i])
+                i += 1
+            for c, following in zip(service.characteristics, service.characteristics[1:] + [None]):
+                c.end_handle = following.handle - 1 if following is not None else service.end_group_handle
+
+    def discover_descriptors(self, connection_handle, services: list, timeout: float = GATT_TIMEOUT):
+        """
+        fill the descriptors of every characteristic, the Find Information
+        requests of all characteristics are pipelined
+        """
+        characteristics = [c for s in services for c in s.characteristics if c.value_handle < c.end_handle]
+        entries = self._query_ranges(
+            connection_handle,
+            self._merge_ranges([(c.value_handle + 1, c.end_handle) for c in characteristics]),
+            self.att.find_information,
+            self._parse_find_information,
+            timeout,
+        )
+        i = 0
+        for c in characteristics:
+            c.descriptors = []
+            while i < len(entries) and entries[i][0] <= c.end_handle:
+                if entries[i][0] > c.value_handle:
+                    c.descriptors.append(Descriptor(entries[i][0], bytes(entries[i][1])))
+                i += 1
+
+    @staticmethod
+    def _merge_ranges(ranges: list) -> list:
+        """
+        join adjacent handle ranges, fewer and fuller requests
+        """
+        merged = []
+        for start, end in sorted(ranges):
+            if start > end:
+                continue
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [tuple(r) for r in merged]
+
+    def read_database_hash(self, connection_handle, timeout: float = GATT_TIMEOUT) -> bytes:
+        """
+        Database Hash characteristic value, None if the peer has none
+        """
+        try:
+            pdu = self.att.read_by_type(connection_handle, 0x0001, 0xFFFF, uuid16(GATT_DATABASE_HASH)).result(timeout)
+        except AttError:
+            return None
+        entries, _ = self._parse_read_by_type(pdu)
+        return bytes(entries[0][1]) if entries else None
+
+    def discover(self, connection_handle, timeout: float = GATT_TIMEOUT) -> list:
+        """
+        services, characteristics and descriptors of the peer, from the cache
+        if the peer Database Hash matches the cached one
+        """
+        self.exchange_mtu(connection_handle, timeout)
+        key = None
+        database_hash = None
+        if self.cache is not None and self.connections is not None:
+            connection = self.connections.get(connection_handle)
+            if connection is not None:
+                key = GattCache.key(connection.peer_address_type, connection.peer_address)
+            if key is not None:
+                database_hash = self.read_database_hash(connection_handle, timeout)
+        if database_hash is not None:
+            services = self.cache.load(key, database_hash)
+            if services is not None:
+                logger.info(f"gatt connection_handle:0x{connection_handle:04X} database loaded from cache")
+                self.databases[connection_handle] = services
+                return services
+        services = self.discover_services(connection_handle, timeout)
+        self.discover_characteristics(connection_handle, services, timeout)
+        self.discover_descriptors(connection_handle, services, timeout)
+        self.databases[connection_handle] = services
+        if database_hash is not None:
+            self.cache.store(key, database_hash, services)
+        return services
+
+    def read_characteristic(self, connection_handle, char_handle, timeout: float = GATT_TIMEOUT) -> bytes:
+        """
+        read a characteristic value by value handle, long values are
+        completed with Read Blob
+        """
+        value = self.att.read(connection_handle, char_handle).result(timeout)[1:]
+        return self._read_blobs(connection_handle, char_handle, value, None, timeout)
+
+    def _read_blobs(self, connection_handle, value_handle, value: bytes, length: int, timeout: float) -> bytes:
+        """
+        complete a value read up to len(value) with Read Blob requests
+
+        With a known length all the requests are queued at once. Otherwise a
+        value that filled its response may continue, GATT_BLOB_WINDOW requests
+        are kept queued ahead until a short part marks the end of the value.
+        The requests still queued after the end of the value or an error are
+        cancelled, ATT never sends them.
+        """
+        chunk = self.att.mtu(connection_handle) - 1
+        value = bytearray(value)
+        if length is not None:
+            futures = deque(self.att.read_blob(connection_handle, value_handle, offset) for offset in range(len(value), length, chunk))
+        else:
+            if len(value) < chunk:
+                return bytes(value)
+            offsets = iter(range(len(value), GATT_MAX_VALUE_LEN, chunk))
+            futures = deque(self.att.read_blob(connection_handle, value_handle, offset) for offset in islice(offsets, GATT_BLOB_WINDOW))
+        while futures:
+            try:
+                part = futures.popleft().result(timeout)[1:]
+            except (AttError, concurrent.futures.TimeoutError):
+                self._cancel(futures)
+                raise
+            value += part
+            if length is None:
+                if len(part) < chunk:
+                    # requests queued past the end of the value
+                    self._cancel(futures)
+                    break
+                offset = next(offsets, None)
+                if offset is not None:
+                    futures.append(self.att.read_blob(connection_handle, value_handle, offset))
+        return bytes(value)
+
+    def read_multiple(self, connection_handle, handles: list, timeout: float = GATT_TIMEOUT) -> dict:
+        """
+        read many values with as few requests as the ATT_MTU allows
+
+        Handles are coalesced into Read Multiple Variable requests of
+        (ATT_MTU - 1) / 2 handles, all queued at once. Handles cut off by a
+        full response go into the next round, a truncated last value is
+        completed with Read Blob. A batch with an error response, for an
+        unreadable handle or a peer without Read Multiple Variable, or with
+        a response holding no value at all is read again with one Read per
+        handle. On a timeout the requests still queued are cancelled so ATT
+        never sends them, and the TimeoutError is raised. The request that
+        was outstanding is left to the ATT transaction timeout.
+
+        return {handle: value}, the AttError for handles that cannot be read
+        """
+        values = {}
+        pending = list(dict.fromkeys(handles))
+        per_request = (self.att.mtu(connection_handle) - 1) // 2
+        while pending:
+            batches = [pending[i : i + per_request] for i in range(0, len(pending), per_request)]
+            requests = [(batch, self.att.read_multiple_variable(connection_handle, batch) if len(batch) > 1 else None) for batch in batches]
+            pending = []
+            truncated = []
+            for i, (batch, future) in enumerate(requests):
+                if future is None:
+                    self._read_each(connection_handle, batch, values, timeout)
+                    continue
+                try:
+                    pdu = future.result(timeout)
+                except AttError:
+                    # one handle not readable or no Read Multiple Variable on the peer
+                    self._read_each(connection_handle, batch, values, timeout)
+                    continue
+                except concurrent.futures.TimeoutError:
+                    self._cancel(queued for _, queued in requests[i + 1 :] if queued is not None)
+                    raise
+                if len(pdu) < 3:
+                    # no value at all, asking again would loop forever
+                    self._read_each(connection_handle, batch, values, timeout)
+                    continue
+                offset = 1
+                for handle in batch:
+                    if offset + 2 > len(pdu):
+                        pending.append(handle)
+                        continue
+                    length = struct.unpack_from("<H", pdu, offset)[0]
+                    value = pdu[offset + 2 : offset + 2 + length]
+                    offset += 2 + length
+                    if len(value) < length:
+                        truncated.append((handle, value, length))
+                    else:
+                        values[handle] = value
+            for handle, value, length in truncated:
+                try:
+                    values[handle] = self._read_blobs(connection_handle, handle, value, length, timeout)
+                except AttError as e:
+                    values[handle] = e
+        return values
+
+    def _read_each(self, connection_handle, handles: list, values: dict, timeout: float):
+        """
+        one Read per handle, all queued at once
+        """
+        futures = [(handle, self.att.read(connection_handle, handle)) for handle in handles]
+        for i, (handle, future) in enumerate(futures):
+            try:
+                value = future.result(timeout)[1:]
+                values[handle] = self._read_blobs(connection_handle, handle, value, None, timeout)
+            except AttError as e:
+                # a Read or Read Blob error fails this handle only
+                values[handle] = e
+            except concurrent.futures.TimeoutError:
+                self._cancel(queued for _, queued in futures[i + 1 :])
+                raise
+
+    @staticmethod
+    def _cancel(futures):
+        """
+        cancel queued requests, ATT drops them unsent
+        """
+        for future in futures:
+            future.cancel()
+
+    def write_characteristic(self, connection_handle, char_handle, value: bytes, response: bool = True, timeout: float = GATT_TIMEOUT):
+        """
+        write a characteristic value by value handle
+
+        response=False sends a Write Command of at most ATT_MTU - 3 bytes. A
+        value longer than ATT_MTU - 3 with response is a long write: the
+        Prepare Write requests of all its parts are queued at once, their
+        echoes checked, then the Execute Write commits them. A part failing
+        or timing out cancels the parts already queued by the peer.
+        """
+        chunk = self.att.mtu(connection_handle) - 3
+        if not response:
+            if len(value) > chunk:
+                raise ValueError(f"write command value longer than {chunk} bytes")
+            self.att.write_cmd(connection_handle, char_handle, value)
+            return
+        if len(value) <= chunk:
+            self.att.write(connection_handle, char_handle, value).result(timeout)
+            return
+        # prepare write parts carry 2 more bytes of offset
+        chunk -= 2
+        parts = [(offset, value[offset : offset + chunk]) for offset in range(0, len(value), chunk)]
+        futures = [(offset, part, self.att.prepare_write(connection_handle, char_handle, offset, part)) for offset, part in parts]
+        try:
+            for offset, part, future in futures:
+                if future.result(timeout)[1:] != struct.pack("<HH", char_handle, offset) + part:
+                    raise ValueError(f"prepare write handle:0x{char_handle:04X} offset:{offset} echo mismatch")
+        except (AttError, ValueError):
+            self.att.execute_write(connection_handle, ATT_EXECUTE_WRITE_CANCEL).result(timeout)
+            raise
+        except concurrent.futures.TimeoutError:
+            # queued behind the unanswered part, the cancel goes out if the peer answers late
+            self.att.execute_write(connection_handle, ATT_EXECUTE_WRITE_CANCEL)
+            raise
+        self.att.execute_write(connection_handle, ATT_EXECUTE_WRITE_COMMIT).result(timeout)
 
-    def discover_services(self):
-        # 实现 GATT 服务发现逻辑
-        pass
+    def write_bulk(self, connection_handle, char_handle, data: bytes, max_pending: int = GATT_WRITE_MAX_PENDING, timeout: float = GATT_TIMEOUT) -> int:
+        """
+        stream data to a characteristic as Write Commands of ATT_MTU - 3 bytes
 
-    def read_characteristic(self, char_handle):
-        # 实现 GATT 特征值读取逻辑
-        pass
+        A Write Command is queued whenever the connection has fewer than
+        max_pending ACL packets waiting in the HciAclScheduler, so the
+        controller buffers stay full and the host queue stays bounded.
+        Waits for Number Of Completed Packets otherwise, TimeoutError if no
+        credit comes back within timeout.
 
-    def write_characteristic(self, char_handle, value):
-        # 实现 GATT 特征值写入逻辑
-        pass
\ No newline at end of file
+        return the number of bytes written
+        """
+        scheduler = self.att.l2cap.hci.acl_scheduler
+        chunk = self.att.mtu(connection_handle) - 3
+        data = memoryview(data)
+        for offset in range(0, len(data), chunk):
+            with self.acl_completed:
+                while True:
+                    if self.connections is not None and connection_handle not in self.connections:
+                        raise ConnectionError(f"connection 0x{connection_handle:04X} disconnected")
+                    if scheduler.pending(connection_handle) < max_pending:
+                        break
+                    if not self.acl_completed.wait(timeout):
+                        raise TimeoutError(f"gatt connection_handle:0x{connection_handle:04X} no ACL credits")
+            self.att.write_cmd(connection_handle, char_handle, bytes(data[offset : offset + chunk]))
+        return len(data)
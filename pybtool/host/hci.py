@@ -1,13 +1,19 @@
-import time
 import queue
+import struct
 import logging
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from enum import IntEnum
 from . import hci_transport
 from .hci_cmd import *
 from .hci_evt import *
-from .hci_btsnoop import BTSnoop
+from .hci_btsnoop import BTSnoopWriter
+from .hci_evt_decoder import decode_event
+from .trace import get_tracer
+from .hci_scheduler import HciCommandScheduler, HciAclScheduler
+from .connection import ConnectionManager
 
 logger = logging.getLogger(__name__)
+tracer = get_tracer("hci")
 
 hci_init_cmds = [
     (HciCmdReset, HciEventCommandComplete),
@@ -22,12 +28,14 @@ hci_init_cmds = [
         HciCmdLeReadlocalSupportedFeaturesPage0,
         HciEventCommandCompleteLeLocalSupportedFeatures,
     ),
+    (HciCmdLeReadBufferSize, HciEventCommandCompleteLeBufferSize),
 ]
 
 hci_evt_handlers = {
     HciEventDisconnectionComplete.EVENT_CODE: HciEventDisconnectionComplete,
     HciEventCommandComplete.EVENT_CODE: HciEventCommandComplete,
     HciEventCommandStatus.EVENT_CODE: HciEventCommandStatus,
+    HciEventNumberOfCompletedPackets.EVENT_CODE: HciEventNumberOfCompletedPackets,
     HciEventLeMeta.EVENT_CODE: HciEventLeMeta,
 }
 
@@ -37,23 +45,60 @@ hci_evt_le_handlers = {
 }
 
 
+def hci_event_object(evt_data: bytes) -> HciEvent:
+    """
+    decode an event with the HciEvent classes, for display
+
+    The receive path dispatches the decode_event tuples, these objects are
+    only built for their __str__ when the event is logged.
+    """
+    evt = hci_evt_handlers.get(evt_data[0], HciEvent)()
+    evt.unpack(evt_data)
+    if evt.event_code == HciEventLeMeta.EVENT_CODE and evt.subevent_code in hci_evt_le_handlers:
+        evt = hci_evt_le_handlers[evt.subevent_code]()
+        evt.unpack(evt_data)
+    return evt
+
+
 class HCI:
     """
     HCI class
+
+    Commands are queued in a HciCommandScheduler which honors the controller
+    command credits and matches Command Complete/Command Status events to the
+    pending command by opcode, the caller waits on a future instead of polling.
+    Every other event is dispatched to the subscribers registered with
+    register_event/register_le_event.
+
+    ACL data goes through a HciAclScheduler which fragments to the controller
+    ACL MTU and never sends more packets than the controller has buffers for.
+    Connection state is kept by a ConnectionManager in self.connections.
     """
 
-    def __init__(self, transport: str = "usb"):
-        print(__name__)
-        self.acl_callback = None
-        self.event_callback = None
-        self.event_queue = queue.Queue()
+    def __init__(self, transport="usb", btsnoop: str = "hci_btsnoop.cfa", btsnoop_writer: BTSnoopWriter = None):
+        """
+        transport: "usb", "uart" or a HCIInterface instance
+        btsnoop: btsnoop file name, None to disable snoop logging
+        btsnoop_writer: configured BTSnoopWriter (rotation, flush policy), default one otherwise
+        """
         self.acl_queue = queue.Queue()
-        self.btsnoop = BTSnoop()
-        self.btsnoop.createHeader("hci_btsnoop.cfa")
+        self.btsnoop = btsnoop_writer or BTSnoopWriter()
+        if btsnoop is not None:
+            self.btsnoop.createHeader(btsnoop)
         if transport == "usb":
             self.hci = hci_transport.usb_interface()
-        else:
+        elif transport == "uart":
             self.hci = hci_transport.uart_interface()
+        else:
+            self.hci = transport
+        self.cmd_scheduler = HciCommandScheduler(self._write_command)
+        self.acl_scheduler = HciAclScheduler(self._write_acl_packets)
+        # event code / le subevent code -> list of callbacks
+        self.event_callbacks = {}
+        self.le_event_callbacks = {}
+        self.register_event(HciEventNumberOfCompletedPackets.EVENT_CODE, self._on_completed_packets)
+        self.register_event(HciEventDisconnectionComplete.EVENT_CODE, self._on_disconnection_complete)
+        self.connections = ConnectionManager(self)
 
     def list_devices(self):
         return self.hci.list_devices()
@@ -72,50 +117,142 @@ class HCI:
         self.btsnoop.close()
 
     def send_command(self, cmd: HciCmd, expect_evt: HciEvent = None, timeout: int = 2):
-        evt = HciEvent()
-        logger.info("send cmd:" + " ".join([hex(i) for i in cmd.pack()]))
-        self.btsnoop.addRecord(bytes([0x00, 0x01]) + cmd.pack())
-        self.hci.send_command(cmd.pack())
-        # wait for expect event timeout times
-        time_start = time.time()
-        while time.time() - time_start < timeout:
-            recv = self.receive_event()
-            if len(recv) > 0:
-                evt.unpack(recv)
-                if evt.event_code == expect_evt.EVENT_CODE:
-                    expect_evt.unpack(recv)
-                    return expect_evt
-        return None
-    
+        """
+        send command and wait for its Command Complete/Command Status event
+
+        expect_evt: event instance the response is unpacked into, default HciEventCommandComplete
+        return the event, or None on timeout
+        """
+        future = self.submit_command(cmd, expect_evt)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            self.cmd_scheduler.cancel(cmd.opcode, future)
+            logger.warning(f"cmd opcode:0x{cmd.opcode:04X} timeout")
+            return None
+
+    def submit_command(self, cmd: HciCmd, expect_evt: HciEvent = None) -> Future:
+        """
+        queue command without waiting, the returned future resolves to the response event
+
+        the command is sent as soon as the controller grants a command credit
+        """
+        if expect_evt is None:
+            expect_evt = HciEventCommandComplete()
+        return self.cmd_scheduler.submit(cmd.opcode, cmd.pack(), expect_evt)
+
+    def send_commands(self, cmds: list, timeout: int = 2) -> list:
+        """
+        pipeline commands and wait for all of them
+
+        cmds: list of (HciCmd, expect_evt)
+        return list of response events, None for the commands that timed out
+        """
+        futures = [(cmd, self.submit_command(cmd, evt)) for cmd, evt in cmds]
+        evts = []
+        for cmd, future in futures:
+            try:
+                evts.append(future.result(timeout))
+            except FutureTimeoutError:
+                self.cmd_scheduler.cancel(cmd.opcode, future)
+                logger.warning(f"cmd opcode:0x{cmd.opcode:04X} timeout")
+                evts.append(None)
+        return evts
+
+    def _write_command(self, data: bytes):
+        tracer.packet("send cmd", data)
+        self.btsnoop.addPacket(True, HCI_TYPE.HCI_CMD, data)
+        self.hci.send_command(data)
+
     def send_acl(self, data: bytes):
-        logger.info("send acl:" + " ".join([hex(i) for i in data]))
-        self.btsnoop.addRecord(bytes([0x00, 0x02]) + data)
-        self.hci.send_acl(data)
+        """
+        send a complete ACL packet (header included)
+        """
+        self.acl_scheduler.send_packet(data)
+
+    def send_acl_data(self, connection_handle: int, data: bytes):
+        """
+        send a L2CAP PDU, fragmented to the controller ACL MTU
+        """
+        self.acl_scheduler.send_pdu(connection_handle, data)
+
+    def _write_acl_packets(self, packets: list):
+        for data in packets:
+            tracer.packet("send acl", data)
+            self.btsnoop.addPacket(True, HCI_TYPE.HCI_ACL, data)
+        if len(packets) == 1:
+            self.hci.send_acl(packets[0])
+        else:
+            self.hci.send_packets([(HCI_TYPE.HCI_ACL, data) for data in packets])
+
+    def _on_completed_packets(self, evt: HciEventNumberOfCompletedPackets):
+        for connection_handle, num in evt.completed_packets:
+            self.acl_scheduler.completed(connection_handle, num)
+
+    def _on_disconnection_complete(self, evt: HciEventDisconnectionComplete):
+        if evt.status == 0:
+            self.acl_scheduler.disconnected(evt.connection_handle)
 
     def event_handler(self, evt_data: bytes):
-        logger.info("recv evt:" + " ".join([hex(i) for i in evt_data]))
-        self.event_queue.put(evt_data)
-        self.btsnoop.addRecord(bytes([0x00, 0x04]) + evt_data)
-        if evt_data[0] in hci_evt_handlers:
-            evt = hci_evt_handlers[evt_data[0]]()
-            evt.unpack(evt_data)
-            if evt.event_code == HciEventLeMeta.EVENT_CODE:
-                if evt.subevent_code in hci_evt_le_handlers:
-                    evt = hci_evt_le_handlers[evt.subevent_code]()
-                    evt.unpack(evt_data)
-            print(evt)
-            
+        tracer.packet("recv evt", evt_data)
+        self.btsnoop.addPacket(False, HCI_TYPE.HCI_EVT, evt_data)
+        try:
+            evt = decode_event(evt_data)
+        except (ValueError, struct.error) as e:
+            logger.error(f"invalid event: {e}")
+            return
+        if tracer.enabled():
+            tracer.log("%s", hci_event_object(evt_data))
+        if evt.event_code in (HciEventCommandComplete.EVENT_CODE, HciEventCommandStatus.EVENT_CODE):
+            self.cmd_scheduler.complete(evt, evt_data)
+        self._dispatch_event(evt)
+
+    def _dispatch_event(self, evt):
+        callbacks = self.event_callbacks.get(evt.event_code, ())
+        if evt.event_code == HciEventLeMeta.EVENT_CODE:
+            callbacks = list(callbacks) + self.le_event_callbacks.get(evt.subevent_code, [])
+        for cb in callbacks:
+            try:
+                cb(evt)
+            except Exception as e:
+                logger.exception(f"event callback error: {e}")
+
+    def register_event(self, event_code: int, cb: callable):
+        """
+        注册 HCI 事件回调函数, cb(evt)
+        """
+        callbacks = self.event_callbacks.setdefault(event_code, [])
+        if cb not in callbacks:
+            callbacks.append(cb)
+
+    def unregister_event(self, event_code: int, cb: callable):
+        """
+        取消注册 HCI 事件回调函数
+        """
+        callbacks = self.event_callbacks.get(event_code, [])
+        if cb in callbacks:
+            callbacks.remove(cb)
+
+    def register_le_event(self, subevent_code: int, cb: callable):
+        """
+        注册 LE Meta 子事件回调函数, cb(evt)
+        """
+        callbacks = self.le_event_callbacks.setdefault(subevent_code, [])
+        if cb not in callbacks:
+            callbacks.append(cb)
+
+    def unregister_le_event(self, subevent_code: int, cb: callable):
+        """
+        取消注册 LE Meta 子事件回调函数
+        """
+        callbacks = self.le_event_callbacks.get(subevent_code, [])
+        if cb in callbacks:
+            callbacks.remove(cb)
 
     def acl_handler(self, acl_data: bytes):
-        logger.info("recv acl:" + " ".join([hex(i) for i in acl_data]))
+        tracer.packet("recv acl", acl_data)
         self.acl_queue.put(acl_data)
-        self.btsnoop.addRecord(bytes([0x00, 0x02]) + acl_data)
-
-    def receive_event(self) -> bytes:
-        try:
-            return self.event_queue.get(block=False)
-        except queue.Empty:
-            return bytes()
+        self.btsnoop.addPacket(False, HCI_TYPE.HCI_ACL, acl_data)
 
     def receive_acl(self) -> bytes:
         try:
@@ -133,13 +270,37 @@ class HCI:
     def init(self):
         """
         hci module init
+
+        the whole table is queued at once and pipelined by the command scheduler
         """
-        for h in hci_init_cmds:
-            hcicmd = h[0]()
+        cmds = [(h[0](), h[1]()) for h in hci_init_cmds]
+        for hcicmd, _ in cmds:
             logger.info(hcicmd)
-            hcievt = h[1]()
-            hcievt = self.send_command(hcicmd, hcievt)
+        evts = self.send_commands(cmds)
+        for hcievt in evts:
             logger.info(hcievt)
+        self._setup_acl_buffers(evts)
+
+    def _setup_acl_buffers(self, evts: list):
+        """
+        LE links use the LE buffers, or the shared ACL buffers when the controller reports none
+        """
+        buffer_size = le_buffer_size = None
+        for evt in evts:
+            if isinstance(evt, HciEventCommandCompleteBufferSize) and evt.status == 0:
+                buffer_size = evt
+            elif isinstance(evt, HciEventCommandCompleteLeBufferSize) and evt.status == 0:
+                le_buffer_size = evt
+        if le_buffer_size is not None and le_buffer_size.total_num_le_acl_data_packets > 0:
+            self.acl_scheduler.set_buffer_size(
+                le_buffer_size.le_acl_data_packet_length, le_buffer_size.total_num_le_acl_data_packets
+            )
+        elif buffer_size is not None and buffer_size.total_num_acl_data_packets > 0:
+            self.acl_scheduler.set_buffer_size(
+                buffer_size.acl_data_packet_size, buffer_size.total_num_acl_data_packets
+            )
+        else:
+            logger.warning("acl buffer size unknown, acl flow control disabled")
 
 
 if __name__ == "__main__":
@@ -164,9 +325,6 @@ if __name__ == "__main__":
             d = devices[i]
         hci.open(d)
         print(f"hci open {hci.name}")
-        cmd = bytes.fromhex("010c0300")
-        hci.send_command(cmd)
-        print("send cmd:" + " ".join([hex(i) for i in cmd]))
-        evt = hci.receive_event()
-        print("recv evt:" + " ".join([hex(i) for i in evt]))
+        evt = hci.send_command(HciCmdReset())
+        print(evt)
         hci.close()
@@ -1,8 +1,37 @@
 from io import TextIOWrapper
+from array import array
+from bisect import bisect_left
+from collections import deque, namedtuple
+import logging
+import mmap
+import os
 import struct
+import threading
 import time
 import datetime
 
+logger = logging.getLogger(__name__)
+
+BTSNOOP_MAGIC = b"btsnoop\0"
+# microseconds from 0000-01-01 to 1970-01-01
+BTSNOOP_EPOCH_DELTA = 0x00DCDDB30F2F8000
+
+
+def btsnoop_timestamp(t: float) -> int:
+    stamp = t + 8 * 3600  # 东八区  得加回8小时
+    return round(stamp * 1000 * 1000) + BTSNOOP_EPOCH_DELTA
+
+
+def btsnoop_time(timestamp: int) -> float:
+    """
+    inverse of btsnoop_timestamp, return time.time() seconds
+    """
+    return (timestamp - BTSNOOP_EPOCH_DELTA) / (1000 * 1000) - 8 * 3600
+
+
+# data is a memoryview into the mapped file: |packet type(1)|packet|
+SnoopRecordView = namedtuple("SnoopRecordView", ["orig_len", "incl_len", "flags", "drops", "timestamp", "data"])
+
 
 class SnoopHeader:
     def __init__(self) -> None:
@@ -35,8 +64,7 @@ class SnoopRecord:
         return f1 << 1 | f0
 
     def gettimestamp(self) -> int:
-        stamp = time.time() + 8 * 3600  # 东八区  得加回8小时
-        return round(stamp * 1000 * 1000) + 0x00DCDDB30F2F8000
+        return btsnoop_timestamp(time.time())
 
     def getdata(self):
         return self.data[1:]
@@ -63,8 +91,7 @@ class BTSnoop:
     def createHeader(self, file: str = "snoop.cfa"):
         if not self.writer:
             self.writer = open(file, "wb+")
-            btsnoop_magic = b"btsnoop\0"
-            self.writer.write(btsnoop_magic)
+            self.writer.write(BTSNOOP_MAGIC)
             hb = self.header.getbytes()
             self.writer.write(hb)
             self.writer.flush()
@@ -80,3 +107,320 @@ class BTSnoop:
     def close(self):
         if self.writer and not self.writer.closed:
             self.writer.close()
+
+
+class BTSnoopWriter:
+    """
+    buffered btsnoop writer
+
+    addRecord/addPacket only queue the packet with its timestamp, a background
+    thread packs the queued records in batches into a reusable bytearray and
+    writes them when flush_size bytes are pending or every flush_interval
+    seconds. The file is rotated to file.1, file.2, ... when it grows over
+    max_bytes or is older than rotate_interval seconds, keeping backup_count
+    old files. 0 disables the corresponding limit, with backup_count 0 the
+    file is simply restarted.
+
+    At most max_records packets are queued, when the flush thread falls
+    behind the oldest queued packets are dropped and counted in dropped,
+    the running count is written as cumulative drops of the later records.
+    """
+
+    RECORD_HEADER = struct.Struct(">4Iq")
+    # flags
+    FLAG_RECEIVED = 0x01
+    FLAG_COMMAND_EVENT = 0x02
+
+    def __init__(
+        self,
+        flush_size: int = 64 * 1024,
+        flush_interval: float = 1.0,
+        max_bytes: int = 0,
+        rotate_interval: float = 0,
+        backup_count: int = 0,
+        max_records: int = 100000,
+    ) -> None:
+        self.header = SnoopHeader()
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.max_records = max_records
+        self.file = None
+        self.writer = None
+        self.file_size = 0
+        self.file_time = 0
+        # (timestamp, flags, packet type, data)
+        self.records = deque()
+        # size of the queued records, records and pending_bytes are guarded by records_lock
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.records_lock = threading.Lock()
+        self.buffer = bytearray(flush_size + 4096)
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def createHeader(self, file: str = "snoop.cfa"):
+        if self.writer:
+            return
+        self.file = file
+        self._open()
+        self.running = True
+        self.thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.thread.start()
+
+    def addRecord(self, data: bytes):
+        """
+        |direction(1), 0 received|packet type(1)|packet|, same as BTSnoop.addRecord
+        """
+        if not data or len(data) < 2:
+            return
+        self.addPacket(data[0] != 0, data[1], data[2:])
+
+    def addPacket(self, sent: bool, packet_type: int, data: bytes):
+        """
+        queue a packet, sent is True for host to controller packets
+        """
+        if self.writer is None:
+            return
+        flags = 0 if sent else self.FLAG_RECEIVED
+        if packet_type == 0x01 or packet_type == 0x04:
+            flags |= self.FLAG_COMMAND_EVENT
+        record_size = self.RECORD_HEADER.size + 1 + len(data)
+        with self.records_lock:
+            if len(self.records) >= self.max_records:
+                dropped = self.records.popleft()
+                self.pending_bytes -= self.RECORD_HEADER.size + 1 + len(dropped[3])
+                self.dropped += 1
+            self.records.append((time.time(), flags, packet_type, data))
+            self.pending_bytes += record_size
+            wakeup = self.pending_bytes >= self.flush_size
+        if wakeup:
+            self.wakeup.set()
+
+    def flush(self):
+        """
+        write all queued records now
+        """
+        with self.write_lock:
+            if self.writer is None:
+                return
+            self._write_records()
+            self.writer.flush()
+
+    def close(self):
+        if self.thread:
+            self.running = False
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+        with self.write_lock:
+            if self.writer and not self.writer.closed:
+                self._write_records()
+                self.writer.close()
+            self.writer = None
+
+    def _open(self):
+        self.writer = open(self.file, "wb")
+        self.writer.write(BTSNOOP_MAGIC)
+        self.writer.write(self.header.getbytes())
+        self.writer.flush()
+        self.file_size = len(BTSNOOP_MAGIC) + 8
+        self.file_time = time.time()
+
+    def _rotate(self):
+        self.writer.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = f"{self.file}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.file}.{i + 1}")
+            os.replace(self.file, f"{self.file}.1")
+        self._open()
+
+    def _need_rotate(self) -> bool:
+        if self.max_bytes > 0 and self.file_size >= self.max_bytes:
+            return True
+        if self.rotate_interval > 0 and time.time() - self.file_time >= self.rotate_interval:
+            return True
+        return False
+
+    def _write_records(self):
+        """
+        pack the queued records into the reusable buffer and write them
+        """
+        pack_into = self.RECORD_HEADER.pack_into
+        header_size = self.RECORD_HEADER.size
+        # take the whole queue, packets added meanwhile go to a new one
+        with self.records_lock:
+            records = self.records
+            self.records = deque()
+            self.pending_bytes = 0
+            # packets are dropped from the head, so all the taken ones come after every drop
+            drops = self.dropped
+        while records:
+            if self._need_rotate():
+                self._rotate()
+            size = 0
+            while records and size < self.flush_size:
+                t, flags, packet_type, data = records.popleft()
+                length = len(data) + 1
+                end = size + header_size + length
+                if end > len(self.buffer):
+                    self.buffer.extend(bytes(end - len(self.buffer)))
+                pack_into(self.buffer, size, length, length, flags, drops, btsnoop_timestamp(t))
+                self.buffer[size + header_size] = packet_type
+                self.buffer[size + header_size + 1 : end] = data
+                size = end
+            self.writer.write(memoryview(self.buffer)[:size])
+            self.file_size += size
+
+    def _flush_loop(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except (OSError, ValueError) as e:
+                # keep the receive path alive even if the disk is gone
+                logger.error(f"btsnoop write error: {e}")
+
+
+class BTSnoopReader:
+    """
+    btsnoop reader
+
+    The file is memory mapped and records are iterated as SnoopRecordView
+    whose data is a memoryview into the mapping, nothing is copied and the
+    file is never loaded in RAM. build_index() scans the record headers once
+    to allow random access by record number and seek by time.
+    Release the records before close(), the mapping can not be closed while
+    memoryviews into it are alive.
+    """
+
+    FILE_HEADER_SIZE = len(BTSNOOP_MAGIC) + 8
+    RECORD_HEADER = struct.Struct(">4Iq")
+
+    def __init__(self, file: str):
+        self.file = open(file, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < self.FILE_HEADER_SIZE:
+            self.file.close()
+            raise ValueError("not a btsnoop file")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        if self.view[: len(BTSNOOP_MAGIC)] != BTSNOOP_MAGIC:
+            self.close()
+            raise ValueError("not a btsnoop file")
+        self.version, self.datalink = struct.unpack_from(">2I", self.mm, len(BTSNOOP_MAGIC))
+        # record number -> file offset / timestamp, filled by build_index
+        self.offsets = None
+        self.timestamps = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            self.mm.close()
+            self.file.close()
+
+    def __iter__(self):
+        return self.iter_records()
+
+    def iter_records(self, offset: int = FILE_HEADER_SIZE):
+        """
+        iterate records starting at a file offset
+        """
+        view = self.view
+        unpack_from = self.RECORD_HEADER.unpack_from
+        header_size = self.RECORD_HEADER.size
+        end = len(view)
+        while offset + header_size <= end:
+            orig_len, incl_len, flags, drops, timestamp = unpack_from(view, offset)
+            data_offset = offset + header_size
+            offset = data_offset + incl_len
+            if offset > end:
+                # truncated capture
+                return
+            yield SnoopRecordView(orig_len, incl_len, flags, drops, timestamp, view[data_offset:offset])
+
+    def build_index(self):
+        """
+        scan the record headers and store each record offset and timestamp
+        """
+        offsets = array("Q")
+        timestamps = array("q")
+        unpack_from = self.RECORD_HEADER.unpack_from
+        header_size = self.RECORD_HEADER.size
+        end = len(self.view)
+        offset = self.FILE_HEADER_SIZE
+        while offset + header_size <= end:
+            _, incl_len, _, _, timestamp = unpack_from(self.mm, offset)
+            if offset + header_size + incl_len > end:
+                break
+            offsets.append(offset)
+            timestamps.append(timestamp)
+            offset += header_size + incl_len
+        self.offsets = offsets
+        self.timestamps = timestamps
+
+    def _index(self):
+        if self.offsets is None:
+            self.build_index()
+        return self.offsets
+
+    def __len__(self):
+        return len(self._index())
+
+    def __getitem__(self, n: int) -> SnoopRecordView:
+        offset = self._index()[n]
+        return next(self.iter_records(offset))
+
+    def iter_from(self, n: int):
+        """
+        iterate records starting at record number n
+        """
+        offsets = self._index()
+        if n >= len(offsets):
+            return iter(())
+        return self.iter_records(offsets[n])
+
+    def seek_time(self, t: float) -> int:
+        """
+        return the number of the first record at or after time t (time.time() seconds)
+        """
+        self._index()
+        return bisect_left(self.timestamps, btsnoop_timestamp(t))
+
+    @staticmethod
+    def is_received(record: SnoopRecordView) -> bool:
+        return bool(record.flags & BTSnoopWriter.FLAG_RECEIVED)
+
+    @staticmethod
+    def decode(record: SnoopRecordView):
+        """
+        decode a record with the HciCmd/HciEvent classes
+
+        return HciCmd or HciEvent subclass instance, ACL/SCO/ISO packets are returned as bytes
+        """
+        from .hci import hci_event_object
+        from .hci_cmd import HciCmd
+
+        packet_type = record.data[0]
+        data = bytes(record.data[1:])
+        if packet_type == 0x01:
+            cmd = HciCmd()
+            cmd.unpack(data)
+            return cmd
+        if packet_type == 0x04:
+            return hci_event_object(data)
+        return data
@@ -200,6 +200,16 @@ class HciCmdLeReadlocalSupportedFeaturesPage0(HciCmd):
         self.opcode = HCI_OPCODE.HCI_CMD_LE_READ_LOCAL_SUPPORTED_FEATURES
 
 
+class HciCmdLeReadBufferSize(HciCmd):
+    """
+    HCI LE read buffer size command
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.opcode = HCI_OPCODE.HCI_CMD_LE_READ_BUFFER_SIZE
+
+
 class HciCmdLeReadFilterAcceptListSize(HciCmd):
     """
     HCI LE read local supported features page0 command
@@ -156,6 +156,34 @@ class HciEventCommandCompleteBufferSize(HciEventCommandComplete):
         )
 
 
+class HciEventCommandCompleteLeBufferSize(HciEventCommandComplete):
+    """
+    HCI command complete event for LE buffer size
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.le_acl_data_packet_length = 0
+        self.total_num_le_acl_data_packets = 0
+
+    def unpack(self, data: bytes):
+        super().unpack(data)
+        if (
+            self.event_code == self.EVENT_CODE
+            and self.opcode == HCI_OPCODE.HCI_CMD_LE_READ_BUFFER_SIZE
+        ):
+            (
+                self.le_acl_data_packet_length,
+                self.total_num_le_acl_data_packets,
+            ) = struct.unpack("<HB", self.param[4 : 4 + 3])
+
+    def __str__(self):
+        return (
+            super().__str__()
+            + f", le_acl_data_packet_length: {self.le_acl_data_packet_length}, total_num_le_acl_data_packets: {self.total_num_le_acl_data_packets}"
+        )
+
+
 class HciEventCommandCompleteLocalVersionInfo(HciEventCommandComplete):
     """
     HCI command complete event for buffer size
@@ -315,13 +343,43 @@ class HciEventCommandStatus(HciEvent):
         super().unpack(data)
         if self.event_code == self.EVENT_CODE:
             self.status, self.num_hci_cmd_packets, self.opcode = struct.unpack(
-                "<BHB", self.param[:4]
+                "<BBH", self.param[:4]
             )
 
     def __str__(self):
         return f"hci event code: 0x{self.event_code:02X}, len: {self.len}, status: 0x{self.status:02X}, num_hci_cmd_packets: {self.num_hci_cmd_packets}, opcode: 0x{self.opcode:04X}"
 
 
+class HciEventNumberOfCompletedPackets(HciEvent):
+    """
+    HCI number of completed packets event
+    """
+    EVENT_CODE = 0x13
+    def __init__(self):
+        super().__init__()
+        self.event_code = 0
+        self.num_handles = 0
+        self.completed_packets = []
+
+    def unpack(self, data: bytes):
+        """
+        convert from bytes
+        """
+        super().unpack(data)
+        if self.event_code == self.EVENT_CODE:
+            self.num_handles = self.param[0]
+            _format = "<" + "HH" * self.num_handles
+            _offset = 1
+            _len = struct.calcsize(_format)
+            values = struct.unpack(_format, self.param[_offset:_offset+_len])
+            # list of (connection_handle, num_completed_packets)
+            self.completed_packets = list(zip(values[0::2], values[1::2]))
+
+    def __str__(self):
+        packets = ", ".join([f"0x{h:04X}: {n}" for h, n in self.completed_packets])
+        return f"hci event code: 0x{self.event_code:02X} HCI_Number_Of_Completed_Packets, len: {self.len}, num_handles: {self.num_handles}, completed_packets: {{{packets}}}"
+
+
 class HciEventLeMeta(HciEvent):
     """
     HCI LE meta event
@@ -0,0 +1,222 @@
+import struct
+from collections import namedtuple
+from .hci_evt import (
+    HciEventDisconnectionComplete,
+    HciEventCommandComplete,
+    HciEventCommandStatus,
+    HciEventNumberOfCompletedPackets,
+    HciEventLeMeta,
+    HciEventLeConnectionComplete,
+    HciEventLeConnectionUpdateComplete,
+)
+
+ENCRYPTION_CHANGE = 0x08
+ENCRYPTION_KEY_REFRESH_COMPLETE = 0x30
+LE_ADVERTISING_REPORT = 0x02
+LE_ENHANCED_CONNECTION_COMPLETE = 0x0A
+LE_EXTENDED_ADVERTISING_REPORT = 0x0D
+
+RawEvent = namedtuple("RawEvent", ["event_code", "param"])
+LeMetaEvent = namedtuple("LeMetaEvent", ["event_code", "subevent_code", "param"])
+DisconnectionComplete = namedtuple("DisconnectionComplete", ["event_code", "status", "connection_handle", "reason"])
+EncryptionChange = namedtuple("EncryptionChange", ["event_code", "status", "connection_handle", "encryption_enabled"])
+EncryptionKeyRefreshComplete = namedtuple("EncryptionKeyRefreshComplete", ["event_code", "status", "connection_handle"])
+CommandComplete = namedtuple("CommandComplete", ["event_code", "num_hci_cmd_packets", "opcode", "status", "return_parameters"])
+CommandStatus = namedtuple("CommandStatus", ["event_code", "status", "num_hci_cmd_packets", "opcode"])
+NumberOfCompletedPackets = namedtuple("NumberOfCompletedPackets", ["event_code", "num_handles", "completed_packets"])
+LeConnectionComplete = namedtuple(
+    "LeConnectionComplete",
+    [
+        "event_code",
+        "subevent_code",
+        "status",
+        "connection_handle",
+        "role",
+        "adv_address_type",
+        "peer_bd_addr",
+        "connection_interval",
+        "max_latency",
+        "supervision_timeout",
+        "central_clock_accuracy",
+    ],
+)
+LeEnhancedConnectionComplete = namedtuple(
+    "LeEnhancedConnectionComplete",
+    [
+        "event_code",
+        "subevent_code",
+        "status",
+        "connection_handle",
+        "role",
+        "adv_address_type",
+        "peer_bd_addr",
+        "local_resolvable_private_address",
+        "peer_resolvable_private_address",
+        "connection_interval",
+        "max_latency",
+        "supervision_timeout",
+        "central_clock_accuracy",
+    ],
+)
+LeConnectionUpdateComplete = namedtuple(
+    "LeConnectionUpdateComplete",
+    ["event_code", "subevent_code", "status", "connection_handle", "connection_interval", "max_latency", "supervision_timeout"],
+)
+LeAdvertisingReport = namedtuple("LeAdvertisingReport", ["event_code", "subevent_code", "reports"])
+# data is a memoryview into the event packet
+AdvertisingReport = namedtuple("AdvertisingReport", ["event_type", "address_type", "address", "data", "rssi"])
+ExtendedAdvertisingReport = namedtuple(
+    "ExtendedAdvertisingReport",
+    [
+        "event_type",
+        "address_type",
+        "address",
+        "primary_phy",
+        "secondary_phy",
+        "advertising_sid",
+        "tx_power",
+        "rssi",
+        "periodic_advertising_interval",
+        "direct_address_type",
+        "direct_address",
+        "data",
+    ],
+)
+
+_DISCONNECTION_COMPLETE = struct.Struct("<BHB")
+_ENCRYPTION_CHANGE = struct.Struct("<BHB")
+_ENCRYPTION_KEY_REFRESH_COMPLETE = struct.Struct("<BH")
+_COMMAND_COMPLETE = struct.Struct("<BHB")
+_COMMAND_COMPLETE_NOP = struct.Struct("<BH")
+_COMMAND_STATUS = struct.Struct("<BBH")
+_COMPLETED_PACKETS = struct.Struct("<HH")
+_LE_CONNECTION_COMPLETE = struct.Struct("<BHBB6sHHHB")
+_LE_ENHANCED_CONNECTION_COMPLETE = struct.Struct("<BHBB6s6s6sHHHB")
+_LE_CONNECTION_UPDATE_COMPLETE = struct.Struct("<BHHHH")
+_ADVERTISING_REPORT = struct.Struct("<BB6sB")
+_RSSI = struct.Struct("<b")
+_EXTENDED_ADVERTISING_REPORT = struct.Struct("<HB6sBBBbbHB6sB")
+
+# offset of the event parameters, |event code|Parameter Total Length|
+_PARAM = 2
+
+
+def decode_disconnection_complete(data: bytes):
+    return DisconnectionComplete(data[0], *_DISCONNECTION_COMPLETE.unpack_from(data, _PARAM))
+
+
+def decode_encryption_change(data: bytes):
+    return EncryptionChange(data[0], *_ENCRYPTION_CHANGE.unpack_from(data, _PARAM))
+
+
+def decode_encryption_key_refresh_complete(data: bytes):
+    return EncryptionKeyRefreshComplete(data[0], *_ENCRYPTION_KEY_REFRESH_COMPLETE.unpack_from(data, _PARAM))
+
+
+def decode_command_complete(data: bytes):
+    if data[1] < _COMMAND_COMPLETE.size:
+        # e.g. the HCI_NOP command complete, no return parameters
+        num_hci_cmd_packets, opcode = _COMMAND_COMPLETE_NOP.unpack_from(data, _PARAM)
+        status = 0
+    else:
+        # status is the first return parameter for most commands
+        num_hci_cmd_packets, opcode, status = _COMMAND_COMPLETE.unpack_from(data, _PARAM)
+    return CommandComplete(data[0], num_hci_cmd_packets, opcode, status, memoryview(data)[_PARAM + 3 :])
+
+
+def decode_command_status(data: bytes):
+    return CommandStatus(data[0], *_COMMAND_STATUS.unpack_from(data, _PARAM))
+
+
+def decode_number_of_completed_packets(data: bytes):
+    num_handles = data[_PARAM]
+    unpack_from = _COMPLETED_PACKETS.unpack_from
+    completed_packets = [unpack_from(data, _PARAM + 1 + 4 * i) for i in range(num_handles)]
+    return NumberOfCompletedPackets(data[0], num_handles, completed_packets)
+
+
+def decode_le_meta(data: bytes):
+    subevent_code = data[_PARAM]
+    decoder = hci_evt_le_decoders.get(subevent_code)
+    if decoder is None:
+        return LeMetaEvent(data[0], subevent_code, memoryview(data)[_PARAM + 1 :])
+    return decoder(data)
+
+
+def decode_le_connection_complete(data: bytes):
+    return LeConnectionComplete(data[0], data[_PARAM], *_LE_CONNECTION_COMPLETE.unpack_from(data, _PARAM + 1))
+
+
+def decode_le_enhanced_connection_complete(data: bytes):
+    return LeEnhancedConnectionComplete(data[0], data[_PARAM], *_LE_ENHANCED_CONNECTION_COMPLETE.unpack_from(data, _PARAM + 1))
+
+
+def decode_le_connection_update_complete(data: bytes):
+    return LeConnectionUpdateComplete(data[0], data[_PARAM], *_LE_CONNECTION_UPDATE_COMPLETE.unpack_from(data, _PARAM + 1))
+
+
+def decode_le_advertising_report(data: bytes):
+    view = memoryview(data)
+    unpack_from = _ADVERTISING_REPORT.unpack_from
+    num_reports = data[_PARAM + 1]
+    offset = _PARAM + 2
+    reports = []
+    for _ in range(num_reports):
+        event_type, address_type, address, length = unpack_from(data, offset)
+        offset += _ADVERTISING_REPORT.size
+        rssi = _RSSI.unpack_from(data, offset + length)[0]
+        reports.append(AdvertisingReport(event_type, address_type, address, view[offset : offset + length], rssi))
+        offset += length + 1
+    return LeAdvertisingReport(data[0], data[_PARAM], reports)
+
+
+def decode_le_extended_advertising_report(data: bytes):
+    view = memoryview(data)
+    unpack_from = _EXTENDED_ADVERTISING_REPORT.unpack_from
+    num_reports = data[_PARAM + 1]
+    offset = _PARAM + 2
+    reports = []
+    for _ in range(num_reports):
+        fields = unpack_from(data, offset)
+        offset += _EXTENDED_ADVERTISING_REPORT.size
+        length = fields[-1]
+        reports.append(ExtendedAdvertisingReport(*fields[:-1], view[offset : offset + length]))
+        offset += length
+    return LeAdvertisingReport(data[0], data[_PARAM], reports)
+
+
+def decode_event(data: bytes):
+    """
+    decode a HCI event packet into a record
+
+    Every event/subevent has one precompiled struct.Struct, fields are read
+    with unpack_from at their offset in the packet without intermediate
+    slices. The record fields use the attribute names of the HciEvent classes
+    in hci_evt, so event callbacks can read either. Raises ValueError or
+    struct.error on malformed packets.
+    """
+    if len(data) < 2 or len(data) < 2 + data[1]:
+        raise ValueError("data too short")
+    decoder = hci_evt_decoders.get(data[0])
+    if decoder is None:
+        return RawEvent(data[0], memoryview(data)[_PARAM : _PARAM + data[1]])
+    return decoder(data)
+
+
+hci_evt_decoders = {
+    HciEventDisconnectionComplete.EVENT_CODE: decode_disconnection_complete,
+    ENCRYPTION_CHANGE: decode_encryption_change,
+    HciEventCommandComplete.EVENT_CODE: decode_command_complete,
+    HciEventCommandStatus.EVENT_CODE: decode_command_status,
+    HciEventNumberOfCompletedPackets.EVENT_CODE: decode_number_of_completed_packets,
+    ENCRYPTION_KEY_REFRESH_COMPLETE: decode_encryption_key_refresh_complete,
+    HciEventLeMeta.EVENT_CODE: decode_le_meta,
+}
+
+hci_evt_le_decoders = {
+    HciEventLeConnectionComplete.SUBEVENT_CODE: decode_le_connection_complete,
+    LE_ADVERTISING_REPORT: decode_le_advertising_report,
+    HciEventLeConnectionUpdateComplete.SUBEVENT_CODE: decode_le_connection_update_complete,
+    LE_ENHANCED_CONNECTION_COMPLETE: decode_le_enhanced_connection_complete,
+    LE_EXTENDED_ADVERTISING_REPORT: decode_le_extended_advertising_report,
+}
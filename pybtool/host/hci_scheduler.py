@@ -0,0 +1,240 @@
+import logging
+import struct
+import threading
+from collections import deque
+from concurrent.futures import Future
+from .hci_def import HCI_OPCODE
+
+logger = logging.getLogger(__name__)
+
+
+class HciCommandScheduler:
+    """
+    HCI command scheduler
+
+    Tracks the command credits granted by the controller in the
+    num_hci_cmd_packets field of Command Complete/Command Status events and
+    pipelines queued commands up to that window. Responses are matched to
+    pending commands by opcode, oldest first.
+    """
+
+    def __init__(self, send: callable):
+        """
+        send: send(data) writes a packed command to the controller
+        """
+        self.send = send
+        # the host may send one command after power on / reset
+        self.credits = 1
+        # (opcode, data, future, expect_evt) not yet sent to the controller
+        self.queue = deque()
+        # opcode -> deque of (future, expect_evt) sent and waiting for response
+        self.pending = {}
+        # no command may be sent while HCI_Reset is outstanding
+        self.reset_pending = False
+        self.lock = threading.RLock()
+
+    def submit(self, opcode: int, data: bytes, expect_evt) -> Future:
+        """
+        queue a command, the returned future resolves to the response event
+        """
+        future = Future()
+        with self.lock:
+            self.queue.append((opcode, data, future, expect_evt))
+            self._pump()
+        return future
+
+    def cancel(self, opcode: int, future: Future):
+        """
+        drop a command whose caller gave up waiting
+        """
+        with self.lock:
+            for item in self.queue:
+                if item[2] is future:
+                    self.queue.remove(item)
+                    break
+            else:
+                pending = self.pending.get(opcode)
+                if pending:
+                    for item in pending:
+                        if item[0] is future:
+                            pending.remove(item)
+                            break
+                    if not pending:
+                        del self.pending[opcode]
+                    # the controller never answered, assume the slot is free again
+                    if opcode == HCI_OPCODE.HCI_CMD_RESET:
+                        self.reset_pending = False
+                    self.credits = max(self.credits, 1)
+            future.cancel()
+            self._pump()
+
+    def complete(self, evt, evt_data: bytes):
+        """
+        handle a Command Complete/Command Status event
+        """
+        item = None
+        with self.lock:
+            self.credits = evt.num_hci_cmd_packets
+            pending = self.pending.get(evt.opcode)
+            if pending:
+                item = pending.popleft()
+                if not pending:
+                    del self.pending[evt.opcode]
+            if evt.opcode == HCI_OPCODE.HCI_CMD_RESET:
+                self.reset_pending = False
+        if item is not None:
+            future, expect_evt = item
+            if expect_evt.EVENT_CODE != evt.event_code:
+                # e.g. Command Status with an error for a command expecting Command Complete
+                expect_evt = evt
+            else:
+                expect_evt.unpack(evt_data)
+            if future.set_running_or_notify_cancel():
+                future.set_result(expect_evt)
+        with self.lock:
+            self._pump()
+
+    def _pump(self):
+        while self.queue and self.credits > 0 and not self.reset_pending:
+            opcode, data, future, expect_evt = self.queue.popleft()
+            if future.cancelled():
+                continue
+            self.credits -= 1
+            if opcode == HCI_OPCODE.HCI_CMD_RESET:
+                self.reset_pending = True
+            self.pending.setdefault(opcode, deque()).append((future, expect_evt))
+            try:
+                self.send(data)
+            except Exception as e:
+                self.pending[opcode].remove((future, expect_evt))
+                if not self.pending[opcode]:
+                    del self.pending[opcode]
+                if opcode == HCI_OPCODE.HCI_CMD_RESET:
+                    self.reset_pending = False
+                self.credits += 1
+                future.set_exception(e)
+
+
+class HciAclScheduler:
+    """
+    HCI ACL scheduler
+
+    Host side ACL flow control: keeps the controller buffer credits read with
+    HCI_Read_Buffer_Size/HCI_LE_Read_Buffer_Size, takes them back from Number
+    Of Completed Packets events and fragments outgoing PDUs to the controller
+    ACL MTU. Queued packets are sent round-robin across connection handles,
+    all the packets the credits allow are handed to the transport at once.
+    Until set_buffer_size is called packets are sent without accounting.
+    """
+
+    # packet boundary flag
+    PB_FIRST_NON_FLUSHABLE = 0b00
+    PB_CONTINUING = 0b01
+    PB_FIRST_FLUSHABLE = 0b10
+
+    def __init__(self, send: callable):
+        """
+        send: send(packets) writes a list of complete ACL packets to the controller
+        """
+        self.send = send
+        # LE minimum ACL data length
+        self.acl_mtu = 27
+        self.total_num_acl_packets = 0
+        self.credits = 0
+        self.flow_control = False
+        # connection handle -> deque of ACL packets
+        self.queues = {}
+        # connection handles with queued packets, in round-robin order
+        self.ready = deque()
+        # connection handle -> packets sent and not yet completed
+        self.in_flight = {}
+        self.lock = threading.RLock()
+
+    def set_buffer_size(self, acl_mtu: int, total_num_acl_packets: int):
+        with self.lock:
+            self.acl_mtu = acl_mtu
+            self.total_num_acl_packets = total_num_acl_packets
+            self.credits = total_num_acl_packets - sum(self.in_flight.values())
+            self.flow_control = True
+            self._pump()
+
+    def send_pdu(self, connection_handle: int, pdu: bytes):
+        """
+        fragment a L2CAP PDU to the ACL MTU and queue the fragments
+        """
+        pdu = memoryview(pdu)
+        with self.lock:
+            queue = self.queues.get(connection_handle)
+            if queue is None:
+                queue = self.queues[connection_handle] = deque()
+            pb = self.PB_FIRST_NON_FLUSHABLE
+            for offset in range(0, max(len(pdu), 1), self.acl_mtu):
+                fragment = pdu[offset : offset + self.acl_mtu]
+                header = struct.pack("<HH", connection_handle | (pb << 12), len(fragment))
+                queue.append(header + fragment)
+                pb = self.PB_CONTINUING
+            self._schedule(connection_handle)
+
+    def send_packet(self, data: bytes):
+        """
+        queue a complete ACL packet (header included)
+        """
+        connection_handle = struct.unpack("<H", data[:2])[0] & 0x0FFF
+        with self.lock:
+            self.queues.setdefault(connection_handle, deque()).append(data)
+            self._schedule(connection_handle)
+
+    def pending(self, connection_handle: int) -> int:
+        """
+        number of packets queued and not yet sent for a connection
+        """
+        queue = self.queues.get(connection_handle)
+        return len(queue) if queue else 0
+
+    def completed(self, connection_handle: int, num_completed_packets: int):
+        """
+        handle one entry of a Number Of Completed Packets event
+        """
+        with self.lock:
+            in_flight = self.in_flight.get(connection_handle, 0)
+            num = min(num_completed_packets, in_flight)
+            if num < num_completed_packets:
+                logger.warning(f"acl handle:0x{connection_handle:04X} completed {num_completed_packets} packets, {in_flight} in flight")
+            if in_flight - num:
+                self.in_flight[connection_handle] = in_flight - num
+            else:
+                self.in_flight.pop(connection_handle, None)
+            self.credits += num
+            self._pump()
+
+    def disconnected(self, connection_handle: int):
+        """
+        the controller flushes the packets of a closed connection, take their credits back
+        """
+        with self.lock:
+            self.credits += self.in_flight.pop(connection_handle, 0)
+            self.queues.pop(connection_handle, None)
+            if connection_handle in self.ready:
+                self.ready.remove(connection_handle)
+            self._pump()
+
+    def _schedule(self, connection_handle: int):
+        if connection_handle not in self.ready:
+            self.ready.append(connection_handle)
+        self._pump()
+
+    def _pump(self):
+        packets = []
+        while self.ready and (self.credits > 0 or not self.flow_control):
+            connection_handle = self.ready.popleft()
+            queue = self.queues[connection_handle]
+            packets.append(queue.popleft())
+            if queue:
+                self.ready.append(connection_handle)
+            else:
+                del self.queues[connection_handle]
+            if self.flow_control:
+                self.credits -= 1
+                self.in_flight[connection_handle] = self.in_flight.get(connection_handle, 0) + 1
+        if packets:
+            self.send(packets)
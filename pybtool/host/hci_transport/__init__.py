@@ -1,2 +1,4 @@
 from .uart_interface import uart_interface
-from .usb_interface import usb_interface
\ No newline at end of file
+from .usb_interface import usb_interface
+from .replay_interface import replay_interface
+from .loopback_interface import loopback_interface
@@ -0,0 +1,231 @@
+import heapq
+import itertools
+import logging
+import struct
+import threading
+import time
+from .transport import HCIInterface, Device
+from ..hci_def import HCI_OPCODE
+
+logger = logging.getLogger(__name__)
+
+
+class loopback_interface(HCIInterface):
+    """
+    in-process virtual controller
+
+    Answers the hci_init_cmds table, advertising/scanning commands and LE
+    connection setup, and sinks or echoes ACL data after a configurable
+    latency. It owns acl_buffers ACL buffers and returns them with Number Of
+    Completed Packets events, packets sent beyond the free buffers are
+    counted in acl_overflows. Used to benchmark HCI/L2CAP/ATT without a
+    Bluetooth dongle.
+
+    acl_mode: "sink" drops the received ACL data, "echo" sends it back on the same connection
+    """
+
+    EVT_DISCONNECTION_COMPLETE = 0x05
+    EVT_COMMAND_COMPLETE = 0x0E
+    EVT_COMMAND_STATUS = 0x0F
+    EVT_NUMBER_OF_COMPLETED_PACKETS = 0x13
+    EVT_LE_META = 0x3E
+    SUBEVT_LE_CONNECTION_COMPLETE = 0x01
+
+    def __init__(
+        self,
+        bd_addr: bytes = bytes([0x01, 0x00, 0x00, 0xBA, 0xB7, 0x00]),
+        acl_mtu: int = 251,
+        acl_buffers: int = 8,
+        latency: float = 0,
+        acl_mode: str = "sink",
+        num_hci_cmd_packets: int = 1,
+    ):
+        self.bd_addr = bd_addr
+        self.acl_mtu = acl_mtu
+        self.acl_buffers = acl_buffers
+        self.latency = latency
+        self.acl_mode = acl_mode
+        self.num_hci_cmd_packets = num_hci_cmd_packets
+        self.event_callbacks = []
+        self.acl_callbacks = []
+        self.running = False
+        self.worker = None
+        # (due time, seq, callbacks, packet, done)
+        self.deliveries = []
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.next_handle = 0x0040
+        # connection handle -> peer address
+        self.connections = {}
+        self.advertising = False
+        self.acl_in_use = 0
+        self.acl_overflows = 0
+        self.acl_packets_received = 0
+        self.acl_bytes_received = 0
+        self.commands = {
+            HCI_OPCODE.HCI_CMD_READ_LOCAL_NAME: lambda p: b"btool loopback".ljust(248, b"\0"),
+            HCI_OPCODE.HCI_CMD_READ_BD_ADDR: lambda p: self.bd_addr,
+            HCI_OPCODE.HCI_CMD_READ_BUFFER_SIZE: lambda p: struct.pack("<HBHH", self.acl_mtu, 0, self.acl_buffers, 0),
+            HCI_OPCODE.HCI_CMD_LE_READ_BUFFER_SIZE: lambda p: struct.pack("<HB", self.acl_mtu, self.acl_buffers),
+            HCI_OPCODE.HCI_CMD_READ_LOCAL_VERSION_INFO: lambda p: struct.pack("<BHBHH", 0x0D, 0, 0x0D, 0xFFFF, 0),
+            HCI_OPCODE.HCI_CMD_READ_LOCAL_SUPPORTED_COMMANDS: lambda p: bytes([0xFF] * 64),
+            HCI_OPCODE.HCI_CMD_READ_LOCAL_SUPPORTED_FEATURES: lambda p: bytes([0xFF] * 8),
+            HCI_OPCODE.HCI_CMD_LE_READ_LOCAL_SUPPORTED_FEATURES: lambda p: bytes([0xFF, 0xFF, 0, 0, 0, 0, 0, 0]),
+            HCI_OPCODE.HCI_CMD_LE_SET_ADVERTISING_ENABLE: self._set_advertising_enable,
+            HCI_OPCODE.HCI_CMD_LE_CREATE_CONNECTION: self._le_create_connection,
+            HCI_OPCODE.HCI_CMD_DISCONNECT: self._disconnect,
+        }
+        # commands only acknowledged with success
+        self.accepted = {
+            HCI_OPCODE.HCI_CMD_RESET,
+            HCI_OPCODE.HCI_CMD_SET_EVENT_MASK,
+            HCI_OPCODE.HCI_CMD_LE_SET_EVENT_MASK,
+            HCI_OPCODE.HCI_CMD_LE_SET_ADVERTISING_PARAMETERS,
+            HCI_OPCODE.HCI_CMD_LE_SET_ADVERTISING_DATA,
+            HCI_OPCODE.HCI_CMD_LE_SET_SCAN_RESPONSE_DATA,
+            HCI_OPCODE.HCI_CMD_LE_SET_SCAN_PARAMETERS,
+            HCI_OPCODE.HCI_CMD_LE_SET_SCAN_ENABLE,
+        }
+
+    @property
+    def name(self):
+        return "loopback"
+
+    def list_devices(self):
+        return [Device("loopback", 0, 0)]
+
+    def open(self, device: Device = None):
+        self.running = True
+        self.worker = threading.Thread(target=self._deliver_loop, daemon=True)
+        self.worker.start()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.worker:
+            self.worker.join()
+            self.worker = None
+
+    def register_event(self, cb: callable):
+        """
+        注册事件回调函数
+        """
+        if cb not in self.event_callbacks:
+            self.event_callbacks.append(cb)
+
+    def register_acl(self, cb: callable):
+        """
+        注册 ACL 数据回调函数
+        """
+        if cb not in self.acl_callbacks:
+            self.acl_callbacks.append(cb)
+
+    def send_command(self, cmd: bytes):
+        opcode, length = struct.unpack_from("<HB", cmd)
+        param = cmd[3 : 3 + length]
+        if opcode in self.commands:
+            ret = self.commands[opcode](param)
+            if ret is not None:
+                self._command_complete(opcode, ret)
+        elif opcode in self.accepted:
+            self._command_complete(opcode)
+        else:
+            logger.warning(f"loopback unknown command opcode:0x{opcode:04X}")
+            self._command_complete(opcode, status=0x01)
+
+    def send_acl(self, data: bytes):
+        _connection_handle, length = struct.unpack_from("<HH", data)
+        connection_handle = _connection_handle & 0x0FFF
+        with self.condition:
+            if self.acl_in_use >= self.acl_buffers:
+                self.acl_overflows += 1
+            self.acl_in_use += 1
+            self.acl_packets_received += 1
+            self.acl_bytes_received += length
+        if self.acl_mode == "echo" and connection_handle in self.connections:
+            pb = (_connection_handle >> 12) & 0x03
+            if pb == 0b00:
+                # controller to host start fragment
+                pb = 0b10
+            self._deliver(self.acl_callbacks, struct.pack("<H", connection_handle | (pb << 12)) + data[2:])
+        self._deliver(self.event_callbacks, struct.pack("<BBBHH", self.EVT_NUMBER_OF_COMPLETED_PACKETS, 5, 1, connection_handle, 1), self._acl_completed)
+
+    def connect(self, peer_addr: bytes = bytes([0x06, 0x05, 0x04, 0x03, 0x02, 0x01]), role: int = 0x01, interval: int = 0x0018, latency: int = 0, timeout: int = 0x0048) -> int:
+        """
+        simulate a peer connecting, role 0x01 peripheral (we were advertising), 0x00 central
+
+        return the connection handle
+        """
+        connection_handle = self.next_handle
+        self.next_handle += 1
+        self.connections[connection_handle] = peer_addr
+        self.advertising = False
+        param = struct.pack(
+            "<BBHBB6sHHHB", self.SUBEVT_LE_CONNECTION_COMPLETE, 0, connection_handle, role, 0, peer_addr, interval, latency, timeout, 0
+        )
+        self._deliver(self.event_callbacks, bytes([self.EVT_LE_META, len(param)]) + param)
+        return connection_handle
+
+    def disconnect(self, connection_handle: int, reason: int = 0x13):
+        """
+        simulate the peer closing the connection
+        """
+        self.connections.pop(connection_handle, None)
+        self._deliver(self.event_callbacks, struct.pack("<BBBHB", self.EVT_DISCONNECTION_COMPLETE, 4, 0, connection_handle, reason))
+
+    def inject_acl(self, connection_handle: int, data: bytes, pb: int = 0b10):
+        """
+        deliver ACL data from the peer
+        """
+        self._deliver(self.acl_callbacks, struct.pack("<HH", connection_handle | (pb << 12), len(data)) + data)
+
+    def _acl_completed(self):
+        with self.condition:
+            self.acl_in_use -= 1
+
+    def _command_complete(self, opcode: int, ret: bytes = b"", status: int = 0):
+        param = struct.pack("<BHB", self.num_hci_cmd_packets, opcode, status) + ret
+        self._deliver(self.event_callbacks, bytes([self.EVT_COMMAND_COMPLETE, len(param)]) + param)
+
+    def _command_status(self, opcode: int, status: int = 0):
+        param = struct.pack("<BBH", status, self.num_hci_cmd_packets, opcode)
+        self._deliver(self.event_callbacks, bytes([self.EVT_COMMAND_STATUS, len(param)]) + param)
+
+    def _set_advertising_enable(self, param: bytes):
+        self.advertising = bool(param[0])
+        return b""
+
+    def _le_create_connection(self, param: bytes):
+        peer_addr = bytes(param[6:12])
+        interval, latency, timeout = struct.unpack_from("<HHH", param, 15)
+        self._command_status(HCI_OPCODE.HCI_CMD_LE_CREATE_CONNECTION)
+        self.connect(peer_addr, 0x00, interval, latency, timeout)
+
+    def _disconnect(self, param: bytes):
+        connection_handle, reason = struct.unpack_from("<HB", param)
+        if connection_handle not in self.connections:
+            self._command_status(HCI_OPCODE.HCI_CMD_DISCONNECT, status=0x02)
+            return
+        self._command_status(HCI_OPCODE.HCI_CMD_DISCONNECT)
+        self.connections.pop(connection_handle)
+        self._deliver(self.event_callbacks, struct.pack("<BBBHB", self.EVT_DISCONNECTION_COMPLETE, 4, 0, connection_handle, 0x16))
+
+    def _deliver(self, callbacks: list, packet: bytes, done: callable = None):
+        with self.condition:
+            heapq.heappush(self.deliveries, (time.perf_counter() + self.latency, next(self.seq), callbacks, packet, done))
+            self.condition.notify()
+
+    def _deliver_loop(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.deliveries or self.deliveries[0][0] > time.perf_counter()):
+                    timeout = self.deliveries[0][0] - time.perf_counter() if self.deliveries else None
+                    self.condition.wait(timeout)
+                if not self.running:
+                    return
+                _, _, callbacks, packet, done = heapq.heappop(self.deliveries)
+            if done is not None:
+                done()
+            for cb in callbacks:
+                cb(packet)
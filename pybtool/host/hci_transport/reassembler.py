@@ -0,0 +1,141 @@
+import logging
+import struct
+from ..hci_def import HCI_TYPE
+
+logger = logging.getLogger(__name__)
+
+
+class HciPacketReassembler:
+    """
+    streaming HCI packet reassembler
+
+    Collects the chunks read from a transport into one preallocated buffer,
+    driven by the length field of the packet header, and calls
+    callback(packet) for every complete packet only. Packets that arrive
+    whole in a chunk are sliced out without going through the buffer.
+    """
+
+    def __init__(self, header_size: int, length_offset: int, length_format: str, length_mask: int, max_size: int, callback: callable):
+        self.header_size = header_size
+        self.length = struct.Struct(length_format)
+        self.length_offset = length_offset
+        self.length_mask = length_mask
+        self.buffer = bytearray(max_size)
+        self.view = memoryview(self.buffer)
+        self.callback = callback
+        self.size = 0
+        self.expected = header_size
+
+    @classmethod
+    def event(cls, callback: callable):
+        """
+        |event code|Parameter Total Length(1)|Event Parameter|
+        """
+        return cls(2, 1, "<B", 0xFF, 2 + 0xFF, callback)
+
+    @classmethod
+    def acl(cls, callback: callable):
+        """
+        |Handle|PB|BC|Data Total Length(2)|Data|
+        """
+        return cls(4, 2, "<H", 0xFFFF, 4 + 0xFFFF, callback)
+
+    @classmethod
+    def sco(cls, callback: callable):
+        """
+        |Handle|Packet Status|Data Total Length(1)|Data|
+        """
+        return cls(3, 2, "<B", 0xFF, 3 + 0xFF, callback)
+
+    @classmethod
+    def iso(cls, callback: callable):
+        """
+        |Handle|PB|TS|Data Total Length(14 bits)|Data|
+        """
+        return cls(4, 2, "<H", 0x3FFF, 4 + 0x3FFF, callback)
+
+    def reset(self):
+        self.size = 0
+        self.expected = self.header_size
+
+    def _packet_size(self, data, offset: int) -> int:
+        return self.header_size + (self.length.unpack_from(data, offset + self.length_offset)[0] & self.length_mask)
+
+    def feed(self, data: bytes):
+        """
+        feed a chunk read from the transport
+        """
+        data = memoryview(data)
+        end = len(data)
+        pos = 0
+        while pos < end:
+            pos, _ = self.consume(data, pos, end)
+
+    def consume(self, data: memoryview, pos: int, end: int):
+        """
+        consume data[pos:end] up to the end of the current packet
+
+        return (new pos, True if a packet was completed)
+        """
+        if self.size == 0 and end - pos >= self.header_size:
+            # fast path, the whole packet may be in this chunk
+            packet_size = self._packet_size(data, pos)
+            if end - pos >= packet_size:
+                self.callback(bytes(data[pos : pos + packet_size]))
+                return pos + packet_size, True
+        n = min(self.expected - self.size, end - pos)
+        self.view[self.size : self.size + n] = data[pos : pos + n]
+        self.size += n
+        pos += n
+        if self.size == self.header_size:
+            self.expected = self._packet_size(self.buffer, 0)
+        if self.size == self.expected:
+            self.callback(bytes(self.view[: self.size]))
+            self.reset()
+            return pos, True
+        return pos, False
+
+
+class H4Demux:
+    """
+    H4 (UART) stream demultiplexer
+
+    |packet type(1)|HCI packet|, the packet type selects the reassembler
+    the following bytes are fed to until its packet is complete.
+    """
+
+    def __init__(self, event_callback: callable, acl_callback: callable, sco_callback: callable = None, iso_callback: callable = None):
+        self.reassemblers = {
+            HCI_TYPE.HCI_EVT: HciPacketReassembler.event(event_callback),
+            HCI_TYPE.HCI_ACL: HciPacketReassembler.acl(acl_callback),
+        }
+        if sco_callback is not None:
+            self.reassemblers[HCI_TYPE.HCI_SCO] = HciPacketReassembler.sco(sco_callback)
+        if iso_callback is not None:
+            self.reassemblers[HCI_TYPE.HCI_IOS] = HciPacketReassembler.iso(iso_callback)
+        self.current = None
+
+    def reset(self):
+        for r in self.reassemblers.values():
+            r.reset()
+        self.current = None
+
+    def feed(self, data: bytes):
+        """
+        feed a chunk read from the uart
+        """
+        data = memoryview(data)
+        end = len(data)
+        pos = 0
+        while pos < end:
+            if self.current is None:
+                packet_type = data[pos]
+                pos += 1
+                self.current = self.reassemblers.get(packet_type)
+                if self.current is None:
+                    # out of sync, skip until a known packet type
+                    logger.error(f"h4 unknown packet type:0x{packet_type:02X}")
+                    continue
+            pos, done = self.current.consume(data, pos, end)
+            if done:
+                self.current = None
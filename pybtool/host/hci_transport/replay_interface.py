@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+import time
+from .transport import HCIInterface, Device
+from ..hci_btsnoop import BTSnoopReader
+from ..hci_def import HCI_TYPE
+
+logger = logging.getLogger(__name__)
+
+
+class replay_interface(HCIInterface):
+    """
+    btsnoop replay transport
+
+    Plays the controller to host packets of a btsnoop capture into the
+    registered event/ACL callbacks, so HCI, L2CAP and ATT run without a
+    controller. Host to controller records are used as checkpoints: playback
+    waits until the host sends the next packet and, with verify, compares it
+    to the recorded one, differences are collected in mismatches.
+
+    realtime: pace the packets with the capture timestamps divided by speed,
+    otherwise play at maximum speed.
+    """
+
+    def __init__(self, file: str, realtime: bool = False, speed: float = 1.0, verify: bool = True, timeout: float = 5.0):
+        self.file = file
+        self.realtime = realtime
+        self.speed = speed
+        self.verify = verify
+        self.timeout = timeout
+        self.reader = None
+        self.running = False
+        self.replay_thread = None
+        self.event_callbacks = []
+        self.acl_callbacks = []
+        # packets sent by the host, (HCI_TYPE, data)
+        self.host_packets = queue.Queue()
+        # (record number, expected packet, actual packet), None when missing
+        self.mismatches = []
+        self.packets_replayed = 0
+        self.done = threading.Event()
+
+    @property
+    def name(self):
+        return "replay " + self.file
+
+    def list_devices(self):
+        return [Device(self.file, 0, 0)]
+
+    def open(self, device: Device = None):
+        if device is not None:
+            self.file = device.name
+        self.reader = BTSnoopReader(self.file)
+        self.done.clear()
+        self.running = True
+        self.replay_thread = threading.Thread(target=self._replay_loop, daemon=True)
+        self.replay_thread.start()
+
+    def close(self):
+        self.running = False
+        if self.replay_thread:
+            self.replay_thread.join()
+            self.replay_thread = None
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        wait until the whole capture is played
+        """
+        return self.done.wait(timeout)
+
+    def send_command(self, cmd: bytes):
+        self.host_packets.put((HCI_TYPE.HCI_CMD, cmd))
+
+    def send_acl(self, data: bytes):
+        self.host_packets.put((HCI_TYPE.HCI_ACL, data))
+
+    def register_event(self, cb: callable):
+        """
+        注册事件回调函数
+        """
+        if cb not in self.event_callbacks:
+            self.event_callbacks.append(cb)
+
+    def register_acl(self, cb: callable):
+        """
+        注册 ACL 数据回调函数
+        """
+        if cb not in self.acl_callbacks:
+            self.acl_callbacks.append(cb)
+
+    def _check_host_packet(self, n: int, expected: bytes):
+        try:
+            packet_type, data = self.host_packets.get(timeout=self.timeout)
+        except queue.Empty:
+            logger.warning(f"replay record {n}: host packet missing, expected {expected.hex()}")
+            self.mismatches.append((n, expected, None))
+            return
+        actual = bytes([packet_type]) + data
+        if actual != expected:
+            logger.warning(f"replay record {n}: host packet {actual.hex()}, expected {expected.hex()}")
+            self.mismatches.append((n, expected, actual))
+
+    def _replay_loop(self):
+        start = time.perf_counter()
+        first_timestamp = None
+        try:
+            for n, record in enumerate(self.reader):
+                if not self.running:
+                    break
+                packet = bytes(record.data)
+                if not BTSnoopReader.is_received(record):
+                    if self.verify:
+                        self._check_host_packet(n, packet)
+                    continue
+                if self.realtime:
+                    if first_timestamp is None:
+                        first_timestamp = record.timestamp
+                    delay = (record.timestamp - first_timestamp) / 1e6 / self.speed - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                if packet[0] == HCI_TYPE.HCI_EVT:
+                    callbacks = self.event_callbacks
+                elif packet[0] == HCI_TYPE.HCI_ACL:
+                    callbacks = self.acl_callbacks
+                else:
+                    continue
+                for cb in callbacks:
+                    cb(packet[1:])
+                self.packets_replayed += 1
+            # release the view into the mapped file
+            record = None
+        finally:
+            self.done.set()
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from ..hci_def import HCI_TYPE
 
 @dataclass
 class Device(object):
@@ -57,3 +58,20 @@ class HCIInterface(ABC):
         register event callback
         '''
         pass
+
+    @abstractmethod
+    def register_acl(self, cb: callable):
+        '''
+        register acl callback
+        '''
+        pass
+
+    def send_packets(self, packets: list):
+        '''
+        send several packets at once, packets: list of (HCI_TYPE, data)
+        '''
+        for packet_type, data in packets:
+            if packet_type == HCI_TYPE.HCI_CMD:
+                self.send_command(data)
+            else:
+                self.send_acl(data)
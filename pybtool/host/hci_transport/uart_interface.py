@@ -1,45 +1,136 @@
+import logging
+import threading
 import serial
 import serial.tools.list_ports
 from .transport import HCIInterface, Device
+from .reassembler import H4Demux
+from ..hci_def import HCI_TYPE
+
+logger = logging.getLogger(__name__)
 
 
 class uart_interface(HCIInterface):
-    def __init__(self):
-        self.port = "COM3"
-        self.baudrate = 115200
+    """
+    H4 UART transport
+
+    A reader thread pulls everything the port has buffered in one read and
+    the H4 demultiplexer reassembles complete events and ACL packets from
+    the stream. Baud rates up to 3-4 Mbps need RTS/CTS flow control.
+    """
+
+    # only bounds how long close() waits for the reader thread
+    READ_TIMEOUT = 0.1
+    READ_SIZE = 4096
+
+    def __init__(self, port: str = "COM3", baudrate: int = 115200, rtscts: bool = False):
+        self.port = port
+        self.baudrate = baudrate
+        self.rtscts = rtscts
         self.serial = None
+        self.running = False
+        self.receive_thread = None
+        self.write_lock = threading.Lock()
+        self.event_callbacks = []
+        self.acl_callbacks = []
+        self.demux = H4Demux(self._dispatch(self.event_callbacks), self._dispatch(self.acl_callbacks))
 
     def list_devices(self):
-        return serial.tools.list_ports.comports()
+        return [Device(p.device, p.vid or 0, p.pid or 0) for p in serial.tools.list_ports.comports()]
 
     @property
     def name(self):
-        return 'uart ' + self.port + " " + str(self.baudrate)
+        return 'uart ' + self.port + " " + str(self.baudrate) + (" rtscts" if self.rtscts else "")
 
     def open(self, device: Device = None):
-        self.serial = serial.Serial(device.name, self.baudrate)
+        if device is not None:
+            self.port = device.name
+        self.serial = serial.Serial(self.port, self.baudrate, rtscts=self.rtscts, timeout=self.READ_TIMEOUT)
+        self.demux.reset()
+
+        # 启动接收线程
+        self.running = True
+        self.receive_thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self.receive_thread.start()
 
     def close(self):
+        self.running = False
+        if self.receive_thread:
+            self.receive_thread.join()
+            self.receive_thread = None
         if self.serial:
             self.serial.close()
 
-    def send_command(self, cmd:bytes):
-        if self.serial:
-            self.serial.write(cmd)
+    def send_command(self, cmd: bytes):
+        self.send_packets([(HCI_TYPE.HCI_CMD, cmd)])
 
-    def receive_event(self):
+    def send_acl(self, data: bytes):
+        self.send_packets([(HCI_TYPE.HCI_ACL, data)])
+
+    def send_packets(self, packets: list):
+        """
+        frame the packets with their H4 packet type and write them in one call
+        """
         if self.serial:
-            return self.serial.read()
-        return None
+            data = b"".join([bytes([packet_type]) + packet for packet_type, packet in packets])
+            with self.write_lock:
+                self.serial.write(data)
+
+    def register_event(self, cb: callable):
+        """
+        注册事件回调函数
+        """
+        if cb not in self.event_callbacks:
+            self.event_callbacks.append(cb)
+
+    def unregister_event(self, cb: callable):
+        """
+        取消注册事件回调函数
+        """
+        if cb in self.event_callbacks:
+            self.event_callbacks.remove(cb)
+
+    def register_acl(self, cb: callable):
+        """
+        注册 ACL 数据回调函数
+        """
+        if cb not in self.acl_callbacks:
+            self.acl_callbacks.append(cb)
+
+    def unregister_acl(self, cb: callable):
+        """
+        取消注册 ACL 数据回调函数
+        """
+        if cb in self.acl_callbacks:
+            self.acl_callbacks.remove(cb)
+
+    @staticmethod
+    def _dispatch(callbacks: list) -> callable:
+        def dispatch(data: bytes):
+            for cb in callbacks:
+                cb(data)
+
+        return dispatch
+
+    def _receive_loop(self):
+        while self.running:
+            try:
+                # 阻塞等待第一个字节, 然后一次读出缓冲区中的所有数据
+                data = self.serial.read(min(max(self.serial.in_waiting, 1), self.READ_SIZE))
+                if data:
+                    self.demux.feed(data)
+            except serial.SerialException as e:
+                logger.error(f"UART Error: {e}")
+                break
 
 
 if __name__ == "__main__":
+    from ..hci_cmd import HciCmdReset
+
     hci = uart_interface()
+    hci.register_event(lambda evt: print("recv evt:" + " ".join([hex(i) for i in evt])))
     hci.open(Device(name="COM3", vid=0x0BDA, pid=0xC123))
     print(f"hci open {hci.name}")
-    cmd = bytes.fromhex("010c0300")
+    cmd = HciCmdReset().pack()
     hci.send_command(cmd)
     print("send cmd:" + " ".join([hex(i) for i in cmd]))
-    evt = hci.receive_event()
-    print("recv evt:" + " ".join([hex(i) for i in evt]))
     hci.close()
@@ -4,6 +4,7 @@ import usb.backend.libusb1
 import libusb
 import threading
 from .transport import HCIInterface, Device
+from .reassembler import HciPacketReassembler
 
 backend = usb.backend.libusb1.get_backend(find_library=lambda x: "libusb-1.0.dll")
 
@@ -16,12 +17,17 @@ class usb_interface(HCIInterface):
     USB_HCI_CMD_W_ENDP = 0x00  # control - use controlMsg method
     USB_HCI_INT_R_ENDP = 0x81  # interrupt
 
+    EVT_READ_SIZE = 256
+    ACL_READ_SIZE = 1024
+    # only bounds how long close() waits for the reader threads
+    READ_TIMEOUT = 100
+
     def __init__(self):
         self.vendor_id = 0
         self.product_id = 0
         self.device = None
         self.running = False
-        self.receive_thread = None
+        self.receive_threads = []
         self.event_callbacks = []
         self.acl_callbacks = []
 
@@ -51,16 +57,36 @@ class usb_interface(HCIInterface):
             raise ValueError("Device not found")
         self.device.set_configuration()
 
-        # 启动接收线程
+        # 启动接收线程, 事件和 ACL 端点各一个, 互不阻塞
         self.running = True
-        self.receive_thread = threading.Thread(target=self._receive_loop,daemon=True)
-        self.receive_thread.start()
-        
+        self.receive_threads = [
+            threading.Thread(
+                target=self._receive_loop,
+                args=(
+                    self.USB_HCI_INT_R_ENDP,
+                    self.EVT_READ_SIZE,
+                    HciPacketReassembler.event(self._dispatch(self.event_callbacks)),
+                ),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self._receive_loop,
+                args=(
+                    self.USB_HCI_ACL_R_ENDP,
+                    self.ACL_READ_SIZE,
+                    HciPacketReassembler.acl(self._dispatch(self.acl_callbacks)),
+                ),
+                daemon=True,
+            ),
+        ]
+        for t in self.receive_threads:
+            t.start()
 
     def close(self):
         self.running = False
-        if self.receive_thread:
-            self.receive_thread.join()
+        for t in self.receive_threads:
+            t.join()
+        self.receive_threads = []
         if self.device:
             usb.util.dispose_resources(self.device)
 
@@ -100,23 +126,28 @@ class usb_interface(HCIInterface):
         if cb in self.acl_callbacks:
             self.acl_callbacks.remove(cb)
 
-    def _receive_loop(self):
+    @staticmethod
+    def _dispatch(callbacks: list) -> callable:
+        def dispatch(data: bytes):
+            for cb in callbacks:
+                cb(data)
+
+        return dispatch
+
+    def _receive_loop(self, endpoint: int, size: int, reassembler: HciPacketReassembler):
+        """
+        read one endpoint, the reassembler dispatches every complete packet as soon as it lands
+        """
+        buffer = usb.util.create_buffer(size)
+        view = memoryview(buffer)
         while self.running:
             try:
-                # 读取 HCI 事件
-                evt = self.device.read(0x81, 256, 100)
-                if evt:
-                    evt_data = evt.tobytes()
-                    for cb in self.event_callbacks:
-                        cb(evt_data)
-
-                # 读取 ACL 数据
-                acl = self.device.read(0x82, 256, 100)
-                if acl:
-                    acl_data = acl.tobytes()
-                    for cb in self.acl_callbacks:
-                        cb(acl_data)
+                n = self.device.read(endpoint, buffer, self.READ_TIMEOUT)
+                if n:
+                    reassembler.feed(view[:n])
 
+            except usb.core.USBTimeoutError:
+                pass
             except usb.core.USBError as e:
                 if e.errno == 10060:  # 超时错误，可以忽略
                     pass
@@ -1,29 +1,305 @@
 import logging
 import struct
+import threading
+from enum import IntEnum
+from .connection import ConnectionEvent
+from .trace import get_tracer
 logger = logging.getLogger(__name__)
+tracer = get_tracer("l2cap")
+
+# max ATT_MTU is 517, room for the largest attribute value
+L2CAP_DEFAULT_MTU = 517
+
+# fixed channels
+L2CAP_CID_SIGNALING = 0x0001
+L2CAP_CID_ATT = 0x0004
+L2CAP_CID_LE_SIGNALING = 0x0005
+L2CAP_CID_SMP = 0x0006
+# LE dynamically allocated channels
+L2CAP_CID_DYNAMIC_FIRST = 0x0040
+L2CAP_CID_DYNAMIC_LAST = 0x007F
+
+PB_FIRST_NON_FLUSHABLE = 0b00
+PB_CONTINUING = 0b01
+PB_FIRST_FLUSHABLE = 0b10
+
+_ACL_HEADER = struct.Struct("<HH")
+_L2CAP_HEADER = struct.Struct("<HH")
+_SIGNALING_HEADER = struct.Struct("<BBH")
+
+
+class L2CAP_SIGNALING_CODE(IntEnum):
+    L2CAP_COMMAND_REJECT_RSP = 0x01
+    L2CAP_CONNECTION_REQ = 0x02
+    L2CAP_CONNECTION_RSP = 0x03
+    L2CAP_CONFIGURATION_REQ = 0x04
+    L2CAP_CONFIGURATION_RSP = 0x05
+    L2CAP_DISCONNECTION_REQ = 0x06
+    L2CAP_DISCONNECTION_RSP = 0x07
+    L2CAP_ECHO_REQ = 0x08
+    L2CAP_ECHO_RSP = 0x09
+    L2CAP_INFORMATION_REQ = 0x0A
+    L2CAP_INFORMATION_RSP = 0x0B
+    L2CAP_CONNECTION_PARAMETER_UPDATE_REQ = 0x12
+    L2CAP_CONNECTION_PARAMETER_UPDATE_RSP = 0x13
+    L2CAP_LE_CREDIT_BASED_CONNECTION_REQ = 0x14
+    L2CAP_LE_CREDIT_BASED_CONNECTION_RSP = 0x15
+    L2CAP_FLOW_CONTROL_CREDIT_IND = 0x16
+    L2CAP_CREDIT_BASED_CONNECTION_REQ = 0x17
+    L2CAP_CREDIT_BASED_CONNECTION_RSP = 0x18
+    L2CAP_CREDIT_BASED_RECONFIGURE_REQ = 0x19
+    L2CAP_CREDIT_BASED_RECONFIGURE_RSP = 0x1A
+
+
+# signaling commands that must not be answered with a command reject
+L2CAP_SIGNALING_NO_REJECT = {
+    L2CAP_SIGNALING_CODE.L2CAP_COMMAND_REJECT_RSP,
+    L2CAP_SIGNALING_CODE.L2CAP_CONNECTION_RSP,
+    L2CAP_SIGNALING_CODE.L2CAP_CONFIGURATION_RSP,
+    L2CAP_SIGNALING_CODE.L2CAP_DISCONNECTION_RSP,
+    L2CAP_SIGNALING_CODE.L2CAP_ECHO_RSP,
+    L2CAP_SIGNALING_CODE.L2CAP_INFORMATION_RSP,
+    L2CAP_SIGNALING_CODE.L2CAP_CONNECTION_PARAMETER_UPDATE_RSP,
+    L2CAP_SIGNALING_CODE.L2CAP_LE_CREDIT_BASED_CONNECTION_RSP,
+    L2CAP_SIGNALING_CODE.L2CAP_FLOW_CONTROL_CREDIT_IND,
+    L2CAP_SIGNALING_CODE.L2CAP_CREDIT_BASED_CONNECTION_RSP,
+    L2CAP_SIGNALING_CODE.L2CAP_CREDIT_BASED_RECONFIGURE_RSP,
+}
+
+L2CAP_REJECT_NOT_UNDERSTOOD = 0x0000
+L2CAP_REJECT_SIGNALING_MTU_EXCEEDED = 0x0001
+L2CAP_REJECT_INVALID_CID = 0x0002
+
+
+class L2capRecombiner:
+    """
+    recombination buffer of one connection
+
+    The start fragment and the continuations of a basic frame are copied into
+    a bytearray preallocated to the largest PDU accepted (4 + mtu), the
+    Basic L2CAP header gives the expected length.
+    """
+
+    __slots__ = ("buffer", "view", "size", "expected")
+
+    def __init__(self, mtu: int):
+        self.buffer = bytearray(_L2CAP_HEADER.size + mtu)
+        self.view = memoryview(self.buffer)
+        self.size = 0
+        # 0 until the L2CAP header is complete
+        self.expected = 0
+
+    def reset(self):
+        self.size = 0
+        self.expected = 0
+
+    def append(self, data) -> bool:
+        """
+        append a fragment, return False if the PDU overflows the buffer
+        """
+        end = self.size + len(data)
+        if end > len(self.buffer) or (self.expected and end > self.expected):
+            return False
+        self.view[self.size : end] = data
+        self.size = end
+        if not self.expected and end >= _L2CAP_HEADER.size:
+            self.expected = _L2CAP_HEADER.size + _L2CAP_HEADER.unpack_from(self.buffer, 0)[0]
+            if self.expected > len(self.buffer) or end > self.expected:
+                return False
+        return True
+
+    @property
+    def complete(self) -> bool:
+        return self.expected != 0 and self.size == self.expected
+
 
 class L2CAP:
-    def __init__(self, hci_interface):
+    """
+    L2CAP layer
+
+    Received ACL packets are recombined per connection handle following the
+    packet boundary flag: a start packet holding the whole PDU is dispatched
+    directly, fragmented PDUs go through a L2capRecombiner bounded by mtu.
+    Sent PDUs are fragmented to the controller ACL size by HCI.
+
+    PDUs are dispatched by CID: fixed channels (ATT, SMP, signaling) are
+    registered with register_channel, dynamic channels are allocated per
+    connection with allocate_cid. Both are dict lookups. The signaling
+    channels are handled here, commands are dispatched by code to the
+    handlers registered with register_signaling and unhandled requests are
+    answered with a command reject.
+    """
+
+    def __init__(self, hci_interface, mtu: int = L2CAP_DEFAULT_MTU):
+        """
+        mtu: largest L2CAP payload accepted, bigger PDUs are dropped
+        """
         self.hci = hci_interface
         self.hci.register_acl(self.acl_handler)
-        self.att_cb = None
+        self.mtu = mtu
+        # fixed cid -> callback(connection_handle, cid, payload)
+        self.channels = {
+            L2CAP_CID_SIGNALING: self.signaling_handler,
+            L2CAP_CID_LE_SIGNALING: self.signaling_handler,
+        }
+        # connection handle -> {dynamic cid -> callback(connection_handle, cid, payload)}
+        self.dynamic_channels = {}
+        self.dynamic_lock = threading.Lock()
+        # signaling code -> callback(connection_handle, cid, identifier, data)
+        self.signaling_handlers = {}
+        self.identifier = 0
+        # connection handle -> L2capRecombiner, allocated on the first fragmented PDU
+        self.recombiners = {}
+        # connection handles whose current PDU is dropped until the next start packet
+        self.dropping = set()
+        connections = getattr(self.hci, "connections", None)
+        if connections is not None:
+            connections.register_event(ConnectionEvent.DISCONNECTED, self._on_disconnected)
 
     def acl_handler(self, acl_data: bytes):
-        logger.info("l2cap recv acl:" + " ".join([hex(i) for i in acl_data]))
-        _connection_handle, total_len, pdu_len, cid  = struct.unpack('<HHHH', acl_data[0:8])
+        tracer.packet("l2cap recv acl", acl_data)
+        _connection_handle, data_len = _ACL_HEADER.unpack_from(acl_data, 0)
         connection_handle = _connection_handle & 0x0FFF
-        broadcast_flag = (_connection_handle & 0xC000) >> 14
         packet_boundary_flag = (_connection_handle & 0x3000) >> 12
-        logger.info(f"l2cap connection_handle:0x{connection_handle:04X} total_len:{total_len} pdu_len:{pdu_len} cid:0x{cid:04X} broadcast_flag:{broadcast_flag} packet_boundary_flag:{packet_boundary_flag}")
-        payload = acl_data[8:]
-        if self.att_cb is not None:
-            self.att_cb(connection_handle,cid, payload)
+        fragment = memoryview(acl_data)[_ACL_HEADER.size : _ACL_HEADER.size + data_len]
+        recombiner = self.recombiners.get(connection_handle)
+        if packet_boundary_flag != PB_CONTINUING:
+            self.dropping.discard(connection_handle)
+            if recombiner is not None and recombiner.size:
+                logger.warning(f"l2cap connection_handle:0x{connection_handle:04X} incomplete PDU dropped")
+                recombiner.reset()
+            if data_len >= _L2CAP_HEADER.size:
+                pdu_len, cid = _L2CAP_HEADER.unpack_from(fragment, 0)
+                if pdu_len + _L2CAP_HEADER.size == data_len:
+                    # fast path, the whole PDU in one packet
+                    self._dispatch(connection_handle, cid, acl_data[_ACL_HEADER.size + _L2CAP_HEADER.size : _ACL_HEADER.size + data_len])
+                    return
+            if recombiner is None:
+                recombiner = self.recombiners[connection_handle] = L2capRecombiner(self.mtu)
+        elif connection_handle in self.dropping:
+            return
+        elif recombiner is None or recombiner.size == 0:
+            logger.warning(f"l2cap connection_handle:0x{connection_handle:04X} unexpected continuation fragment")
+            return
+        if not recombiner.append(fragment):
+            logger.warning(f"l2cap connection_handle:0x{connection_handle:04X} PDU exceeds mtu {self.mtu}, dropped")
+            recombiner.reset()
+            self.dropping.add(connection_handle)
+            return
+        if recombiner.complete:
+            pdu_len, cid = _L2CAP_HEADER.unpack_from(recombiner.buffer, 0)
+            payload = bytes(recombiner.view[_L2CAP_HEADER.size : recombiner.size])
+            recombiner.reset()
+            self._dispatch(connection_handle, cid, payload)
+
+    def _dispatch(self, connection_handle: int, cid: int, payload: bytes):
+        tracer.log("l2cap connection_handle:0x%04X cid:0x%04X len:%d", connection_handle, cid, len(payload))
+        cb = self.channels.get(cid)
+        if cb is None:
+            cb = self.dynamic_channels.get(connection_handle, {}).get(cid)
+            if cb is None:
+                tracer.log("l2cap cid:0x%04X not registered, dropped", cid)
+                return
+        cb(connection_handle, cid, payload)
+
+    def _on_disconnected(self, connection):
+        self.recombiners.pop(connection.handle, None)
+        self.dropping.discard(connection.handle)
+        with self.dynamic_lock:
+            self.dynamic_channels.pop(connection.handle, None)
 
     def register_att(self, cb:callable):
-        self.att_cb = cb
+        self.register_channel(L2CAP_CID_ATT, cb)
+
+    def register_channel(self, cid: int, cb: callable):
+        """
+        注册 L2CAP 固定通道回调函数, cb(connection_handle, cid, payload)
+        """
+        self.channels[cid] = cb
+
+    def unregister_channel(self, cid: int):
+        """
+        取消注册 L2CAP 固定通道回调函数
+        """
+        self.channels.pop(cid, None)
+
+    def allocate_cid(self, connection_handle: int, cb: callable) -> int:
+        """
+        分配 L2CAP 动态通道并注册回调函数, cb(connection_handle, cid, payload)
+
+        return the cid, None if all dynamic cids of the connection are in use
+        """
+        with self.dynamic_lock:
+            channels = self.dynamic_channels.setdefault(connection_handle, {})
+            for cid in range(L2CAP_CID_DYNAMIC_FIRST, L2CAP_CID_DYNAMIC_LAST + 1):
+                if cid not in channels:
+                    channels[cid] = cb
+                    return cid
+        return None
+
+    def release_cid(self, connection_handle: int, cid: int):
+        """
+        释放 L2CAP 动态通道
+        """
+        with self.dynamic_lock:
+            channels = self.dynamic_channels.get(connection_handle)
+            if channels is not None:
+                channels.pop(cid, None)
+                if not channels:
+                    del self.dynamic_channels[connection_handle]
+
+    def register_signaling(self, code: int, cb: callable):
+        """
+        注册 L2CAP 信令命令回调函数, cb(connection_handle, cid, identifier, data)
+        """
+        self.signaling_handlers[code] = cb
+
+    def unregister_signaling(self, code: int):
+        """
+        取消注册 L2CAP 信令命令回调函数
+        """
+        self.signaling_handlers.pop(code, None)
+
+    def next_identifier(self) -> int:
+        """
+        identifier of a new signaling request, 1..255
+        """
+        self.identifier = self.identifier % 255 + 1
+        return self.identifier
+
+    def send_signaling(self, connection_handle: int, code: int, identifier: int, data: bytes, cid: int = L2CAP_CID_LE_SIGNALING):
+        self.send(connection_handle, cid, _SIGNALING_HEADER.pack(code, identifier, len(data)) + data)
+
+    def signaling_handler(self, connection_handle, cid, payload: bytes):
+        offset = 0
+        while offset + _SIGNALING_HEADER.size <= len(payload):
+            code, identifier, length = _SIGNALING_HEADER.unpack_from(payload, offset)
+            offset += _SIGNALING_HEADER.size
+            data = payload[offset : offset + length]
+            offset += length
+            if len(data) != length:
+                logger.warning(f"l2cap signaling code:0x{code:02X} truncated")
+                return
+            cb = self.signaling_handlers.get(code)
+            if cb is not None:
+                try:
+                    cb(connection_handle, cid, identifier, data)
+                except Exception as e:
+                    logger.exception(f"l2cap signaling code:0x{code:02X} error: {e}")
+            elif code not in L2CAP_SIGNALING_NO_REJECT:
+                self.command_reject(connection_handle, cid, identifier, L2CAP_REJECT_NOT_UNDERSTOOD)
+            if cid == L2CAP_CID_LE_SIGNALING:
+                # one command per C-frame on the LE signaling channel
+                return
+
+    def command_reject(self, connection_handle: int, cid: int, identifier: int, reason: int, data: bytes = b""):
+        self.send_signaling(
+            connection_handle, L2CAP_SIGNALING_CODE.L2CAP_COMMAND_REJECT_RSP, identifier, struct.pack("<H", reason) + data, cid
+        )
 
     def send(self, connection_handle, cid, data):
-        pdu_len = len(data)
-        total_len = pdu_len + 4
-        data = struct.pack('<HHHH', connection_handle, total_len, pdu_len, cid) + data
-        self.hci.send_acl(data)
\ No newline at end of file
+        """
+        send a L2CAP basic frame, HCI fragments it to the controller ACL MTU
+        """
+        pdu = struct.pack('<HH', len(data), cid) + data
+        self.hci.send_acl_data(connection_handle, pdu)
\ No newline at end of file
@@ -0,0 +1,510 @@
+import logging
+import queue
+import struct
+import threading
+from collections import deque
+from concurrent.futures import Future
+from .connection import ConnectionEvent
+from .l2cap import (
+    L2CAP_CID_DYNAMIC_FIRST,
+    L2CAP_CID_DYNAMIC_LAST,
+    L2CAP_REJECT_INVALID_CID,
+    L2CAP_SIGNALING_CODE,
+)
+logger = logging.getLogger(__name__)
+
+COC_DEFAULT_MTU = 2048
+# one K-frame per LE ACL packet with a 251 bytes LE data length
+COC_DEFAULT_MPS = 247
+COC_DEFAULT_CREDITS = 16
+COC_MAX_CREDITS = 65535
+# LE credit based mode minimum MTU and MPS
+COC_MIN_MTU = 23
+COC_MIN_MPS = 23
+# enhanced credit based mode limits
+ECBM_MIN_MTU = 64
+ECBM_MIN_MPS = 64
+ECBM_MAX_CHANNELS = 5
+
+COC_RESULT_SUCCESS = 0x0000
+COC_RESULT_PSM_NOT_SUPPORTED = 0x0002
+COC_RESULT_NO_RESOURCES = 0x0004
+COC_RESULT_INVALID_SOURCE_CID = 0x0009
+COC_RESULT_SOURCE_CID_ALREADY_ALLOCATED = 0x000A
+COC_RESULT_UNACCEPTABLE_PARAMETERS = 0x000B
+
+_LE_CONNECTION_REQ = struct.Struct("<HHHHH")
+_LE_CONNECTION_RSP = struct.Struct("<HHHHH")
+_CONNECTION_REQ = struct.Struct("<HHHH")
+_CONNECTION_RSP = struct.Struct("<HHHH")
+_CREDIT_IND = struct.Struct("<HH")
+_DISCONNECTION = struct.Struct("<HH")
+_SDU_LENGTH = struct.Struct("<H")
+
+
+class L2capCocError(Exception):
+    """
+    credit based connection refused
+    """
+
+    def __init__(self, result: int):
+        super().__init__(f"l2cap credit based connection refused, result:0x{result:04X}")
+        self.result = result
+
+
+class L2capCocChannel:
+    """
+    LE credit based connection oriented channel
+
+    send() segments a SDU into K-frames of the peer MPS, the first one
+    carrying the SDU length, and sends one K-frame per credit granted by the
+    peer, the rest waits in a queue until a Flow Control Credit Ind.
+    Received K-frames are reassembled into a bytearray preallocated to mtu,
+    credits are granted back to the peer when half of them are used.
+    """
+
+    def __init__(self, coc, connection_handle: int, psm: int, mtu: int, mps: int, credits: int):
+        self.coc = coc
+        self.l2cap = coc.l2cap
+        self.connection_handle = connection_handle
+        self.psm = psm
+        self.local_cid = 0
+        self.remote_cid = 0
+        # receive side, what we accept
+        self.mtu = mtu
+        self.mps = mps
+        self.initial_credits = credits
+        self.rx_credits = credits
+        # send side, what the peer accepts
+        self.remote_mtu = 0
+        self.remote_mps = 0
+        self.tx_credits = 0
+        self.tx_queue = deque()
+        self.tx_empty = threading.Event()
+        self.tx_empty.set()
+        self.lock = threading.RLock()
+        self.rx_buffer = bytearray(mtu)
+        self.rx_view = memoryview(self.rx_buffer)
+        self.rx_size = 0
+        # SDU length of the SDU being received, None between SDUs
+        self.rx_expected = None
+        self.sdu_queue = queue.Queue()
+        self.sdu_cb = None
+        self.connected = False
+
+    def __str__(self):
+        return f"coc channel psm:0x{self.psm:04X} connection_handle:0x{self.connection_handle:04X} local_cid:0x{self.local_cid:04X} remote_cid:0x{self.remote_cid:04X} mtu:{self.mtu}/{self.remote_mtu} mps:{self.mps}/{self.remote_mps}"
+
+    def _open(self, remote_cid: int, remote_mtu: int, remote_mps: int, credits: int):
+        self.remote_cid = remote_cid
+        self.remote_mtu = remote_mtu
+        self.remote_mps = remote_mps
+        self.tx_credits = credits
+        self.connected = True
+        logger.info(f"{self} connected")
+
+    def register_sdu(self, cb: callable):
+        """
+        注册 SDU 接收回调函数, cb(channel, sdu), 注册后 receive() 不再收到数据
+        """
+        self.sdu_cb = cb
+
+    def send(self, sdu: bytes):
+        """
+        queue a SDU, it is sent as the peer grants credits
+        """
+        if not self.connected:
+            raise ConnectionError(f"{self} not connected")
+        if len(sdu) > self.remote_mtu:
+            raise ValueError(f"sdu length {len(sdu)} exceeds the peer mtu {self.remote_mtu}")
+        mps = self.remote_mps
+        first = mps - _SDU_LENGTH.size
+        frames = [_SDU_LENGTH.pack(len(sdu)) + sdu[:first]]
+        frames.extend(sdu[offset : offset + mps] for offset in range(first, len(sdu), mps))
+        with self.lock:
+            self.tx_queue.extend(frames)
+            self.tx_empty.clear()
+            self._pump()
+
+    def write(self, data: bytes):
+        """
+        stream data of any length as SDUs of the peer mtu
+        """
+        for offset in range(0, len(data), self.remote_mtu):
+            self.send(data[offset : offset + self.remote_mtu])
+
+    def drain(self, timeout: float = None) -> bool:
+        """
+        wait until every queued K-frame is handed to HCI
+        """
+        return self.tx_empty.wait(timeout)
+
+    def receive(self, timeout: float = None) -> bytes:
+        """
+        next received SDU, None once the channel is closed, raise queue.Empty on timeout
+        """
+        return self.sdu_queue.get(timeout=timeout)
+
+    def disconnect(self):
+        """
+        send a Disconnection Request, the channel closes on the response
+        """
+        if self.connected:
+            self.coc.disconnect(self)
+
+    def _pump(self):
+        while self.tx_queue and self.tx_credits > 0:
+            self.tx_credits -= 1
+            self.l2cap.send(self.connection_handle, self.remote_cid, self.tx_queue.popleft())
+        if not self.tx_queue:
+            self.tx_empty.set()
+
+    def _add_credits(self, credits: int) -> bool:
+        with self.lock:
+            if self.tx_credits + credits > COC_MAX_CREDITS:
+                return False
+            self.tx_credits += credits
+            self._pump()
+        return True
+
+    def pdu_handler(self, connection_handle, cid, payload: bytes):
+        sdu = None
+        grant = 0
+        with self.lock:
+            if self.rx_credits == 0 or len(payload) > self.mps:
+                logger.warning(f"{self} K-frame without credit or larger than mps, disconnecting")
+                error = True
+            else:
+                self.rx_credits -= 1
+                error = self._reassemble(payload)
+                if not error and self.rx_expected is not None and self.rx_size == self.rx_expected:
+                    sdu = bytes(self.rx_view[: self.rx_size])
+                    self.rx_size = 0
+                    self.rx_expected = None
+                if self.rx_credits <= self.initial_credits // 2:
+                    grant = self.initial_credits - self.rx_credits
+                    self.rx_credits = self.initial_credits
+        if error:
+            self.disconnect()
+            return
+        if grant:
+            self.l2cap.send_signaling(
+                connection_handle,
+                L2CAP_SIGNALING_CODE.L2CAP_FLOW_CONTROL_CREDIT_IND,
+                self.l2cap.next_identifier(),
+                _CREDIT_IND.pack(self.local_cid, grant),
+            )
+        if sdu is not None:
+            if self.sdu_cb is not None:
+                self.sdu_cb(self, sdu)
+            else:
+                self.sdu_queue.put(sdu)
+
+    def _reassemble(self, payload: bytes) -> bool:
+        """
+        return True on a protocol error
+        """
+        if self.rx_expected is None:
+            if len(payload) < _SDU_LENGTH.size:
+                logger.warning(f"{self} first K-frame without SDU length")
+                return True
+            self.rx_expected = _SDU_LENGTH.unpack_from(payload, 0)[0]
+            if self.rx_expected > self.mtu:
+                logger.warning(f"{self} SDU length {self.rx_expected} exceeds mtu")
+                return True
+            payload = memoryview(payload)[_SDU_LENGTH.size :]
+        end = self.rx_size + len(payload)
+        if end > self.rx_expected:
+            logger.warning(f"{self} SDU longer than its SDU length")
+            return True
+        self.rx_view[self.rx_size : end] = payload
+        self.rx_size = end
+        return False
+
+    def _closed(self):
+        with self.lock:
+            self.connected = False
+            self.tx_queue.clear()
+            self.tx_empty.set()
+        self.sdu_queue.put(None)
+        logger.info(f"{self} disconnected")
+
+
+class L2capCoc:
+    """
+    LE credit based connection oriented channels on the LE signaling channel
+
+    Handles LE Credit Based Connection Req/Rsp, the enhanced Credit Based
+    Connection Req/Rsp (several channels per request), Flow Control Credit
+    Ind and Disconnection Req/Rsp. Servers register a PSM with register_psm,
+    clients open channels with connect/connect_enhanced. Data of every
+    channel goes through a dynamic CID allocated from L2CAP.
+    """
+
+    def __init__(self, l2cap):
+        self.l2cap = l2cap
+        # psm -> (accept_cb(channel), mtu, mps, credits)
+        self.servers = {}
+        # (connection handle, local cid) -> L2capCocChannel
+        self.channels = {}
+        # (connection handle, remote cid) -> L2capCocChannel
+        self.remote_channels = {}
+        # (connection handle, identifier) -> (future, [L2capCocChannel], enhanced)
+        self.pending = {}
+        self.lock = threading.Lock()
+        handlers = {
+            L2CAP_SIGNALING_CODE.L2CAP_COMMAND_REJECT_RSP: self._on_command_reject,
+            L2CAP_SIGNALING_CODE.L2CAP_DISCONNECTION_REQ: self._on_disconnection_req,
+            L2CAP_SIGNALING_CODE.L2CAP_DISCONNECTION_RSP: self._on_disconnection_rsp,
+            L2CAP_SIGNALING_CODE.L2CAP_LE_CREDIT_BASED_CONNECTION_REQ: self._on_le_connection_req,
+            L2CAP_SIGNALING_CODE.L2CAP_LE_CREDIT_BASED_CONNECTION_RSP: self._on_connection_rsp,
+            L2CAP_SIGNALING_CODE.L2CAP_FLOW_CONTROL_CREDIT_IND: self._on_credit_ind,
+            L2CAP_SIGNALING_CODE.L2CAP_CREDIT_BASED_CONNECTION_REQ: self._on_connection_req,
+            L2CAP_SIGNALING_CODE.L2CAP_CREDIT_BASED_CONNECTION_RSP: self._on_connection_rsp,
+        }
+        for code, cb in handlers.items():
+            self.l2cap.register_signaling(code, cb)
+        connections = getattr(self.l2cap.hci, "connections", None)
+        if connections is not None:
+            connections.register_event(ConnectionEvent.DISCONNECTED, self._on_disconnected)
+
+    def register_psm(self, psm: int, accept_cb: callable, mtu: int = COC_DEFAULT_MTU, mps: int = COC_DEFAULT_MPS, credits: int = COC_DEFAULT_CREDITS):
+        """
+        注册 LE_PSM 服务, 新通道建立时回调 accept_cb(channel)
+        """
+        self._check_parameters(mtu, mps)
+        self.servers[psm] = (accept_cb, mtu, mps, credits)
+
+    def unregister_psm(self, psm: int):
+        """
+        取消注册 LE_PSM 服务
+        """
+        self.servers.pop(psm, None)
+
+    def connect(self, connection_handle: int, psm: int, mtu: int = COC_DEFAULT_MTU, mps: int = COC_DEFAULT_MPS, credits: int = COC_DEFAULT_CREDITS) -> Future:
+        """
+        open a LE credit based channel, the future resolves to the L2capCocChannel
+
+        raise L2capCocError through the future if the peer refuses it
+        """
+        self._check_parameters(mtu, mps)
+        future = Future()
+        channel = self._new_channel(connection_handle, psm, mtu, mps, credits)
+        if channel is None:
+            future.set_exception(L2capCocError(COC_RESULT_NO_RESOURCES))
+            return future
+        identifier = self.l2cap.next_identifier()
+        with self.lock:
+            self.pending[(connection_handle, identifier)] = (future, [channel], False)
+        self.l2cap.send_signaling(
+            connection_handle,
+            L2CAP_SIGNALING_CODE.L2CAP_LE_CREDIT_BASED_CONNECTION_REQ,
+            identifier,
+            _LE_CONNECTION_REQ.pack(psm, channel.local_cid, mtu, mps, credits),
+        )
+        return future
+
+    def connect_enhanced(self, connection_handle: int, spsm: int, count: int, mtu: int = COC_DEFAULT_MTU, mps: int = COC_DEFAULT_MPS, credits: int = COC_DEFAULT_CREDITS) -> Future:
+        """
+        open up to 5 channels with one enhanced Credit Based Connection Request,
+        the future resolves to the list of channels the peer accepted
+        """
+        if not 1 <= count <= ECBM_MAX_CHANNELS or mtu < ECBM_MIN_MTU or mps < ECBM_MIN_MPS:
+            raise ValueError("invalid enhanced credit based connection parameters")
+        self._check_parameters(mtu, mps)
+        future = Future()
+        channels = []
+        for _ in range(count):
+            channel = self._new_channel(connection_handle, spsm, mtu, mps, credits)
+            if channel is None:
+                break
+            channels.append(channel)
+        if not channels:
+            future.set_exception(L2capCocError(COC_RESULT_NO_RESOURCES))
+            return future
+        identifier = self.l2cap.next_identifier()
+        with self.lock:
+            self.pending[(connection_handle, identifier)] = (future, channels, True)
+        self.l2cap.send_signaling(
+            connection_handle,
+            L2CAP_SIGNALING_CODE.L2CAP_CREDIT_BASED_CONNECTION_REQ,
+            identifier,
+            _CONNECTION_REQ.pack(spsm, mtu, mps, credits) + b"".join(struct.pack("<H", c.local_cid) for c in channels),
+        )
+        return future
+
+    def disconnect(self, channel: L2capCocChannel):
+        self.l2cap.send_signaling(
+            channel.connection_handle,
+            L2CAP_SIGNALING_CODE.L2CAP_DISCONNECTION_REQ,
+            self.l2cap.next_identifier(),
+            _DISCONNECTION.pack(channel.remote_cid, channel.local_cid),
+        )
+
+    def _check_parameters(self, mtu: int, mps: int):
+        if mtu < COC_MIN_MTU or mps < COC_MIN_MPS:
+            raise ValueError(f"mtu {mtu} and mps {mps} must be at least {COC_MIN_MTU}")
+        if mps > self.l2cap.mtu:
+            raise ValueError(f"mps {mps} exceeds the L2CAP mtu {self.l2cap.mtu}")
+
+    def _new_channel(self, connection_handle, psm, mtu, mps, credits) -> L2capCocChannel:
+        channel = L2capCocChannel(self, connection_handle, psm, mtu, mps, credits)
+        channel.local_cid = self.l2cap.allocate_cid(connection_handle, channel.pdu_handler)
+        if channel.local_cid is None:
+            return None
+        with self.lock:
+            self.channels[(connection_handle, channel.local_cid)] = channel
+        return channel
+
+    def _add_remote(self, channel: L2capCocChannel, remote_cid: int, mtu: int, mps: int, credits: int):
+        channel._open(remote_cid, mtu, mps, credits)
+        with self.lock:
+            self.remote_channels[(channel.connection_handle, remote_cid)] = channel
+
+    def _remove(self, channel: L2capCocChannel):
+        with self.lock:
+            self.channels.pop((channel.connection_handle, channel.local_cid), None)
+            if self.remote_channels.get((channel.connection_handle, channel.remote_cid)) is channel:
+                del self.remote_channels[(channel.connection_handle, channel.remote_cid)]
+        self.l2cap.release_cid(channel.connection_handle, channel.local_cid)
+        if channel.connected:
+            channel._closed()
+
+    def _check_source_cid(self, connection_handle: int, scid: int) -> int:
+        if not L2CAP_CID_DYNAMIC_FIRST <= scid <= L2CAP_CID_DYNAMIC_LAST:
+            return COC_RESULT_INVALID_SOURCE_CID
+        if (connection_handle, scid) in self.remote_channels:
+            return COC_RESULT_SOURCE_CID_ALREADY_ALLOCATED
+        return COC_RESULT_SUCCESS
+
+    def _on_le_connection_req(self, connection_handle, cid, identifier, data: bytes):
+        psm, scid, mtu, mps, credits = _LE_CONNECTION_REQ.unpack_from(data, 0)
+        server = self.servers.get(psm)
+        channel = None
+        if server is None:
+            result = COC_RESULT_PSM_NOT_SUPPORTED
+        elif mtu < COC_MIN_MTU or mps < COC_MIN_MPS:
+            result = COC_RESULT_UNACCEPTABLE_PARAMETERS
+        else:
+            result = self._check_source_cid(connection_handle, scid)
+        if result == COC_RESULT_SUCCESS:
+            accept_cb, local_mtu, local_mps, local_credits = server
+            channel = self._new_channel(connection_handle, psm, local_mtu, local_mps, local_credits)
+            if channel is None:
+                result = COC_RESULT_NO_RESOURCES
+        if channel is None:
+            rsp = _LE_CONNECTION_RSP.pack(0, 0, 0, 0, result)
+        else:
+            self._add_remote(channel, scid, mtu, mps, credits)
+            rsp = _LE_CONNECTION_RSP.pack(channel.local_cid, channel.mtu, channel.mps, channel.initial_credits, result)
+        self.l2cap.send_signaling(connection_handle, L2CAP_SIGNALING_CODE.L2CAP_LE_CREDIT_BASED_CONNECTION_RSP, identifier, rsp, cid)
+        if channel is not None:
+            accept_cb(channel)
+
+    def _on_connection_req(self, connection_handle, cid, identifier, data: bytes):
+        spsm, mtu, mps, credits = _CONNECTION_REQ.unpack_from(data, 0)
+        scids = [c for (c,) in struct.iter_unpack("<H", data[_CONNECTION_REQ.size :])]
+        server = self.servers.get(spsm)
+        # None for the refused source cids
+        channels = [None] * len(scids)
+        result = COC_RESULT_SUCCESS
+        if server is None:
+            result = COC_RESULT_PSM_NOT_SUPPORTED
+        elif mtu < ECBM_MIN_MTU or mps < ECBM_MIN_MPS or not 1 <= len(scids) <= ECBM_MAX_CHANNELS:
+            result = COC_RESULT_UNACCEPTABLE_PARAMETERS
+        else:
+            _, local_mtu, local_mps, local_credits = server
+            for i, scid in enumerate(scids):
+                scid_result = self._check_source_cid(connection_handle, scid)
+                if scid_result == COC_RESULT_SUCCESS:
+                    channels[i] = self._new_channel(connection_handle, spsm, local_mtu, local_mps, local_credits)
+                    if channels[i] is None:
+                        scid_result = COC_RESULT_NO_RESOURCES
+                    else:
+                        self._add_remote(channels[i], scid, mtu, mps, credits)
+                if scid_result != COC_RESULT_SUCCESS:
+                    result = scid_result
+        if any(channels):
+            rsp = _CONNECTION_RSP.pack(local_mtu, local_mps, local_credits, result)
+        else:
+            rsp = _CONNECTION_RSP.pack(0, 0, 0, result)
+        rsp += b"".join(struct.pack("<H", c.local_cid if c else 0) for c in channels)
+        self.l2cap.send_signaling(connection_handle, L2CAP_SIGNALING_CODE.L2CAP_CREDIT_BASED_CONNECTION_RSP, identifier, rsp, cid)
+        for channel in channels:
+            if channel is not None:
+                server[0](channel)
+
+    def _on_connection_rsp(self, connection_handle, cid, identifier, data: bytes):
+        with self.lock:
+            item = self.pending.pop((connection_handle, identifier), None)
+        if item is None:
+            logger.warning(f"l2cap unexpected credit based connection response, identifier:{identifier}")
+            return
+        future, channels, enhanced = item
+        if enhanced:
+            mtu, mps, credits, result = _CONNECTION_RSP.unpack_from(data, 0)
+            dcids = [c for (c,) in struct.iter_unpack("<H", data[_CONNECTION_RSP.size :])]
+        else:
+            dcid, mtu, mps, credits, result = _LE_CONNECTION_RSP.unpack_from(data, 0)
+            dcids = [dcid if result == COC_RESULT_SUCCESS else 0]
+        opened = []
+        for i, channel in enumerate(channels):
+            dcid = dcids[i] if i < len(dcids) else 0
+            if dcid:
+                self._add_remote(channel, dcid, mtu, mps, credits)
+                opened.append(channel)
+            else:
+                self._remove(channel)
+        if not future.set_running_or_notify_cancel():
+            for channel in opened:
+                channel.disconnect()
+        elif not opened:
+            future.set_exception(L2capCocError(result))
+        else:
+            future.set_result(opened if enhanced else opened[0])
+
+    def _on_command_reject(self, connection_handle, cid, identifier, data: bytes):
+        with self.lock:
+            item = self.pending.pop((connection_handle, identifier), None)
+        if item is None:
+            return
+        future, channels, _ = item
+        for channel in channels:
+            self._remove(channel)
+        if future.set_running_or_notify_cancel():
+            future.set_exception(L2capCocError(struct.unpack_from("<H", data, 0)[0]))
+
+    def _on_credit_ind(self, connection_handle, cid, identifier, data: bytes):
+        remote_cid, credits = _CREDIT_IND.unpack_from(data, 0)
+        channel = self.remote_channels.get((connection_handle, remote_cid))
+        if channel is None:
+            return
+        if not channel._add_credits(credits):
+            logger.warning(f"{channel} credit overflow, disconnecting")
+            channel.disconnect()
+
+    def _on_disconnection_req(self, connection_handle, cid, identifier, data: bytes):
+        dcid, scid = _DISCONNECTION.unpack_from(data, 0)
+        channel = self.channels.get((connection_handle, dcid))
+        if channel is None or channel.remote_cid != scid:
+            self.l2cap.command_reject(connection_handle, cid, identifier, L2CAP_REJECT_INVALID_CID, data[: _DISCONNECTION.size])
+            return
+        self.l2cap.send_signaling(connection_handle, L2CAP_SIGNALING_CODE.L2CAP_DISCONNECTION_RSP, identifier, data[: _DISCONNECTION.size], cid)
+        self._remove(channel)
+
+    def _on_disconnection_rsp(self, connection_handle, cid, identifier, data: bytes):
+        dcid, scid = _DISCONNECTION.unpack_from(data, 0)
+        channel = self.channels.get((connection_handle, scid))
+        if channel is not None:
+            self._remove(channel)
+
+    def _on_disconnected(self, connection):
+        with self.lock:
+            channels = [c for (handle, _), c in self.channels.items() if handle == connection.handle]
+            pending = [k for k in self.pending if k[0] == connection.handle]
+            items = [self.pending.pop(k) for k in pending]
+        for channel in channels:
+            self._remove(channel)
+        for future, _, _ in items:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ConnectionError(f"connection 0x{connection.handle:04X} disconnected"))
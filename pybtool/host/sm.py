@@ -1,6 +1,57 @@
+import logging
+import struct
+from enum import IntEnum
+from .l2cap import L2CAP_CID_SMP
+logger = logging.getLogger(__name__)
+
+
+class SMP_CODE(IntEnum):
+    SMP_PAIRING_REQUEST = 0x01
+    SMP_PAIRING_RESPONSE = 0x02
+    SMP_PAIRING_CONFIRM = 0x03
+    SMP_PAIRING_RANDOM = 0x04
+    SMP_PAIRING_FAILED = 0x05
+    SMP_ENCRYPTION_INFORMATION = 0x06
+    SMP_CENTRAL_IDENTIFICATION = 0x07
+    SMP_IDENTITY_INFORMATION = 0x08
+    SMP_IDENTITY_ADDRESS_INFORMATION = 0x09
+    SMP_SIGNING_INFORMATION = 0x0A
+    SMP_SECURITY_REQUEST = 0x0B
+    SMP_PAIRING_PUBLIC_KEY = 0x0C
+    SMP_PAIRING_DHKEY_CHECK = 0x0D
+    SMP_PAIRING_KEYPRESS_NOTIFICATION = 0x0E
+
+
+# codes starting a pairing, the only ones answered while pairing is not supported
+SMP_REQUESTS = {SMP_CODE.SMP_PAIRING_REQUEST, SMP_CODE.SMP_SECURITY_REQUEST}
+
+SMP_REASON_PAIRING_NOT_SUPPORTED = 0x05
+
+
 class SecurityManager:
-    def __init__(self, hci_interface):
-        self.hci = hci_interface
+    """
+    Security Manager on the SMP fixed channel
+
+    Pairing is not supported yet, pairing and security requests are answered
+    with Pairing Failed so the peer does not wait for the SMP timeout. The
+    other codes only occur inside a pairing, they are logged and dropped.
+    """
+
+    def __init__(self, l2cap):
+        self.l2cap = l2cap
+        self.hci = l2cap.hci
+        self.l2cap.register_channel(L2CAP_CID_SMP, self.smp_handler)
+
+    def smp_handler(self, connection_handle, cid, smp_data: bytes):
+        if not smp_data:
+            return
+        code = smp_data[0]
+        logger.info(f"smp code:0x{code:02X} connection_handle:0x{connection_handle:04X}")
+        if code in SMP_REQUESTS:
+            self.pairing_failed(connection_handle, SMP_REASON_PAIRING_NOT_SUPPORTED)
+
+    def pairing_failed(self, connection_handle, reason: int):
+        self.l2cap.send(connection_handle, L2CAP_CID_SMP, struct.pack("<BB", SMP_CODE.SMP_PAIRING_FAILED, reason))
 
     def pair(self, address):
         # 实现配对逻辑
@@ -8,4 +59,4 @@ class SecurityManager:
 
     def encrypt(self, address):
         # 实现加密逻辑
-        pass
\ No newline at end of file
+        pass
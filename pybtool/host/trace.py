@@ -0,0 +1,53 @@
+import logging
+
+# per-layer packet trace loggers: pybtool.trace.hci, pybtool.trace.l2cap, pybtool.trace.att
+TRACE_LOGGER = "pybtool.trace"
+
+
+class HexBytes:
+    """
+    lazy hex dump of a packet, formatted only when a handler emits the record
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __str__(self):
+        return self.data.hex(" ")
+
+
+class PacketTracer:
+    """
+    packet trace of one layer
+
+    Both the hex dump and the message arguments are formatted lazily, and
+    nothing is done at all unless the layer logger is enabled for the level,
+    so tracing costs one isEnabledFor check per packet when it is off. Trace
+    levels are set per layer in the loggers section of log_config.yaml.
+    """
+
+    def __init__(self, layer: str):
+        self.logger = logging.getLogger(f"{TRACE_LOGGER}.{layer}")
+
+    def enabled(self, level: int = logging.DEBUG) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def packet(self, tag: str, data: bytes, level: int = logging.DEBUG):
+        """
+        trace a packet as "tag:hex dump"
+        """
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, "%s:%s", tag, HexBytes(data))
+
+    def log(self, msg: str, *args, level: int = logging.DEBUG):
+        """
+        trace a decoded field line, msg is %-formatted with args on emit
+        """
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, *args)
+
+
+def get_tracer(layer: str) -> PacketTracer:
+    return PacketTracer(layer)
@@ -3,9 +3,14 @@ import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import signal
 import time
+import atexit
+import gzip
+import queue
+import shutil
 from datetime import datetime
 import logging
 import logging.config
+import logging.handlers
 import yaml
 import argparse
 import host
@@ -17,10 +22,53 @@ def signal_handler(sig, frame):
     logger.info('\nCtrl+C pressed. Exiting...')
     sys.exit(0)
 
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    enqueue log records without formatting them
+
+    QueueHandler.prepare formats the message in the logging thread, the
+    listener thread does it here instead. Log arguments must not be mutated
+    after the call, packets are immutable bytes.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def gzip_namer(name: str) -> str:
+    return name + ".gz"
+
+
+def gzip_rotator(source: str, dest: str):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_queue_logging():
+    """
+    move the root handlers behind a queue, hot threads only enqueue records
+    and a QueueListener thread formats them and does the I/O
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(LogQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
 def setup_logging():
     # Load logging configuration
     with open(os.path.join(os.path.dirname(__file__), 'log_config.yaml'), 'r') as f:
         config = yaml.safe_load(f.read())
+        # btool options, not part of the dictConfig schema
+        use_queue = config.pop('queue', False)
+        compress = config.pop('compress', False)
         # 创建logs目录（如果不存在）
         logs_dir = os.path.join(os.path.dirname(__file__), '../logs')
         os.makedirs(logs_dir, exist_ok=True)
@@ -31,6 +79,14 @@ def setup_logging():
         config['handlers']['file']['filename'] = log_file
 
         logging.config.dictConfig(config)
+        if compress:
+            for handler in logging.getLogger().handlers:
+                if isinstance(handler, logging.handlers.BaseRotatingHandler):
+                    handler.namer = gzip_namer
+                    handler.rotator = gzip_rotator
+        if use_queue:
+            return setup_queue_logging()
+        return None
 
 def main():
     setup_logging()
@@ -42,11 +98,15 @@ def main():
     parser.add_argument(
         "-t",
         "--transport",
-        choices=["usb", "uart"],
+        choices=["usb", "uart", "replay", "loopback"],
         default="usb",
-        help="select transport type [usb|uart]",
+        help="select transport type [usb|uart|replay|loopback]",
     )
     parser.add_argument("-d", "--device", type=int, help="select device index")
+    parser.add_argument("-b", "--baudrate", type=int, default=115200, help="uart baudrate, up to 3000000/4000000")
+    parser.add_argument("--rtscts", action="store_true", help="enable uart RTS/CTS flow control")
+    parser.add_argument("-c", "--capture", default="hci_btsnoop.cfa", help="btsnoop capture played by the replay transport")
+    parser.add_argument("--realtime", action="store_true", help="replay at the capture pace instead of max speed")
     args = parser.parse_args()
 
     if args.scan:
@@ -54,7 +114,14 @@ def main():
     else:
         parser.print_help()
 
-    hci = host.HCI(args.transport)
+    if args.transport == "uart":
+        hci = host.HCI(host.hci_transport.uart_interface(baudrate=args.baudrate, rtscts=args.rtscts))
+    elif args.transport == "replay":
+        hci = host.HCI(host.hci_transport.replay_interface(args.capture, realtime=args.realtime), btsnoop=None)
+    elif args.transport == "loopback":
+        hci = host.HCI(host.hci_transport.loopback_interface())
+    else:
+        hci = host.HCI(args.transport)
     
     devices = hci.list_devices()
     if len(devices) == 0:
@@ -79,26 +146,20 @@ def main():
         logger.info(f"hci open {hci.name}")
         l2cap = host.L2CAP(hci)
         att = host.ATT(l2cap)
+        # answers pairing requests with Pairing Failed
+        host.SecurityManager(l2cap)
         try:
             hci.init()
             
-            hcicmd = host.hci_cmd.HciCmdLeSetAdvertisingParameters()
-            logger.info(hcicmd)
-            hcievt = host.hci_evt.HciEventCommandComplete()
-            hcievt = hci.send_command(hcicmd, hcievt)
-            logger.info(hcievt)
-
-            hcicmd = host.hci_cmd.HciCmdLeSetAdvertisingData()
-            logger.info(hcicmd)
-            hcievt = host.hci_evt.HciEventCommandComplete()
-            hcievt = hci.send_command(hcicmd, hcievt)
-            logger.info(hcievt)
-
-            hcicmd = host.hci_cmd.HciCmdLeSetAdvertisingEnable()
-            logger.info(hcicmd)
-            hcievt = host.hci_evt.HciEventCommandComplete()
-            hcievt = hci.send_command(hcicmd, hcievt)
-            logger.info(hcievt)
+            cmds = [
+                (host.hci_cmd.HciCmdLeSetAdvertisingParameters(), host.hci_evt.HciEventCommandComplete()),
+                (host.hci_cmd.HciCmdLeSetAdvertisingData(), host.hci_evt.HciEventCommandComplete()),
+                (host.hci_cmd.HciCmdLeSetAdvertisingEnable(), host.hci_evt.HciEventCommandComplete()),
+            ]
+            for hcicmd, _ in cmds:
+                logger.info(hcicmd)
+            for hcievt in hci.send_commands(cmds):
+                logger.info(hcievt)
 
             logger.info("btool running, Press Ctrl+C to exit...")
             while True:
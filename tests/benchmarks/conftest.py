@@ -0,0 +1,91 @@
+import json
+import os
+import platform
+import time
+
+import pytest
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+class Benchmark:
+    """
+    minimal pytest-benchmark style timer
+
+    benchmark(func, *args) calibrates the number of calls per round so a
+    round lasts about min_round_time, runs a few rounds and keeps the best
+    throughput in ops/sec. The test fails when the throughput drops below
+    threshold times the stored baseline.
+    """
+
+    def __init__(self, name: str, baseline: float = None, threshold: float = 0.5, min_round_time: float = 0.05, rounds: int = 5):
+        self.name = name
+        self.baseline = baseline
+        self.threshold = threshold
+        self.min_round_time = min_round_time
+        self.rounds = rounds
+        self.ops = None
+
+    def __call__(self, func, *args, **kwargs):
+        timer = time.perf_counter
+        n = 1
+        while True:
+            start = timer()
+            for _ in range(n):
+                result = func(*args, **kwargs)
+            elapsed = timer() - start
+            if elapsed >= self.min_round_time:
+                break
+            n *= 2
+        best = elapsed
+        for _ in range(self.rounds - 1):
+            start = timer()
+            for _ in range(n):
+                func(*args, **kwargs)
+            best = min(best, timer() - start)
+        self.ops = n / best
+        print(f"\n{self.name}: {self.ops:.0f} ops/s, baseline {self.baseline}")
+        if self.baseline and self.ops < self.baseline * self.threshold:
+            pytest.fail(f"{self.name}: {self.ops:.0f} ops/s is below {self.threshold:.0%} of the baseline {self.baseline} ops/s")
+        return result
+
+
+def _load_baseline() -> dict:
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--bench"):
+        return
+    skip = pytest.mark.skip(reason="benchmarks run with --bench")
+    for item in items:
+        if "benchmarks" in item.nodeid.split("/"):
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope="session")
+def bench_results(request):
+    results = {}
+    yield results
+    if request.config.getoption("--bench-save") and results:
+        baseline = _load_baseline()
+        baseline.setdefault("results", {}).update(results)
+        baseline["machine"] = f"{platform.system()}-{platform.machine()}-{platform.python_implementation()}-{platform.python_version()}"
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write("\n")
+
+
+@pytest.fixture
+def benchmark(request, bench_results):
+    name = request.node.name
+    baseline = None
+    if not request.config.getoption("--bench-save"):
+        baseline = _load_baseline().get("results", {}).get(name)
+    bench = Benchmark(name, baseline, request.config.getoption("--bench-threshold"))
+    yield bench
+    if bench.ops is not None:
+        bench_results[name] = round(bench.ops)
@@ -0,0 +1,93 @@
+import inspect
+import struct
+
+import pytest
+
+from pybtool.host import hci_evt
+from pybtool.host.hci_cmd import HciCmd, HciCmdLeSetAdvertisingParameters, HciCmdLeSetAdvertisingData
+from pybtool.host.hci_evt import *
+from pybtool.host.hci_evt_decoder import decode_event
+
+
+def command_complete(opcode: int, ret: bytes = b"") -> bytes:
+    param = struct.pack("<BHB", 1, opcode, 0) + ret
+    return bytes([0x0E, len(param)]) + param
+
+
+def advertising_report(num_reports: int) -> bytes:
+    adv_data = bytes.fromhex("0201060909627472616365727300")
+    report = struct.pack("<BB6sB", 0, 1, bytes(range(6)), len(adv_data)) + adv_data + struct.pack("<b", -60)
+    param = bytes([0x02, num_reports]) + report * num_reports
+    return bytes([0x3E, len(param)]) + param
+
+
+LE_CONNECTION_COMPLETE = bytes([0x3E, 19]) + struct.pack("<BBHBB6sHHHB", 0x01, 0, 0x0040, 1, 0, bytes(range(6)), 0x18, 0, 0x48, 0)
+
+# one sample packet per event class
+EVENT_SAMPLES = {
+    HciEvent: command_complete(0x0C03),
+    HciEventDisconnectionComplete: bytes.fromhex("0504004000" + "13"),
+    HciEventCommandComplete: command_complete(0x0C03),
+    HciEventCommandCompleteLocalName: command_complete(0x0C14, b"btool".ljust(248, b"\0")),
+    HciEventCommandCompleteBdAddr: command_complete(0x1009, bytes(range(6))),
+    HciEventCommandCompleteBufferSize: command_complete(0x1005, struct.pack("<HBHH", 1021, 0, 8, 0)),
+    HciEventCommandCompleteLeBufferSize: command_complete(0x2002, struct.pack("<HB", 251, 8)),
+    HciEventCommandCompleteLocalVersionInfo: command_complete(0x1001, struct.pack("<BHBHH", 0x0D, 0, 0x0D, 2, 0)),
+    HciEventCommandCompleteLocalSupportedCommands: command_complete(0x1002, bytes(64)),
+    HciEventCommandCompleteLocalSupportedFeatures: command_complete(0x1003, bytes(8)),
+    HciEventCommandCompleteLeLocalSupportedFeatures: command_complete(0x2003, bytes(8)),
+    HciEventCommandStatus: bytes.fromhex("0f0400010d20"),
+    HciEventNumberOfCompletedPackets: bytes.fromhex("130501400001" + "00"),
+    HciEventLeMeta: LE_CONNECTION_COMPLETE,
+    HciEventLeConnectionComplete: LE_CONNECTION_COMPLETE,
+    HciEventLeConnectionUpdateComplete: bytes([0x3E, 10]) + struct.pack("<BBHHHH", 0x03, 0, 0x0040, 0x18, 0, 0x48),
+}
+
+
+def test_event_samples_complete():
+    classes = {c for _, c in inspect.getmembers(hci_evt, inspect.isclass) if issubclass(c, HciEvent)}
+    assert classes == set(EVENT_SAMPLES)
+
+
+def test_cmd_pack(benchmark):
+    cmd = HciCmdLeSetAdvertisingParameters()
+    benchmark(cmd.pack)
+
+
+def test_cmd_pack_adv_data(benchmark):
+    cmd = HciCmdLeSetAdvertisingData()
+    benchmark(cmd.pack)
+
+
+def test_structure_unpack(benchmark):
+    data = HciCmdLeSetAdvertisingParameters().pack()
+    cmd = HciCmd()
+    benchmark(cmd.unpack, data)
+
+
+@pytest.mark.parametrize("evt_cls", list(EVENT_SAMPLES), ids=lambda c: c.__name__)
+def test_event_unpack(benchmark, evt_cls):
+    data = EVENT_SAMPLES[evt_cls]
+
+    def unpack():
+        evt = evt_cls()
+        evt.unpack(data)
+        return evt
+
+    benchmark(unpack)
+
+
+DECODER_SAMPLES = {
+    "command_complete": EVENT_SAMPLES[HciEventCommandComplete],
+    "command_status": EVENT_SAMPLES[HciEventCommandStatus],
+    "disconnection_complete": EVENT_SAMPLES[HciEventDisconnectionComplete],
+    "number_of_completed_packets": EVENT_SAMPLES[HciEventNumberOfCompletedPackets],
+    "le_connection_complete": LE_CONNECTION_COMPLETE,
+    "le_advertising_report": advertising_report(1),
+    "le_advertising_report_x8": advertising_report(8),
+}
+
+
+@pytest.mark.parametrize("name", list(DECODER_SAMPLES))
+def test_event_decode(benchmark, name):
+    benchmark(decode_event, DECODER_SAMPLES[name])
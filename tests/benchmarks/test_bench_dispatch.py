@@ -0,0 +1,91 @@
+import struct
+
+import pytest
+
+from pybtool.host import HCI, L2CAP, ATT
+from pybtool.host.att_db import AttributeDatabase, uuid16, PROP_READ
+from pybtool.host.hci_btsnoop import BTSnoop, BTSnoopWriter
+
+from test_bench_codec import LE_CONNECTION_COMPLETE, command_complete
+from test_hci import FakeTransport
+
+
+@pytest.fixture
+def hci():
+    hci = HCI(FakeTransport(auto_reply=False), btsnoop=None)
+    hci.open()
+    return hci
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        command_complete(0x0C03),
+        LE_CONNECTION_COMPLETE,
+        bytes.fromhex("050400400013"),
+    ],
+    ids=["command_complete", "le_connection_complete", "disconnection_complete"],
+)
+def test_event_handler(benchmark, hci, data):
+    benchmark(hci.event_handler, data)
+
+
+def test_acl_flow_control(benchmark, hci):
+    hci.acl_scheduler.set_buffer_size(251, 8)
+    data = bytes(100)
+    nocp = bytes.fromhex("13050140000100")
+
+    def send():
+        hci.send_acl_data(0x0040, data)
+        hci.event_handler(nocp)
+
+    benchmark(send)
+
+
+def test_l2cap_att(benchmark, hci):
+    l2cap = L2CAP(hci)
+    ATT(l2cap)
+    req = struct.pack("<BHHH", 0x10, 0x0001, 0xFFFF, 0x2800)
+    acl = struct.pack("<HHHH", 0x2040, len(req) + 4, len(req), 0x0004) + req
+    benchmark(l2cap.acl_handler, acl)
+
+
+def test_att_read_by_type_large_db(benchmark, hci):
+    db = AttributeDatabase()
+    for service in range(30):
+        db.add_service(uuid16(0x180F))
+        for _ in range(10):
+            db.add_characteristic(uuid16(0x2A19), PROP_READ, b"\x64")
+    att = ATT(L2CAP(hci), db)
+    req = struct.pack("<BHHH", 0x08, 0x0100, 0xFFFF, 0x2803)
+    benchmark(att.read_by_type_req, 0x0040, req)
+
+
+def test_l2cap_recombine(benchmark, hci):
+    l2cap = L2CAP(hci)
+    l2cap.register_channel(0x0004, lambda handle, cid, payload: None)
+    # 512 byte PDU in 251 byte ACL packets
+    pdu = struct.pack("<HH", 512, 0x0004) + bytes(512)
+    packets = [struct.pack("<HH", 0x2040, 251) + pdu[:251], struct.pack("<HH", 0x1040, 251) + pdu[251:502], struct.pack("<HH", 0x1040, 14) + pdu[502:]]
+
+    def recombine():
+        for packet in packets:
+            l2cap.acl_handler(packet)
+
+    benchmark(recombine)
+
+
+def test_btsnoop_add_record(benchmark, tmp_path):
+    snoop = BTSnoop()
+    snoop.createHeader(str(tmp_path / "snoop.cfa"))
+    data = bytes([0x00, 0x02]) + bytes(31)
+    benchmark(snoop.addRecord, data)
+    snoop.close()
+
+
+def test_btsnoop_writer_add_packet(benchmark, tmp_path):
+    writer = BTSnoopWriter()
+    writer.createHeader(str(tmp_path / "snoop.cfa"))
+    data = bytes(31)
+    benchmark(writer.addPacket, False, 0x02, data)
+    writer.close()
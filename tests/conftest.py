@@ -0,0 +1,10 @@
+def pytest_addoption(parser):
+    group = parser.getgroup("bench", "btool benchmarks")
+    group.addoption("--bench", action="store_true", help="run the benchmarks in tests/benchmarks")
+    group.addoption("--bench-save", action="store_true", help="store the measured throughput as the new baseline")
+    group.addoption(
+        "--bench-threshold",
+        type=float,
+        default=0.5,
+        help="fail a benchmark below this fraction of its baseline throughput (default 0.5)",
+    )
@@ -0,0 +1,87 @@
+import asyncio
+import struct
+import unittest
+
+from pybtool.host import HCI, L2CAP, ATT, AsyncHCI, AsyncL2CAP, AsyncATT
+from pybtool.host.att import AttError
+from pybtool.host.hci_cmd import HciCmdReset
+from pybtool.host.hci_evt import HciEventDisconnectionComplete
+
+from test_hci import FakeTransport
+
+
+def acl(connection_handle, cid, payload):
+    return struct.pack("<HHHH", connection_handle | 0x2000, len(payload) + 4, len(payload), cid) + payload
+
+
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.hci = HCI(self.transport, btsnoop=None)
+        self.hci.open()
+        self.l2cap = L2CAP(self.hci)
+        self.att = ATT(self.l2cap)
+
+    def test_send_command(self):
+        async def run():
+            ahci = AsyncHCI(self.hci)
+            return await ahci.send_commands([(HciCmdReset(), None), (HciCmdReset(), None)])
+
+        evts = asyncio.run(run())
+        self.assertEqual([evt.opcode for evt in evts], [0x0C03, 0x0C03])
+
+    def test_wait_event(self):
+        async def run():
+            ahci = AsyncHCI(self.hci)
+            self.hci.hci.auto_reply = False
+            asyncio.get_running_loop().call_later(0.01, self.transport.inject_event, bytes.fromhex("050400400013"))
+            return await ahci.wait_event(HciEventDisconnectionComplete.EVENT_CODE, timeout=1)
+
+        evt = asyncio.run(run())
+        self.assertEqual(evt.connection_handle, 0x0040)
+
+    def test_l2cap_receive(self):
+        async def run():
+            al2cap = AsyncL2CAP(self.l2cap)
+            al2cap.channel(0x0006)
+            self.transport.inject_acl(acl(0x0040, 0x0006, b"\x01\x02"))
+            return await asyncio.wait_for(al2cap.receive(0x0006), 1)
+
+        self.assertEqual(asyncio.run(run()), (0x0040, b"\x01\x02"))
+
+    def test_att_request(self):
+        async def run():
+            aatt = AsyncATT(self.att)
+            task = asyncio.ensure_future(aatt.read(0x0040, 0x0003))
+            task2 = asyncio.ensure_future(aatt.read(0x0040, 0x0005))
+            await asyncio.sleep(0)
+            # one outstanding request per bearer
+            self.assertEqual(len(self.transport.acl), 1)
+            self.transport.inject_acl(acl(0x0040, 0x0004, b"\x0b\x64"))
+            self.transport.inject_acl(acl(0x0040, 0x0004, b"\x01\x0a\x05\x00\x0a"))
+            value = await task
+            with self.assertRaises(AttError):
+                await task2
+            return value
+
+        self.assertEqual(asyncio.run(run()), b"\x0b\x64")
+        self.assertEqual(self.transport.acl[1][-3:], b"\x0a\x05\x00")
+
+    def test_att_request_timeout(self):
+        async def run():
+            aatt = AsyncATT(self.att)
+            first = asyncio.ensure_future(aatt.read(0x0040, 0x0003))
+            await asyncio.sleep(0)
+            with self.assertRaises(asyncio.TimeoutError):
+                await aatt.read(0x0040, 0x0005, timeout=0.01)
+            self.transport.inject_acl(acl(0x0040, 0x0004, b"\x0b\x64"))
+            return await first
+
+        self.assertEqual(asyncio.run(run()), b"\x0b\x64")
+        # the request given up while queued is never sent
+        self.assertEqual(len(self.transport.acl), 1)
+        self.assertEqual(self.att.requests, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
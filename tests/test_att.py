@@ -0,0 +1,209 @@
+import struct
+import unittest
+from concurrent.futures import TimeoutError
+
+from pybtool.host import HCI, L2CAP, ATT
+from pybtool.host.att_db import AttributeDatabase, default_database, uuid16, PROP_READ, PERM_WRITE
+
+from test_hci import FakeTransport
+from test_connection import le_connection_complete
+
+
+def acl(connection_handle, cid, payload):
+    return struct.pack("<HHHH", connection_handle | 0x2000, len(payload) + 4, len(payload), cid) + payload
+
+
+class TestAttributeDatabase(unittest.TestCase):
+    def test_range_queries(self):
+        db = default_database()
+        services = db.range_by_type(uuid16(0x2800), 0x0001, 0xFFFF)
+        self.assertEqual([s.value for s in services], [uuid16(0x1800), uuid16(0x180F), uuid16(0x1801)])
+        self.assertEqual([db.group_end(s) for s in services], [0x0005, 0x0009, len(db)])
+        self.assertEqual([a.handle for a in db.range(0x0003, 0x0005)], [3, 4, 5])
+        # 16-bit and 128-bit forms of a UUID hit the same index
+        uuid128 = bytes.fromhex("FB349B5F8000008000100000") + uuid16(0x2803) + b"\0\0"
+        self.assertEqual(len(db.range_by_type(uuid128, 1, 0xFFFF)), 4)
+
+    def test_add_handle(self):
+        db = AttributeDatabase()
+        db.add(uuid16(0x2800), uuid16(0x1800), handle=0x0010)
+        db.add(uuid16(0x2800), uuid16(0x180F), handle=0x0008)
+        self.assertEqual(db.handles, [0x0008, 0x0010])
+        with self.assertRaises(ValueError):
+            db.add(uuid16(0x2800), handle=0x0008)
+
+
+class TestAttServer(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.hci = HCI(self.transport, btsnoop=None)
+        self.hci.open()
+        self.l2cap = L2CAP(self.hci)
+        self.att = ATT(self.l2cap)
+
+    def request(self, pdu):
+        self.transport.acl.clear()
+        self.transport.inject_acl(acl(0x0040, 0x0004, pdu))
+        return b"".join(packet[4:] for packet in self.transport.acl)[4:]
+
+    def test_read_by_group_type(self):
+        rsp = self.request(struct.pack("<BHHH", 0x10, 0x0001, 0xFFFF, 0x2800))
+        self.assertEqual(rsp, bytes.fromhex("1106" + "010005000018" + "060009000f18" + "0a000d000118"))
+        rsp = self.request(struct.pack("<BHHH", 0x10, 0x000E, 0xFFFF, 0x2800))
+        self.assertEqual(rsp, bytes.fromhex("01100e000a"))
+        rsp = self.request(struct.pack("<BHHH", 0x10, 0x0001, 0xFFFF, 0x2803))
+        self.assertEqual(rsp, bytes.fromhex("0110010010"))
+
+    def test_read_by_type_packs_mtu(self):
+        db = AttributeDatabase()
+        db.add_service(uuid16(0x180F))
+        for i in range(20):
+            db.add_characteristic(uuid16(0x2A19), PROP_READ, bytes([i]))
+        self.att.db = db
+        rsp = self.request(struct.pack("<BHHH", 0x08, 0x0001, 0xFFFF, 0x2803))
+        # 7 bytes entries in a 23 bytes MTU
+        self.assertEqual(rsp[:2], bytes([0x09, 7]))
+        self.assertEqual(len(rsp), 2 + 3 * 7)
+        rsp = self.request(struct.pack("<BHHH", 0x08, 0x0001, 0xFFFF, 0x2A19))
+        self.assertEqual(rsp, bytes([0x09, 3]) + b"".join(struct.pack("<HB", 3 + 2 * i, i) for i in range(7)))
+
+    def test_find_information(self):
+        rsp = self.request(struct.pack("<BHH", 0x04, 0x0001, 0x0005))
+        self.assertEqual(rsp, bytes.fromhex("0501" + "01000028" + "02000328" + "0300002a" + "04000328" + "0500012a"))
+
+    def test_find_by_type_value(self):
+        rsp = self.request(struct.pack("<BHHH", 0x06, 0x0001, 0xFFFF, 0x2800) + uuid16(0x180F))
+        self.assertEqual(rsp, bytes.fromhex("07" + "06000900"))
+
+    def test_read(self):
+        self.assertEqual(self.request(struct.pack("<BH", 0x0A, 0x0003)), b"\x0bbtool")
+        self.assertEqual(self.request(struct.pack("<BH", 0x0A, 0x0100)), bytes.fromhex("010a000101"))
+        self.att.db.add_descriptor(uuid16(0x2901), b"x", PERM_WRITE)
+        self.assertEqual(self.request(struct.pack("<BH", 0x0A, 0x000E)), bytes.fromhex("010a0e0002"))
+
+    def test_exchange_mtu(self):
+        self.transport.inject_event(le_connection_complete(0x0040, bytes(6)))
+        self.assertEqual(self.request(struct.pack("<BH", 0x02, 247)), bytes.fromhex("030502"))
+        self.assertEqual(self.hci.connections.get(0x0040).mtu, 247)
+        # responses are packed to the new ATT_MTU
+        rsp = self.request(struct.pack("<BHH", 0x04, 0x0001, 0xFFFF))
+        self.assertEqual(len(rsp), 2 + 4 * len(self.att.db))
+        # a client MTU below the default keeps the default
+        self.request(struct.pack("<BH", 0x02, 10))
+        self.assertEqual(self.hci.connections.get(0x0040).mtu, 23)
+
+    def test_read_blob(self):
+        self.att.db.add_descriptor(uuid16(0x2901), bytes(range(40)))
+        self.assertEqual(self.request(struct.pack("<BHH", 0x0C, 0x000E, 0)), b"\x0d" + bytes(range(22)))
+        self.assertEqual(self.request(struct.pack("<BHH", 0x0C, 0x000E, 22)), b"\x0d" + bytes(range(22, 40)))
+        self.assertEqual(self.request(struct.pack("<BHH", 0x0C, 0x000E, 40)), b"\x0d")
+        self.assertEqual(self.request(struct.pack("<BHH", 0x0C, 0x000E, 41)), bytes.fromhex("010c0e0007"))
+
+    def test_read_multiple(self):
+        self.assertEqual(self.request(struct.pack("<BHH", 0x0E, 0x0003, 0x0008)), b"\x0fbtool\x64")
+        self.assertEqual(self.request(struct.pack("<BHHH", 0x20, 0x0003, 0x0005, 0x0008)), bytes.fromhex("21" + "0500") + b"btool" + bytes.fromhex("02000000" + "010064"))
+        # the first handle that cannot be read fails the request
+        self.assertEqual(self.request(struct.pack("<BHH", 0x20, 0x0003, 0x0100)), bytes.fromhex("0120000101"))
+        self.assertEqual(self.request(struct.pack("<BH", 0x20, 0x0003)), bytes.fromhex("0120000004"))
+        # the last value is truncated to the ATT_MTU
+        self.att.db.add_descriptor(uuid16(0x2901), bytes(range(40)))
+        self.assertEqual(self.request(struct.pack("<BHH", 0x20, 0x0008, 0x000E)), bytes.fromhex("21" + "010064" + "2800") + bytes(range(17)))
+
+    def test_write(self):
+        value = self.att.db.add_descriptor(uuid16(0x2901), b"", PERM_WRITE)
+        self.assertEqual(self.request(struct.pack("<BH", 0x12, value.handle) + b"abc"), b"\x13")
+        self.assertEqual(value.value, b"abc")
+        self.assertEqual(self.request(struct.pack("<BH", 0x12, 0x0003) + b"abc"), bytes.fromhex("0112030003"))
+        # commands get no response, even on errors
+        self.assertEqual(self.request(struct.pack("<BH", 0x52, value.handle) + b"de"), b"")
+        self.assertEqual(self.request(struct.pack("<BH", 0x52, 0x0003) + b"de"), b"")
+        self.assertEqual(value.value, b"de")
+        # CCCD values are checked by the write callback
+        self.assertEqual(self.request(struct.pack("<BH", 0x12, 0x0009) + b"\x01"), bytes.fromhex("011209000d"))
+        self.assertEqual(self.request(struct.pack("<BH", 0x12, 0x0009) + b"\x02\x00"), b"\x13")
+        self.assertEqual(self.att.db.client_configuration(0x0040, 0x0008), 0x0002)
+
+    def test_signed_write(self):
+        value = self.att.db.add_descriptor(uuid16(0x2901), b"", PERM_WRITE)
+        signature = bytes(4) + b"good mac"
+        pdu = struct.pack("<BH", 0xD2, value.handle) + b"abc"
+        self.request(pdu + signature)
+        self.assertEqual(value.value, b"")
+        self.att.verifier = lambda connection_handle, data, signature: data == pdu and signature[4:] == b"good mac"
+        self.request(pdu + bytes(4) + b"bad  mac")
+        self.assertEqual(value.value, b"")
+        self.assertEqual(self.request(pdu + signature), b"")
+        self.assertEqual(value.value, b"abc")
+
+    def test_prepared_write(self):
+        value = self.att.db.add_descriptor(uuid16(0x2901), b"", PERM_WRITE)
+        for offset, part in ((0, b"0123"), (4, b"4567"), (2, b"ab")):
+            pdu = struct.pack("<HH", value.handle, offset) + part
+            self.assertEqual(self.request(b"\x16" + pdu), b"\x17" + pdu)
+        self.assertEqual(value.value, b"")
+        self.assertEqual(self.request(b"\x18\x01"), b"\x19")
+        self.assertEqual(value.value, b"01ab4567")
+        self.request(b"\x16" + struct.pack("<HH", value.handle, 0) + b"x")
+        self.assertEqual(self.request(b"\x18\x00"), b"\x19")
+        self.assertEqual(value.value, b"01ab4567")
+        self.request(b"\x16" + struct.pack("<HH", value.handle, 5) + b"x")
+        self.assertEqual(self.request(b"\x18\x01"), bytes.fromhex("0118") + struct.pack("<H", value.handle) + b"\x07")
+        self.assertEqual(self.request(b"\x16" + struct.pack("<HH", 0x0003, 0) + b"x"), bytes.fromhex("0116030003"))
+
+    def test_prepared_write_rejected(self):
+        plain = self.att.db.add_descriptor(uuid16(0x2901), b"old", PERM_WRITE)
+
+        def reject(connection_handle, value):
+            raise ValueError("rejected")
+
+        checked = self.att.db.add_descriptor(uuid16(0x2901), b"", PERM_WRITE, write_cb=reject)
+        for handle in (plain.handle, checked.handle):
+            self.request(b"\x16" + struct.pack("<HH", handle, 0) + b"new")
+        self.assertEqual(self.request(b"\x18\x01"), bytes.fromhex("0118") + struct.pack("<H", checked.handle) + b"\x0d")
+        # the rejection comes before any value is stored
+        self.assertEqual(plain.value, b"old")
+        self.assertEqual(self.att.prepare_queues, {})
+
+    def test_request_not_supported(self):
+        self.assertEqual(self.request(bytes([0x3E])), bytes.fromhex("013e000006"))
+        # confirmations are not requests, nothing sends indications here
+        self.assertEqual(self.request(bytes([0x1E])), b"")
+        # commands get no response
+        self.assertEqual(self.request(bytes([0x7E])), b"")
+
+
+class TestAttClient(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.hci = HCI(self.transport, btsnoop=None)
+        self.hci.open()
+        self.att = ATT(L2CAP(self.hci), timeout=0.05)
+
+    def sent(self):
+        pdus = [packet[8:] for packet in self.transport.acl]
+        self.transport.acl.clear()
+        return pdus
+
+    def test_cancelled_request_not_sent(self):
+        first = self.att.read(0x0040, 0x0003)
+        second = self.att.read(0x0040, 0x0005)
+        third = self.att.read(0x0040, 0x0007)
+        self.assertTrue(second.cancel())
+        self.transport.inject_acl(acl(0x0040, 0x0004, b"\x0b\x01"))
+        self.assertEqual(first.result(0), b"\x0b\x01")
+        self.assertEqual(self.sent(), [bytes.fromhex("0a0300"), bytes.fromhex("0a0700")])
+        self.transport.inject_acl(acl(0x0040, 0x0004, b"\x0b\x03"))
+        self.assertEqual(third.result(0), b"\x0b\x03")
+
+    def test_transaction_timeout(self):
+        first = self.att.read(0x0040, 0x0003)
+        second = self.att.read(0x0040, 0x0005)
+        self.assertIsInstance(first.exception(2), TimeoutError)
+        self.assertIsInstance(second.exception(2), TimeoutError)
+        self.assertEqual(self.att.requests, {})
+        # the bearer is closed until the connection is
+        self.assertIsInstance(self.att.read(0x0040, 0x0003).exception(0), ConnectionError)
+        self.assertEqual(self.sent(), [bytes.fromhex("0a0300")])
+        self.transport.inject_event(bytes.fromhex("0504004000" + "13"))
+        self.att.read(0x0040, 0x0003)
+        self.assertEqual(self.sent(), [bytes.fromhex("0a0300")])
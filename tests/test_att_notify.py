@@ -0,0 +1,99 @@
+import struct
+import unittest
+from concurrent.futures import TimeoutError
+
+from pybtool.host import HCI, L2CAP, ATT, Notifier
+from pybtool.host.att_db import default_database, uuid16, PROP_NOTIFY, PROP_INDICATE
+
+from test_att import acl
+from test_connection import le_connection_complete
+from test_hci import FakeTransport
+
+
+def completed_packets(connection_handle, num):
+    return bytes.fromhex("130501") + struct.pack("<HH", connection_handle, num)
+
+
+class TestNotifier(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.hci = HCI(self.transport, btsnoop=None)
+        self.hci.open()
+        self.db = default_database()
+        self.value = self.db.add_characteristic(uuid16(0x2A37), PROP_NOTIFY | PROP_INDICATE).handle
+        self.att = ATT(L2CAP(self.hci), self.db)
+        self.notifier = Notifier(self.att)
+        self.transport.inject_event(le_connection_complete(0x0040, bytes(6)))
+
+    def sent(self):
+        pdus = [packet[8:] for packet in self.transport.acl]
+        self.transport.acl.clear()
+        return pdus
+
+    def test_cccd(self):
+        self.assertFalse(self.notifier.notify(0x0040, self.value, b"\x01"))
+        self.assertIsNone(self.notifier.indicate(0x0040, self.value, b"\x01"))
+        # written by the client through the descriptor after the value
+        self.db.get(self.value + 1).write_cb(0x0040, b"\x01\x00")
+        self.assertEqual(self.db.get(self.value + 1).read(0x0040), b"\x01\x00")
+        self.assertTrue(self.notifier.notify(0x0040, self.value, b"\x01"))
+        self.assertEqual(self.sent(), [struct.pack("<BH", 0x1B, self.value) + b"\x01"])
+        self.assertEqual(self.notifier.notify_all(self.value, b"\x02"), 1)
+        # configurations do not outlive the connection
+        self.transport.inject_event(bytes.fromhex("0504004000" + "13"))
+        self.assertEqual(self.db.client_configuration(0x0040, self.value), 0)
+
+    def test_backpressure_keeps_latest(self):
+        self.hci.acl_scheduler.set_buffer_size(27, 1)
+        self.db.set_client_configuration(0x0040, self.value, 0x0001)
+        for i in range(10):
+            self.notifier.notify(0x0040, self.value, bytes([i]))
+        # one packet in the controller, 4 waiting for credits, the rest coalesced
+        self.assertEqual(len(self.sent()), 1)
+        self.assertEqual(self.hci.acl_scheduler.pending(0x0040), 4)
+        self.assertEqual(self.notifier.backlog(0x0040), 1)
+        self.assertEqual(self.notifier.coalesced, 4)
+        values = []
+        for _ in range(5):
+            self.transport.inject_event(completed_packets(0x0040, 1))
+            values += [pdu[3] for pdu in self.sent()]
+        self.assertEqual(values, [1, 2, 3, 4, 9])
+        self.assertEqual(self.notifier.backlog(0x0040), 0)
+
+    def test_indications(self):
+        self.db.set_client_configuration(0x0040, self.value, 0x0002)
+        first = self.notifier.indicate(0x0040, self.value, b"\x01")
+        second = self.notifier.indicate(0x0040, self.value, b"\x02")
+        third = self.notifier.indicate(0x0040, self.value, b"\x03")
+        self.assertEqual(self.sent(), [struct.pack("<BH", 0x1D, self.value) + b"\x01"])
+        self.transport.inject_acl(acl(0x0040, 0x0004, b"\x1e"))
+        self.assertIsNone(first.result(0))
+        self.assertFalse(second.done())
+        self.assertEqual(self.sent(), [struct.pack("<BH", 0x1D, self.value) + b"\x03"])
+        self.transport.inject_acl(acl(0x0040, 0x0004, b"\x1e"))
+        self.assertTrue(second.done() and third.done())
+        pending = self.notifier.indicate(0x0040, self.value, b"\x04")
+        self.transport.inject_event(bytes.fromhex("0504004000" + "13"))
+        self.assertIsInstance(pending.exception(0), ConnectionError)
+
+    def test_indication_timeout(self):
+        self.notifier.indication_timeout = 0.05
+        self.db.set_client_configuration(0x0040, self.value, 0x0003)
+        first = self.notifier.indicate(0x0040, self.value, b"\x01")
+        second = self.notifier.indicate(0x0040, self.value, b"\x02")
+        self.assertIsInstance(first.exception(2), TimeoutError)
+        self.assertIsInstance(second.exception(2), TimeoutError)
+        self.assertEqual(self.notifier.backlog(0x0040), 0)
+        # the bearer is closed until the connection is
+        self.assertIsNone(self.notifier.indicate(0x0040, self.value, b"\x03"))
+        self.assertFalse(self.notifier.notify(0x0040, self.value, b"\x03"))
+        self.transport.inject_event(bytes.fromhex("0504004000" + "13"))
+        self.assertEqual(self.notifier.timed_out, set())
+
+    def test_client_receives(self):
+        received = []
+        self.att.register_notification(lambda *args: received.append(args))
+        self.transport.inject_acl(acl(0x0040, 0x0004, bytes.fromhex("1b0300ab")))
+        self.transport.inject_acl(acl(0x0040, 0x0004, bytes.fromhex("1d0300cd")))
+        self.assertEqual(received, [(0x0040, 3, b"\xab"), (0x0040, 3, b"\xcd")])
+        self.assertEqual(self.sent(), [b"\x1e"])
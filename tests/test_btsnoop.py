@@ -0,0 +1,121 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from pybtool.host.hci_btsnoop import BTSnoop, BTSnoopWriter, BTSnoopReader, BTSNOOP_MAGIC
+from pybtool.host.hci_evt import HciEventCommandComplete
+
+
+def read_records(path, with_drops=False):
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[:8] == BTSNOOP_MAGIC
+    records = []
+    pos = 16
+    while pos < len(data):
+        orig_len, incl_len, flags, drops, ts = struct.unpack(">4Iq", data[pos : pos + 24])
+        record = data[pos + 24 : pos + 24 + incl_len]
+        records.append((flags, record, drops) if with_drops else (flags, record))
+        pos += 24 + incl_len
+    return records
+
+
+class TestBTSnoopWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "hci.cfa")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_format_as_btsnoop(self):
+        packets = [bytes([0x00, 0x04]) + bytes.fromhex("0e0401030c00"), bytes([0x01, 0x01]) + bytes.fromhex("030c00")]
+        snoop = BTSnoop()
+        snoop.createHeader(self.path + ".ref")
+        writer = BTSnoopWriter()
+        writer.createHeader(self.path)
+        for p in packets:
+            snoop.addRecord(p)
+            writer.addRecord(p)
+        snoop.close()
+        writer.close()
+        self.assertEqual(read_records(self.path), read_records(self.path + ".ref"))
+        self.assertEqual(read_records(self.path), [(0x03, bytes.fromhex("040e0401030c00")), (0x02, bytes.fromhex("01030c00"))])
+
+    def test_batch_flush(self):
+        writer = BTSnoopWriter(flush_size=64, flush_interval=60)
+        writer.createHeader(self.path)
+        for i in range(100):
+            writer.addPacket(False, 0x02, bytes([0x40, 0x20, 0x01, 0x00, i]))
+        writer.flush()
+        records = read_records(self.path)
+        self.assertEqual(len(records), 100)
+        self.assertEqual(records[99], (0x00 | 0x01, bytes([0x02, 0x40, 0x20, 0x01, 0x00, 99])))
+        writer.close()
+
+    def test_bounded_queue(self):
+        writer = BTSnoopWriter(flush_size=1 << 20, flush_interval=60, max_records=10)
+        writer.createHeader(self.path)
+        for i in range(25):
+            writer.addPacket(False, 0x02, bytes([i]))
+        self.assertEqual((len(writer.records), writer.dropped), (10, 15))
+        self.assertEqual(writer.pending_bytes, 10 * (24 + 2))
+        writer.close()
+        self.assertEqual([(data[1], drops) for _, data, drops in read_records(self.path, True)], [(i, 15) for i in range(15, 25)])
+        self.assertEqual(writer.pending_bytes, 0)
+
+    def test_rotate(self):
+        writer = BTSnoopWriter(flush_size=64, flush_interval=60, max_bytes=200, backup_count=2)
+        writer.createHeader(self.path)
+        for i in range(30):
+            writer.addPacket(True, 0x01, bytes(10))
+            writer.flush()
+        writer.close()
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+        self.assertLess(os.path.getsize(self.path + ".1"), 200 + 64)
+
+
+class TestBTSnoopReader(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "hci.cfa")
+        writer = BTSnoopWriter()
+        writer.createHeader(self.path)
+        for i in range(10):
+            writer.records.append((1000.0 + i, 0x02, 0x01, bytes.fromhex("030c00")))
+            writer.records.append((1000.5 + i, 0x03, 0x04, bytes.fromhex("0e0401030c00")))
+        writer.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_iterate(self):
+        with BTSnoopReader(self.path) as reader:
+            self.assertEqual(reader.datalink, 0x03EA)
+            records = [(r.flags, bytes(r.data)) for r in reader]
+        self.assertEqual(len(records), 20)
+        self.assertEqual(records[1], (0x03, bytes.fromhex("040e0401030c00")))
+
+    def test_index_seek(self):
+        with BTSnoopReader(self.path) as reader:
+            self.assertEqual(len(reader), 20)
+            self.assertEqual(bytes(reader[3].data), bytes.fromhex("040e0401030c00"))
+            n = reader.seek_time(1004.2)
+            self.assertEqual(n, 9)
+            self.assertEqual(len(list(reader.iter_from(n))), 11)
+
+    def test_decode(self):
+        with BTSnoopReader(self.path) as reader:
+            cmd = BTSnoopReader.decode(reader[0])
+            evt = BTSnoopReader.decode(reader[1])
+            self.assertFalse(BTSnoopReader.is_received(reader[0]))
+        self.assertEqual(cmd.opcode, 0x0C03)
+        self.assertIsInstance(evt, HciEventCommandComplete)
+        self.assertEqual(evt.opcode, 0x0C03)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import struct
+import unittest
+
+from pybtool.host import HCI, ConnectionEvent
+
+from test_hci import FakeTransport
+
+
+def le_connection_complete(connection_handle, peer_addr, role=1, interval=0x18):
+    param = struct.pack("<BBHBB6sHHHB", 0x01, 0, connection_handle, role, 0, peer_addr, interval, 0, 0x48, 0)
+    return bytes([0x3E, len(param)]) + param
+
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.hci = HCI(self.transport, btsnoop=None)
+        self.hci.open()
+        self.connections = self.hci.connections
+
+    def test_connect_update_disconnect(self):
+        events = []
+        for event in ConnectionEvent:
+            self.connections.register_event(event, lambda c, event=event: events.append((event, c.handle)))
+        peer = bytes([6, 5, 4, 3, 2, 1])
+        self.transport.inject_event(le_connection_complete(0x0040, peer))
+        connection = self.connections.get(0x0040)
+        self.assertEqual(connection.peer_address, peer)
+        self.assertFalse(connection.is_central)
+        self.assertEqual(connection.mtu, 23)
+        self.assertIs(self.connections.find(peer), connection)
+
+        self.transport.inject_event(bytes([0x3E, 10]) + struct.pack("<BBHHHH", 0x03, 0, 0x0040, 0x30, 4, 0x100))
+        self.assertEqual((connection.interval, connection.latency, connection.supervision_timeout), (0x30, 4, 0x100))
+
+        self.assertEqual(connection.security_level, 1)
+        self.transport.inject_event(bytes.fromhex("0804004000" + "01"))
+        self.assertTrue(connection.encrypted)
+        self.assertEqual(connection.security_level, 2)
+
+        self.transport.inject_event(bytes.fromhex("0504004000" + "13"))
+        self.assertNotIn(0x0040, self.connections)
+        self.assertIsNone(self.connections.find(peer))
+        self.assertEqual(
+            events,
+            [
+                (ConnectionEvent.CONNECTED, 0x40),
+                (ConnectionEvent.UPDATED, 0x40),
+                (ConnectionEvent.ENCRYPTION_CHANGED, 0x40),
+                (ConnectionEvent.DISCONNECTED, 0x40),
+            ],
+        )
+
+    def test_many_connections(self):
+        for i in range(300):
+            self.transport.inject_event(le_connection_complete(i, struct.pack("<IH", i, 0)))
+        self.assertEqual(len(self.connections), 300)
+        self.assertEqual(self.connections.find(struct.pack("<IH", 123, 0)).handle, 123)
+
+    def test_peer_address_type(self):
+        peer = bytes([6, 5, 4, 3, 2, 1])
+        self.transport.inject_event(le_connection_complete(0x0040, peer))
+        param = struct.pack("<BBHBB6sHHHB", 0x01, 0, 0x0041, 1, 1, peer, 0x18, 0, 0x48, 0)
+        self.transport.inject_event(bytes([0x3E, len(param)]) + param)
+        self.assertEqual(self.connections.find(peer).handle, 0x0040)
+        self.assertEqual(self.connections.find(peer, 1).handle, 0x0041)
+        self.transport.inject_event(bytes.fromhex("0504004000" + "13"))
+        self.assertIsNone(self.connections.find(peer))
+        self.assertEqual(self.connections.find(peer, 1).handle, 0x0041)
+
+    def test_failed_connection(self):
+        param = struct.pack("<BBHBB6sHHHB", 0x01, 0x3E, 0, 1, 0, bytes(6), 0, 0, 0, 0)
+        self.transport.inject_event(bytes([0x3E, len(param)]) + param)
+        self.assertEqual(len(self.connections), 0)
@@ -0,0 +1,241 @@
+import tempfile
+from concurrent.futures import TimeoutError
+import threading
+import time
+import unittest
+
+from pybtool.host import HCI, L2CAP, ATT
+from pybtool.host.att_db import default_database, uuid16, PROP_READ, PROP_NOTIFY, PROP_WRITE, PROP_WRITE_WITHOUT_RESPONSE, PERM_READ, PERM_WRITE
+from pybtool.host.att import AttError
+from pybtool.host.gatt import GATT, GattCache
+
+from test_att_notify import completed_packets
+from test_connection import le_connection_complete
+from test_hci import FakeTransport
+from test_l2cap_coc import LinkedTransport
+
+
+def att_stack(db=None):
+    transport = LinkedTransport()
+    hci = HCI(transport, btsnoop=None)
+    hci.open()
+    return transport, ATT(L2CAP(hci), db)
+
+
+class TestGattClient(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = default_database()
+        for i in range(10):
+            self.db.add_service(uuid16(0x1810 + i))
+            self.db.add_characteristic(uuid16(0x2A35), PROP_READ | PROP_NOTIFY, bytes([i]))
+            self.db.add_characteristic(bytes(range(16)), PROP_READ, b"long uuid")
+        self.client_transport, self.client = att_stack()
+        self.server_transport, self.server = att_stack(self.db)
+        self.client_transport.peer = self.server_transport
+        self.server_transport.peer = self.client_transport
+        self.client_transport.inject_event(le_connection_complete(0x0040, bytes([6, 5, 4, 3, 2, 1])))
+        self.server_transport.inject_event(le_connection_complete(0x0040, bytes([1, 2, 3, 4, 5, 6])))
+        self.gatt = GATT(self.client, self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_discover(self):
+        services = self.gatt.discover(0x0040, timeout=2)
+        self.assertEqual(self.client.mtu(0x0040), 517)
+        self.assertEqual([s.uuid for s in services[:3]], [uuid16(0x1800), uuid16(0x180F), uuid16(0x1801)])
+        self.assertEqual(len(services), 13)
+        battery = services[1].characteristics[0]
+        self.assertEqual((battery.uuid, battery.value_handle, battery.properties), (uuid16(0x2A19), 8, PROP_READ | PROP_NOTIFY))
+        self.assertEqual([(d.handle, d.uuid) for d in battery.descriptors], [(9, uuid16(0x2902))])
+        service = services[5]
+        self.assertEqual([c.uuid for c in service.characteristics], [uuid16(0x2A35), bytes(range(16))])
+        self.assertEqual(service.characteristics[1].descriptors, [])
+        self.assertEqual(self.gatt.read_characteristic(0x0040, service.characteristics[1].value_handle, 2), b"long uuid")
+
+    def test_exchange_mtu_fewer_requests(self):
+        self.server.db = default_database()
+        for i in range(20):
+            self.server.db.add_service(uuid16(0x1810 + i))
+            for _ in range(5):
+                self.server.db.add_characteristic(uuid16(0x2A35), PROP_READ, bytes([i]))
+        self.client.local_mtu = 23
+        self.gatt.discover(0x0040, timeout=2)
+        requests_default_mtu = len(self.client_transport.acl)
+        self.client_transport.inject_event(le_connection_complete(0x0041, bytes([7, 5, 4, 3, 2, 1])))
+        self.server_transport.inject_event(le_connection_complete(0x0041, bytes([8, 5, 4, 3, 2, 1])))
+        self.client.local_mtu = 247
+        self.client_transport.acl.clear()
+        self.gatt.discover(0x0041, timeout=2)
+        self.assertEqual(self.client.mtu(0x0041), 247)
+        self.assertLess(len(self.client_transport.acl) * 4, requests_default_mtu)
+
+    def test_read_multiple(self):
+        handles = [a.handle for a in self.db.range_by_type(uuid16(0x2A35), 1, 0xFFFF)]
+        long_value = self.db.add_characteristic(uuid16(0x2A36), PROP_READ, bytes(range(200)))
+        unreadable = self.db.add_characteristic(uuid16(0x2A37), 0, b"x", 0)
+        self.gatt.exchange_mtu(0x0040, 2)
+        self.client_transport.acl.clear()
+        values = self.gatt.read_multiple(0x0040, handles + [long_value.handle], 2)
+        self.assertEqual([values[h] for h in handles], [bytes([i]) for i in range(10)])
+        self.assertEqual(values[long_value.handle], bytes(range(200)))
+        self.assertEqual(len(self.client_transport.acl), 1)
+        values = self.gatt.read_multiple(0x0040, [handles[0], unreadable.handle], 2)
+        self.assertEqual(values[handles[0]], bytes([0]))
+        self.assertEqual(values[unreadable.handle].error_code, 0x02)
+
+    def test_read_multiple_empty_response(self):
+        handles = [a.handle for a in self.db.range_by_type(uuid16(0x2A35), 1, 0xFFFF)]
+        # a peer answering Read Multiple Variable without any value
+        self.server.server_handlers[0x20] = lambda connection_handle, att_data: b"\x21"
+        values = self.gatt.read_multiple(0x0040, handles, 2)
+        self.assertEqual([values[h] for h in handles], [bytes([i]) for i in range(10)])
+        self.server.server_handlers[0x20] = lambda connection_handle, att_data: b"\x21\x05"
+        values = self.gatt.read_multiple(0x0040, handles[:2], 2)
+        self.assertEqual([values[h] for h in handles[:2]], [b"\x00", b"\x01"])
+
+    def test_read_multiple_blob_error(self):
+        long_value = self.db.add_characteristic(uuid16(0x2A36), PROP_READ, bytes(range(200)))
+
+        def read_blob_req(connection_handle, att_data):
+            raise AttError(0x0C, long_value.handle, 0x0E)
+
+        self.server.server_handlers[0x0C] = read_blob_req
+        values = self.gatt.read_multiple(0x0040, [1, long_value.handle], 2)
+        self.assertEqual(values[1], self.db.get(1).value)
+        self.assertEqual(values[long_value.handle].error_code, 0x0E)
+
+    def test_read_multiple_timeout(self):
+        self.client_transport.peer = FakeTransport()
+        with self.assertRaises(TimeoutError):
+            self.gatt.read_multiple(0x0040, list(range(1, 40)), 0.05)
+
+    def test_read_multiple_timeout_cancels(self):
+        read_multiple_variable_req = self.server.server_handlers[0x20]
+
+        def slow_read_multiple_variable_req(connection_handle, att_data):
+            time.sleep(0.3)
+            return read_multiple_variable_req(connection_handle, att_data)
+
+        self.server.server_handlers[0x20] = slow_read_multiple_variable_req
+        self.client_transport.acl.clear()
+        with self.assertRaises(TimeoutError):
+            self.gatt.read_multiple(0x0040, list(range(1, 40)), 0.1)
+        deadline = time.monotonic() + 5
+        while 0x0040 in self.client.requests and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # the batches queued behind the late one were never sent
+        self.assertEqual([packet[8] for packet in self.client_transport.acl], [0x20])
+
+    def test_read_long(self):
+        value = self.db.add_characteristic(uuid16(0x2A36), PROP_READ, bytes(range(256)) * 2)
+        self.client_transport.acl.clear()
+        self.assertEqual(self.gatt.read_characteristic(0x0040, value.handle, 2), bytes(range(256)) * 2)
+        # 23 bytes MTU: one Read and 23 Read Blob requests, at most GATT_BLOB_WINDOW past the end
+        self.assertLessEqual(len(self.client_transport.acl), 1 + 23 + 4)
+        short = self.db.add_characteristic(uuid16(0x2A36), PROP_READ, bytes(range(30)))
+        self.assertEqual(self.gatt.read_characteristic(0x0040, short.handle, 2), bytes(range(30)))
+
+    def test_write(self):
+        value = self.db.add_characteristic(uuid16(0x2A36), PROP_WRITE, b"", PERM_READ | PERM_WRITE)
+        self.gatt.write_characteristic(0x0040, value.handle, b"short", timeout=2)
+        self.assertEqual(value.value, b"short")
+        self.gatt.write_characteristic(0x0040, value.handle, bytes(range(100)), timeout=2)
+        self.assertEqual(value.value, bytes(range(100)))
+        with self.assertRaises(ValueError):
+            self.gatt.write_characteristic(0x0040, value.handle, bytes(21), response=False)
+        readonly = self.db.add_characteristic(uuid16(0x2A37), PROP_READ, b"x")
+        with self.assertRaises(AttError):
+            self.gatt.write_characteristic(0x0040, readonly.handle, bytes(100), timeout=2)
+        # the failed long write left no prepared parts behind
+        self.assertEqual(self.server.prepare_queues, {})
+
+    def test_long_write_timeout(self):
+        value = self.db.add_characteristic(uuid16(0x2A36), PROP_WRITE, b"", PERM_READ | PERM_WRITE)
+        prepare_write_req = self.server.server_handlers[0x16]
+
+        def slow_prepare_write_req(connection_handle, att_data):
+            if att_data[3:5] != bytes(2):
+                time.sleep(0.3)
+            return prepare_write_req(connection_handle, att_data)
+
+        self.server.server_handlers[0x16] = slow_prepare_write_req
+        with self.assertRaises(TimeoutError):
+            self.gatt.write_characteristic(0x0040, value.handle, bytes(100), timeout=0.1)
+        # the late answers let the cancel through, no parts are left for the next long write
+        deadline = time.monotonic() + 5
+        while (0x0040 in self.client.requests or self.server.prepare_queues) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.server.prepare_queues, {})
+        self.assertEqual(value.value, b"")
+
+    def test_write_bulk(self):
+        received = []
+        value = self.db.add_characteristic(uuid16(0x2A36), PROP_WRITE_WITHOUT_RESPONSE, permissions=PERM_WRITE, write_cb=lambda h, v: received.append(v))
+        scheduler = self.client.l2cap.hci.acl_scheduler
+        scheduler.set_buffer_size(27, 2)
+        data = bytes(range(200))
+        writer = threading.Thread(target=self.gatt.write_bulk, args=(0x0040, value.handle, data, 2, 2))
+        writer.start()
+        while writer.is_alive():
+            writer.join(0.05)
+            self.assertLessEqual(scheduler.pending(0x0040), 2)
+            self.client_transport.inject_event(completed_packets(0x0040, 1))
+        # the last writes leave the host queue as credits come back
+        while scheduler.pending(0x0040):
+            self.client_transport.inject_event(completed_packets(0x0040, 1))
+        deadline = time.monotonic() + 2
+        while len(received) < 10 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(b"".join(received), data)
+        self.assertEqual(len(received), 10)
+
+    def test_exchange_mtu_timeout(self):
+        # the peer never answers
+        self.client.timeout = 0.2
+        server_transport, self.client_transport.peer = self.client_transport.peer, FakeTransport()
+        with self.assertRaises(TimeoutError):
+            self.gatt.exchange_mtu(0x0040, 0.05)
+        self.assertNotIn(0x0040, self.gatt.mtu_exchanged)
+        # the retry waits for the same request, then the ATT transaction times out
+        with self.assertRaises(TimeoutError):
+            self.gatt.exchange_mtu(0x0040, 2)
+        self.assertEqual([packet[8] for packet in self.client_transport.acl], [0x02])
+        # the next connection exchanges again
+        self.client_transport.peer = server_transport
+        for transport in (self.client_transport, self.server_transport):
+            transport.inject_event(bytes.fromhex("0504004000" + "13"))
+        self.client_transport.inject_event(le_connection_complete(0x0040, bytes([6, 5, 4, 3, 2, 1])))
+        self.server_transport.inject_event(le_connection_complete(0x0040, bytes([1, 2, 3, 4, 5, 6])))
+        self.assertEqual(self.gatt.exchange_mtu(0x0040, 2), 517)
+        self.assertIn(0x0040, self.gatt.mtu_exchanged)
+
+    def test_cache_key(self):
+        address = bytes([6, 5, 4, 3, 2, 0xC1])
+        self.assertEqual(GattCache.key(0, address), "public-c10203040506")
+        self.assertEqual(GattCache.key(1, address), "random-c10203040506")
+        # identity addresses resolved by the controller
+        self.assertEqual(GattCache.key(2, address), GattCache.key(0, address))
+        self.assertEqual(GattCache.key(3, address), GattCache.key(1, address))
+        # resolvable and non-resolvable private addresses change
+        self.assertIsNone(GattCache.key(1, bytes([6, 5, 4, 3, 2, 0x41])))
+        self.assertIsNone(GattCache.key(1, bytes([6, 5, 4, 3, 2, 0x01])))
+
+    def test_cache(self):
+        self.db.add_service(uuid16(0x1801))
+        self.db.add_characteristic(uuid16(0x2B2A), PROP_READ, bytes(range(16)))
+        services = self.gatt.discover(0x0040, timeout=2)
+        requests = len(self.client_transport.acl)
+        cached = self.gatt.discover(0x0040, timeout=2)
+        # only the Database Hash read
+        self.assertEqual(len(self.client_transport.acl), requests + 1)
+        self.assertEqual([str(s) for s in cached], [str(s) for s in services])
+        self.assertEqual(
+            [str(d) for s in cached for c in s.characteristics for d in c.descriptors],
+            [str(d) for s in services for c in s.characteristics for d in c.descriptors],
+        )
+        # a new hash invalidates the cache
+        self.db.range_by_type(uuid16(0x2B2A), 1, 0xFFFF)[0].value = bytes(16)
+        self.gatt.discover(0x0040, timeout=2)
+        self.assertGreater(len(self.client_transport.acl), requests + 2)
@@ -0,0 +1,244 @@
+import logging
+import struct
+import threading
+import unittest
+
+from pybtool.host.hci import HCI, hci_event_object
+from pybtool.host.hci_evt_decoder import decode_event, RawEvent
+from pybtool.host.hci_scheduler import HciCommandScheduler, HciAclScheduler
+from pybtool.host.hci_cmd import HciCmdReset, HciCmdReadBdAddr
+from pybtool.host.hci_evt import (
+    HciEventCommandComplete,
+    HciEventCommandCompleteBdAddr,
+    HciEventCommandStatus,
+    HciEventDisconnectionComplete,
+    HciEventNumberOfCompletedPackets,
+    HciEventLeConnectionComplete,
+    HciEventLeConnectionUpdateComplete,
+)
+from pybtool.host.hci_transport.transport import HCIInterface
+
+
+class FakeTransport(HCIInterface):
+    """
+    answer every command with a Command Complete event from another thread
+    """
+
+    def __init__(self, auto_reply=True):
+        self.auto_reply = auto_reply
+        self.event_callbacks = []
+        self.acl_callbacks = []
+        self.commands = []
+        self.acl = []
+
+    def list_devices(self):
+        return []
+
+    def open(self, device=None):
+        pass
+
+    def close(self):
+        pass
+
+    def send_command(self, cmd: bytes):
+        self.commands.append(cmd)
+        if self.auto_reply:
+            opcode = struct.unpack("<H", cmd[:2])[0]
+            param = struct.pack("<BHB", 1, opcode, 0)
+            if opcode == 0x1009:  # read bd addr
+                param += bytes([0x01, 0x02, 0x03, 0x04, 0x05, 0x06])
+            threading.Timer(0.01, self.inject_event, [bytes([0x0E, len(param)]) + param]).start()
+
+    def send_acl(self, data: bytes):
+        self.acl.append(data)
+
+    def register_event(self, cb: callable):
+        self.event_callbacks.append(cb)
+
+    def register_acl(self, cb: callable):
+        self.acl_callbacks.append(cb)
+
+    def inject_event(self, data: bytes):
+        for cb in self.event_callbacks:
+            cb(data)
+
+    def inject_acl(self, data: bytes):
+        for cb in self.acl_callbacks:
+            cb(data)
+
+
+class TestHciCommand(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.hci = HCI(self.transport, btsnoop=None)
+        self.hci.open()
+
+    def test_send_command(self):
+        evt = self.hci.send_command(HciCmdReset(), HciEventCommandComplete())
+        self.assertIsNotNone(evt)
+        self.assertEqual(evt.opcode, 0x0C03)
+
+    def test_send_command_expect_evt(self):
+        evt = self.hci.send_command(HciCmdReadBdAddr(), HciEventCommandCompleteBdAddr())
+        self.assertEqual(evt.bd_addr, "01:02:03:04:05:06")
+
+    def test_send_command_timeout(self):
+        self.transport.auto_reply = False
+        evt = self.hci.send_command(HciCmdReset(), timeout=0.05)
+        self.assertIsNone(evt)
+        self.assertEqual(self.hci.cmd_scheduler.pending, {})
+        self.assertEqual(self.hci.cmd_scheduler.credits, 1)
+
+    def test_send_commands(self):
+        evts = self.hci.send_commands(
+            [(HciCmdReset(), HciEventCommandComplete()), (HciCmdReadBdAddr(), HciEventCommandCompleteBdAddr())]
+        )
+        self.assertEqual(evts[0].opcode, 0x0C03)
+        self.assertEqual(evts[1].bd_addr, "01:02:03:04:05:06")
+
+    def test_event_dispatch(self):
+        received = []
+        self.hci.register_event(HciEventDisconnectionComplete.EVENT_CODE, received.append)
+        self.transport.inject_event(bytes.fromhex("0504004000" + "13"))
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0].connection_handle, 0x0040)
+        self.assertEqual(received[0].reason, 0x13)
+
+    def test_event_trace(self):
+        data = bytes.fromhex("0504004000" + "13")
+        logger = logging.getLogger("pybtool.trace.hci")
+        with self.assertLogs(logger, logging.DEBUG) as cm:
+            self.transport.inject_event(data)
+        # traced with the HciEvent classes string, not the decoder tuple
+        self.assertIn("DEBUG:pybtool.trace.hci:" + str(hci_event_object(data)), cm.output)
+
+
+class TestHciEventDecoder(unittest.TestCase):
+    SAMPLES = {
+        HciEventDisconnectionComplete: bytes.fromhex("0504004000" + "13"),
+        HciEventCommandComplete: bytes.fromhex("0e0401030c00"),
+        HciEventCommandStatus: bytes.fromhex("0f0400010d20"),
+        HciEventNumberOfCompletedPackets: bytes.fromhex("1309024000010041000300"),
+        HciEventLeConnectionComplete: bytes([0x3E, 19])
+        + struct.pack("<BBHBB6sHHHB", 0x01, 0, 0x0040, 1, 0, bytes(range(6)), 0x18, 0, 0x48, 0),
+        HciEventLeConnectionUpdateComplete: bytes([0x3E, 10]) + struct.pack("<BBHHHH", 0x03, 0, 0x0040, 0x18, 0, 0x48),
+    }
+
+    def test_same_fields_as_event_classes(self):
+        for evt_cls, data in self.SAMPLES.items():
+            evt = evt_cls()
+            evt.unpack(data)
+            record = decode_event(data)
+            for field in record._fields:
+                if hasattr(evt, field):
+                    self.assertEqual(getattr(record, field), getattr(evt, field), f"{evt_cls.__name__}.{field}")
+
+    def test_unknown_event(self):
+        record = decode_event(bytes.fromhex("ff0201020304"))
+        self.assertIsInstance(record, RawEvent)
+        self.assertEqual(bytes(record.param), b"\x01\x02")
+
+    def test_too_short(self):
+        with self.assertRaises(ValueError):
+            decode_event(bytes.fromhex("0504004000"))
+
+    def test_advertising_report(self):
+        adv_data = bytes.fromhex("020106")
+        report = struct.pack("<BB6sB", 0, 1, bytes(range(6)), len(adv_data)) + adv_data + struct.pack("<b", -60)
+        param = bytes([0x02, 1]) + report
+        record = decode_event(bytes([0x3E, len(param)]) + param)
+        self.assertEqual(record.subevent_code, 0x02)
+        self.assertEqual(len(record.reports), 1)
+        self.assertEqual(record.reports[0].address, bytes(range(6)))
+        self.assertEqual(bytes(record.reports[0].data), adv_data)
+        self.assertEqual(record.reports[0].rssi, -60)
+
+
+class TestHciCommandScheduler(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.scheduler = HciCommandScheduler(self.sent.append)
+
+    def command_complete(self, opcode, num_hci_cmd_packets=1):
+        evt = HciEventCommandComplete()
+        data = bytes([0x0E, 4]) + struct.pack("<BHB", num_hci_cmd_packets, opcode, 0)
+        evt.unpack(data)
+        self.scheduler.complete(evt, data)
+
+    def test_credit_window(self):
+        f1 = self.scheduler.submit(0x1001, b"\x01\x10\x00", HciEventCommandComplete())
+        f2 = self.scheduler.submit(0x1002, b"\x02\x10\x00", HciEventCommandComplete())
+        f3 = self.scheduler.submit(0x1003, b"\x03\x10\x00", HciEventCommandComplete())
+        self.assertEqual(len(self.sent), 1)
+        # controller grants two credits, both queued commands go out
+        self.command_complete(0x1001, 2)
+        self.assertTrue(f1.done())
+        self.assertEqual(len(self.sent), 3)
+        self.command_complete(0x1002)
+        self.command_complete(0x1003)
+        self.assertEqual(f2.result(0).opcode, 0x1002)
+        self.assertEqual(f3.result(0).opcode, 0x1003)
+
+    def test_reset_barrier(self):
+        self.scheduler.credits = 2
+        self.scheduler.submit(0x0C03, b"\x03\x0c\x00", HciEventCommandComplete())
+        self.scheduler.submit(0x1001, b"\x01\x10\x00", HciEventCommandComplete())
+        self.assertEqual(len(self.sent), 1)
+        self.command_complete(0x0C03)
+        self.assertEqual(len(self.sent), 2)
+
+    def test_nop_credit(self):
+        self.scheduler.credits = 0
+        self.scheduler.submit(0x1001, b"\x01\x10\x00", HciEventCommandComplete())
+        self.assertEqual(len(self.sent), 0)
+        self.command_complete(0x0000)
+        self.assertEqual(len(self.sent), 1)
+
+
+class TestHciAclScheduler(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.scheduler = HciAclScheduler(self.sent.extend)
+        self.scheduler.set_buffer_size(27, 2)
+
+    def test_fragment(self):
+        self.scheduler.set_buffer_size(27, 8)
+        self.scheduler.send_pdu(0x0040, bytes(range(60)))
+        self.assertEqual([len(p) for p in self.sent], [31, 31, 10])
+        self.assertEqual(struct.unpack("<HH", self.sent[0][:4]), (0x0040, 27))
+        self.assertEqual(struct.unpack("<HH", self.sent[1][:4]), (0x1040, 27))
+        self.assertEqual(b"".join([p[4:] for p in self.sent]), bytes(range(60)))
+
+    def test_credits(self):
+        for _ in range(4):
+            self.scheduler.send_pdu(0x0040, bytes(10))
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.scheduler.pending(0x0040), 2)
+        self.scheduler.completed(0x0040, 1)
+        self.assertEqual(len(self.sent), 3)
+        self.scheduler.disconnected(0x0040)
+        self.assertEqual(self.scheduler.credits, 2)
+        self.assertEqual(self.scheduler.pending(0x0040), 0)
+
+    def test_round_robin(self):
+        self.scheduler.set_buffer_size(27, 0)
+        for _ in range(3):
+            self.scheduler.send_pdu(0x0040, bytes(1))
+            self.scheduler.send_pdu(0x0041, bytes(1))
+        self.scheduler.set_buffer_size(27, 4)
+        handles = [struct.unpack("<H", p[:2])[0] for p in self.sent]
+        self.assertEqual(handles, [0x0040, 0x0041, 0x0040, 0x0041])
+
+    def test_number_of_completed_packets(self):
+        hci = HCI(FakeTransport(), btsnoop=None)
+        hci.open()
+        hci.acl_scheduler.set_buffer_size(27, 1)
+        hci.send_acl_data(0x0040, bytes(4))
+        hci.send_acl_data(0x0040, bytes(4))
+        self.assertEqual(len(hci.hci.acl), 1)
+        hci.event_handler(bytes.fromhex("1305014000" + "0100"))
+        self.assertEqual(len(hci.hci.acl), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
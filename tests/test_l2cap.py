@@ -0,0 +1,139 @@
+import struct
+import unittest
+
+from pybtool.host import HCI, L2CAP, SecurityManager
+from pybtool.host.l2cap import L2CAP_CID_ATT, L2CAP_CID_LE_SIGNALING, L2CAP_CID_SMP
+
+from test_hci import FakeTransport
+
+
+def fragments(connection_handle, cid, payload, size):
+    pdu = struct.pack("<HH", len(payload), cid) + payload
+    packets = []
+    pb = 0b10
+    for offset in range(0, len(pdu), size):
+        fragment = pdu[offset : offset + size]
+        packets.append(struct.pack("<HH", connection_handle | (pb << 12), len(fragment)) + fragment)
+        pb = 0b01
+    return packets
+
+
+class TestL2capRecombination(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.hci = HCI(self.transport, btsnoop=None)
+        self.hci.open()
+        self.l2cap = L2CAP(self.hci, mtu=600)
+        self.received = []
+        self.l2cap.register_channel(0x0004, lambda handle, cid, payload: self.received.append((handle, payload)))
+
+    def test_single_packet(self):
+        for packet in fragments(0x0040, 0x0004, b"\x0a\x03\x00", 27):
+            self.transport.inject_acl(packet)
+        self.assertEqual(self.received, [(0x0040, b"\x0a\x03\x00")])
+
+    def test_recombine(self):
+        payload = bytes(range(256)) * 2
+        for packet in fragments(0x0040, 0x0004, payload, 27):
+            self.transport.inject_acl(packet)
+        self.assertEqual(self.received, [(0x0040, payload)])
+
+    def test_interleaved_handles(self):
+        a = fragments(0x0040, 0x0004, b"a" * 100, 27)
+        b = fragments(0x0041, 0x0004, b"b" * 100, 27)
+        for pa, pb in zip(a, b):
+            self.transport.inject_acl(pa)
+            self.transport.inject_acl(pb)
+        self.assertEqual(sorted(self.received), [(0x0040, b"a" * 100), (0x0041, b"b" * 100)])
+
+    def test_split_l2cap_header(self):
+        for packet in fragments(0x0040, 0x0004, b"x" * 10, 3):
+            self.transport.inject_acl(packet)
+        self.assertEqual(self.received, [(0x0040, b"x" * 10)])
+
+    def test_exceeds_mtu(self):
+        for packet in fragments(0x0040, 0x0004, bytes(700), 251):
+            self.transport.inject_acl(packet)
+        self.assertEqual(self.received, [])
+        # the next PDU is received normally
+        for packet in fragments(0x0040, 0x0004, bytes(300), 251):
+            self.transport.inject_acl(packet)
+        self.assertEqual(self.received, [(0x0040, bytes(300))])
+
+    def test_incomplete_pdu_dropped_on_start(self):
+        packets = fragments(0x0040, 0x0004, bytes(100), 27)
+        self.transport.inject_acl(packets[0])
+        for packet in fragments(0x0040, 0x0004, b"ok", 27):
+            self.transport.inject_acl(packet)
+        self.assertEqual(self.received, [(0x0040, b"ok")])
+
+    def test_send_fragmented(self):
+        self.hci.acl_scheduler.set_buffer_size(27, 8)
+        self.l2cap.send(0x0040, 0x0004, bytes(100))
+        self.assertEqual(len(self.transport.acl), 4)
+        self.assertEqual(self.transport.acl[0][:2], struct.pack("<H", 0x0040))
+        self.assertEqual(self.transport.acl[1][:2], struct.pack("<H", 0x0040 | 0x1000))
+
+
+class TestL2capChannels(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.hci = HCI(self.transport, btsnoop=None)
+        self.hci.open()
+        self.l2cap = L2CAP(self.hci)
+
+    def inject(self, cid, payload, connection_handle=0x0040):
+        for packet in fragments(connection_handle, cid, payload, 251):
+            self.transport.inject_acl(packet)
+
+    def sent(self):
+        # strip the ACL and L2CAP headers
+        return [(struct.unpack_from("<H", p, 6)[0], p[8:]) for p in self.transport.acl]
+
+    def test_fixed_channels(self):
+        att = []
+        self.l2cap.register_channel(L2CAP_CID_ATT, lambda handle, cid, payload: att.append(payload))
+        SecurityManager(self.l2cap)
+        self.inject(L2CAP_CID_SMP, bytes.fromhex("01030000100707"))
+        self.inject(L2CAP_CID_ATT, b"\x0a\x03\x00")
+        self.assertEqual(att, [b"\x0a\x03\x00"])
+        # pairing failed, pairing not supported
+        self.assertEqual(self.sent(), [(L2CAP_CID_SMP, b"\x05\x05")])
+        # responses and key distribution are never answered
+        self.transport.acl.clear()
+        self.inject(L2CAP_CID_SMP, bytes.fromhex("02030000100707"))
+        self.inject(L2CAP_CID_SMP, b"\x06" + bytes(16))
+        self.inject(L2CAP_CID_SMP, b"\x05\x05")
+        self.assertEqual(self.sent(), [])
+
+    def test_unknown_cid_dropped(self):
+        att = []
+        self.l2cap.register_channel(L2CAP_CID_ATT, lambda handle, cid, payload: att.append(payload))
+        self.inject(0x0050, b"\x0a\x03\x00")
+        self.assertEqual(att, [])
+
+    def test_dynamic_channels(self):
+        received = []
+        cid = self.l2cap.allocate_cid(0x0040, lambda handle, cid, payload: received.append((handle, cid, payload)))
+        self.assertEqual(cid, 0x0040)
+        self.assertEqual(self.l2cap.allocate_cid(0x0040, None), 0x0041)
+        # same cid on another connection is not routed
+        self.inject(cid, b"data", 0x0041)
+        self.inject(cid, b"data")
+        self.assertEqual(received, [(0x0040, cid, b"data")])
+        self.l2cap.release_cid(0x0040, cid)
+        self.assertEqual(self.l2cap.allocate_cid(0x0040, None), cid)
+
+    def test_signaling_reject(self):
+        # connection parameter update response is never rejected
+        self.inject(L2CAP_CID_LE_SIGNALING, bytes.fromhex("1301020000 00"))
+        # unknown request
+        self.inject(L2CAP_CID_LE_SIGNALING, bytes.fromhex("40070000"))
+        self.assertEqual(self.sent(), [(L2CAP_CID_LE_SIGNALING, bytes.fromhex("0107020000 00"))])
+
+    def test_signaling_handler(self):
+        commands = []
+        self.l2cap.register_signaling(0x14, lambda handle, cid, identifier, data: commands.append((identifier, data)))
+        self.inject(L2CAP_CID_LE_SIGNALING, bytes.fromhex("140302000102"))
+        self.assertEqual(commands, [(3, b"\x01\x02")])
+        self.assertEqual(self.sent(), [])
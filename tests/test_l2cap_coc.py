@@ -0,0 +1,100 @@
+import queue
+import threading
+import unittest
+
+from pybtool.host import HCI, L2CAP
+from pybtool.host.l2cap_coc import L2capCoc, L2capCocError, COC_RESULT_PSM_NOT_SUPPORTED, COC_RESULT_UNACCEPTABLE_PARAMETERS
+
+from test_hci import FakeTransport
+
+
+class LinkedTransport(FakeTransport):
+    """
+    deliver the ACL packets sent by the host to the peer transport from a worker thread
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.peer = None
+        self.pipe = queue.Queue()
+        threading.Thread(target=self._deliver, daemon=True).start()
+
+    def send_acl(self, data: bytes):
+        super().send_acl(data)
+        self.pipe.put(data)
+
+    def _deliver(self):
+        while True:
+            data = self.pipe.get()
+            self.peer.inject_acl(data)
+
+
+def le_stack():
+    transport = LinkedTransport()
+    hci = HCI(transport, btsnoop=None)
+    hci.open()
+    l2cap = L2CAP(hci)
+    return transport, L2capCoc(l2cap)
+
+
+class TestL2capCoc(unittest.TestCase):
+    def setUp(self):
+        self.client_transport, self.client = le_stack()
+        self.server_transport, self.server = le_stack()
+        self.client_transport.peer = self.server_transport
+        self.server_transport.peer = self.client_transport
+        self.accepted = queue.Queue()
+        self.server.register_psm(0x0080, self.accepted.put, mtu=1024, mps=100, credits=4)
+
+    def test_connect_and_transfer(self):
+        channel = self.client.connect(0x0040, 0x0080, mtu=512, mps=64, credits=2).result(2)
+        peer = self.accepted.get(timeout=2)
+        self.assertEqual((channel.remote_mtu, channel.remote_mps, channel.tx_credits), (1024, 100, 4))
+        self.assertEqual((peer.remote_mtu, peer.remote_mps), (512, 64))
+        sdus = [bytes([i]) * (i * 37) for i in range(1, 20)]
+        for sdu in sdus:
+            channel.send(sdu)
+        # 19 SDUs need far more K-frames than the 4 initial credits
+        self.assertTrue(channel.drain(2))
+        self.assertEqual([peer.receive(timeout=2) for _ in sdus], sdus)
+        # and the other way round
+        peer.write(bytes(1500))
+        self.assertEqual([len(channel.receive(timeout=2)) for _ in range(3)], [512, 512, 476])
+
+    def test_sdu_too_long(self):
+        channel = self.client.connect(0x0040, 0x0080).result(2)
+        with self.assertRaises(ValueError):
+            channel.send(bytes(1025))
+
+    def test_psm_not_supported(self):
+        with self.assertRaises(L2capCocError) as cm:
+            self.client.connect(0x0040, 0x0081).result(2)
+        self.assertEqual(cm.exception.result, COC_RESULT_PSM_NOT_SUPPORTED)
+
+    def test_unacceptable_parameters(self):
+        with self.assertRaises(ValueError):
+            self.client.connect(0x0040, 0x0080, mtu=22)
+        # a peer below the LE minimum is refused by the server
+        self.client._check_parameters = lambda mtu, mps: None
+        with self.assertRaises(L2capCocError) as cm:
+            self.client.connect(0x0040, 0x0080, mtu=64, mps=10).result(2)
+        self.assertEqual(cm.exception.result, COC_RESULT_UNACCEPTABLE_PARAMETERS)
+        self.assertTrue(self.accepted.empty())
+
+    def test_enhanced(self):
+        channels = self.client.connect_enhanced(0x0040, 0x0080, 3, mtu=256, mps=64).result(2)
+        self.assertEqual(len(channels), 3)
+        peers = [self.accepted.get(timeout=2) for _ in range(3)]
+        self.assertEqual(sorted(p.remote_cid for p in peers), sorted(c.local_cid for c in channels))
+        channels[1].send(b"hello")
+        peer = next(p for p in peers if p.remote_cid == channels[1].local_cid)
+        self.assertEqual(peer.receive(timeout=2), b"hello")
+
+    def test_disconnect(self):
+        channel = self.client.connect(0x0040, 0x0080).result(2)
+        peer = self.accepted.get(timeout=2)
+        channel.disconnect()
+        self.assertIsNone(peer.receive(timeout=2))
+        self.assertIsNone(channel.receive(timeout=2))
+        self.assertEqual(self.client.channels, {})
+        self.assertEqual(self.server.channels, {})
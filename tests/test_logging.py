@@ -0,0 +1,47 @@
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import tempfile
+import unittest
+
+from pybtool.main import LogQueueHandler, gzip_namer, gzip_rotator
+from pybtool.host.trace import HexBytes
+
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.logger = logging.getLogger("pybtool.test.logging")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        for handler in self.logger.handlers[:]:
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.tmp.cleanup()
+
+    def test_queue_handler_formats_in_listener(self):
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(LogQueueHandler(log_queue))
+        self.logger.debug("%s:%s", "recv evt", HexBytes(b"\x0e\x04"))
+        record = log_queue.get_nowait()
+        # still unformatted when enqueued
+        self.assertIsInstance(record.args[1], HexBytes)
+        self.assertEqual(record.getMessage(), "recv evt:0e 04")
+
+    def test_gzip_rotation(self):
+        filename = os.path.join(self.tmp.name, "app.log")
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=64, backupCount=2)
+        handler.namer = gzip_namer
+        handler.rotator = gzip_rotator
+        self.logger.addHandler(handler)
+        for i in range(10):
+            self.logger.info("line %d %s", i, "x" * 40)
+        handler.close()
+        self.assertTrue(os.path.exists(filename + ".1.gz"))
+        self.assertFalse(os.path.exists(filename + ".3.gz"))
+        with gzip.open(filename + ".1.gz", "rt") as f:
+            self.assertIn("line", f.read())
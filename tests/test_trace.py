@@ -0,0 +1,35 @@
+import logging
+import unittest
+
+from pybtool.host.trace import HexBytes, get_tracer
+
+
+class CountingBytes(bytes):
+    hex_calls = 0
+
+    def hex(self, *args):
+        CountingBytes.hex_calls += 1
+        return super().hex(*args)
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.tracer = get_tracer("test")
+        CountingBytes.hex_calls = 0
+
+    def tearDown(self):
+        self.tracer.logger.setLevel(logging.NOTSET)
+
+    def test_hex_bytes(self):
+        self.assertEqual(str(HexBytes(b"\x01\x03\x0c\x00")), "01 03 0c 00")
+
+    def test_disabled_not_formatted(self):
+        self.tracer.logger.setLevel(logging.WARNING)
+        self.tracer.packet("send cmd", CountingBytes(b"\x01\x03\x0c\x00"))
+        self.assertEqual(CountingBytes.hex_calls, 0)
+
+    def test_enabled(self):
+        self.tracer.logger.setLevel(logging.DEBUG)
+        with self.assertLogs(self.tracer.logger, logging.DEBUG) as cm:
+            self.tracer.packet("send cmd", CountingBytes(b"\x01\x03\x0c\x00"))
+        self.assertEqual(cm.output, ["DEBUG:pybtool.trace.test:send cmd:01 03 0c 00"])
@@ -0,0 +1,144 @@
+import os
+import tempfile
+import time
+import unittest
+
+from pybtool.host.hci import HCI
+from pybtool.host.hci_cmd import HciCmdReset, HciCmdReadBdAddr
+from pybtool.host.hci_evt import HciEventCommandCompleteBdAddr
+from pybtool.host.hci_transport import replay_interface, loopback_interface
+from pybtool.host.hci_evt import HciEventLeConnectionComplete
+from pybtool.host.hci_transport.reassembler import HciPacketReassembler, H4Demux
+
+from test_hci import FakeTransport
+
+
+class TestHciPacketReassembler(unittest.TestCase):
+    def setUp(self):
+        self.packets = []
+
+    def test_event_split(self):
+        r = HciPacketReassembler.event(self.packets.append)
+        evt = bytes([0x3E, 0xFF]) + bytes(range(255))
+        for i in range(0, len(evt), 16):
+            r.feed(evt[i : i + 16])
+        self.assertEqual(self.packets, [evt])
+
+    def test_acl_large(self):
+        r = HciPacketReassembler.acl(self.packets.append)
+        acl = bytes([0x40, 0x20, 0xFD, 0x03]) + bytes(1021)
+        r.feed(acl[:256])
+        self.assertEqual(self.packets, [])
+        r.feed(acl[256:3])  # empty chunk
+        r.feed(acl[256:])
+        self.assertEqual(self.packets, [acl])
+
+    def test_multiple_packets_in_chunk(self):
+        r = HciPacketReassembler.event(self.packets.append)
+        evt1 = bytes.fromhex("0e0401030c00")
+        evt2 = bytes.fromhex("0f0400010d20")
+        evt3 = bytes.fromhex("0500")
+        r.feed(evt1 + evt2[:3])
+        r.feed(evt2[3:] + evt3 + evt1[:1])
+        r.feed(evt1[1:])
+        self.assertEqual(self.packets, [evt1, evt2, evt3, evt1])
+
+    def test_header_split(self):
+        r = HciPacketReassembler.acl(self.packets.append)
+        acl = bytes([0x40, 0x20, 0x02, 0x00, 0xAA, 0xBB])
+        for b in acl:
+            r.feed(bytes([b]))
+        self.assertEqual(self.packets, [acl])
+
+
+class TestH4Demux(unittest.TestCase):
+    def test_demux(self):
+        events = []
+        acl = []
+        demux = H4Demux(events.append, acl.append)
+        evt = bytes.fromhex("0e0401030c00")
+        data = bytes([0x40, 0x20, 0x05, 0x00]) + bytes(5)
+        stream = b"\x04" + evt + b"\x02" + data + b"\x04" + evt
+        for i in range(0, len(stream), 5):
+            demux.feed(stream[i : i + 5])
+        self.assertEqual(events, [evt, evt])
+        self.assertEqual(acl, [data])
+
+    def test_resync(self):
+        events = []
+        demux = H4Demux(events.append, None)
+        evt = bytes.fromhex("0e0401030c00")
+        demux.feed(b"\xff\x00" + b"\x04" + evt)
+        self.assertEqual(events, [evt])
+
+
+class TestReplayInterface(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "hci.cfa")
+        hci = HCI(FakeTransport(), btsnoop=self.path)
+        hci.open()
+        hci.send_command(HciCmdReset())
+        hci.send_command(HciCmdReadBdAddr(), HciEventCommandCompleteBdAddr())
+        hci.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_replay(self):
+        transport = replay_interface(self.path)
+        hci = HCI(transport, btsnoop=None)
+        hci.open()
+        self.assertIsNotNone(hci.send_command(HciCmdReset()))
+        evt = hci.send_command(HciCmdReadBdAddr(), HciEventCommandCompleteBdAddr())
+        self.assertTrue(transport.wait(1))
+        hci.close()
+        self.assertEqual(evt.bd_addr, "01:02:03:04:05:06")
+        self.assertEqual(transport.mismatches, [])
+        self.assertEqual(transport.packets_replayed, 2)
+
+    def test_mismatch(self):
+        transport = replay_interface(self.path, timeout=0.1)
+        hci = HCI(transport, btsnoop=None)
+        hci.open()
+        hci.send_command(HciCmdReadBdAddr(), timeout=0.2)
+        self.assertTrue(transport.wait(1))
+        hci.close()
+        self.assertEqual(transport.mismatches[0][0], 0)
+        self.assertEqual(transport.mismatches[0][2], bytes.fromhex("01091000"))
+
+
+class TestLoopbackInterface(unittest.TestCase):
+    def setUp(self):
+        self.transport = loopback_interface(acl_buffers=4, acl_mode="echo")
+        self.hci = HCI(self.transport, btsnoop=None)
+        self.hci.open()
+
+    def tearDown(self):
+        self.hci.close()
+
+    def test_init(self):
+        self.hci.init()
+        self.assertEqual(self.hci.acl_scheduler.acl_mtu, 251)
+        self.assertEqual(self.hci.acl_scheduler.total_num_acl_packets, 4)
+
+    def test_acl_flow_control(self):
+        self.hci.init()
+        connections = []
+        self.hci.register_le_event(HciEventLeConnectionComplete.SUBEVENT_CODE, connections.append)
+        echoed = []
+        self.hci.register_acl(echoed.append)
+        connection_handle = self.transport.connect()
+        for _ in range(50):
+            self.hci.send_acl_data(connection_handle, bytes(600))
+        deadline = time.time() + 5
+        while len(echoed) < 150 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(connections[0].connection_handle, connection_handle)
+        self.assertEqual(len(echoed), 150)
+        self.assertEqual(self.transport.acl_overflows, 0)
+        self.assertEqual(self.transport.acl_bytes_received, 50 * 600)
+
+
+if __name__ == "__main__":
+    unittest.main()